@@ -31,17 +31,38 @@ app.conf.task_routes = {
     'CeleryApp.tasks.remove_dirs_task': {
         'queue': 'common_worker_queue'
     },
+    'CeleryApp.tasks.build_download_archive_task': {
+        'queue': 'common_worker_queue'
+    },
     'CeleryApp.tasks.check_count_processed_videos_periodic_task': {
         'queue': 'common_worker_queue'
     },
+    'CeleryApp.tasks.check_nextcloud_health_periodic_task': {
+        'queue': 'common_worker_queue'
+    },
+    'CeleryApp.tasks.drain_pending_uploads_periodic_task': {
+        'queue': 'common_worker_queue'
+    },
     'CeleryApp.tasks.repack_threads_video_task': {
         'queue': 'ffmpeg_worker_queue'
     },
+    'CeleryApp.tasks.repack_segment_task': {
+        'queue': 'ffmpeg_worker_queue'
+    },
+    'CeleryApp.tasks.finish_segmented_repack_task': {
+        'queue': 'ffmpeg_worker_queue'
+    },
+    'CeleryApp.tasks.repack_segments_failed_task': {
+        'queue': 'ffmpeg_worker_queue'
+    },
     'CeleryApp.tasks.terminate_process_task': {
         'queue': 'ffmpeg_worker_queue'
     },
     'CeleryApp.tasks.upload_processed_records': {
         'queue': 'upload_worker_queue'
+    },
+    'CeleryApp.tasks.upload_repack_task': {
+        'queue': 'upload_worker_queue'
     }
 }
 
@@ -58,4 +79,12 @@ app.conf.beat_schedule = {
         'task': 'CeleryApp.tasks.check_count_processed_videos_periodic_task',
         'schedule': 60*10,
     },
+    'Check NextCloud health every minute': {
+        'task': 'CeleryApp.tasks.check_nextcloud_health_periodic_task',
+        'schedule': settings.NEXTCLOUD_HEALTH_CHECK_INTERVAL,
+    },
+    'Dispatch pending uploads every 5 minutes': {
+        'task': 'CeleryApp.tasks.drain_pending_uploads_periodic_task',
+        'schedule': settings.PENDING_UPLOADS_INTERVAL,
+    },
 }
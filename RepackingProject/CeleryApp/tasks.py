@@ -6,31 +6,43 @@ import shutil
 import logging
 import datetime
 import subprocess
+from typing import List, Tuple
+from urllib.parse import urlsplit
 
+import requests
 from django.db.models import Q
 from django.conf import settings
 from django.db.utils import IntegrityError
 from django.core.mail import send_mail, BadHeaderError
+from celery import chord
 
 from AccountApp.models import UserModel
 from AccountApp.services.user import get_user
 from CeleryApp.app import app
 from core import dynamic_settings
 from RepackingApp.models import RecordingTaskIdModel
-from common.archive import Archiving, ArchivingUnpack
+from common.archive import Archiving, ArchiveMember, ZipStream
 from common.chat_format import MessageListContainer, read_xml_popcorn, save_file
-from common.conn_check import health_check
-from common.nextcloud import upload_to_nextcloud, set_up, mkdir_root
+from common.media_cache import MediaCache
+from common.ffmpeg_repack import StageTimer, get_encoder_profile, thread_budget, prepare_sources, encode_video, \
+    build_segment_commands, concat_segments, run_ffmpeg
+from common.nextcloud import upload_files, UPLOAD_ERRORS, is_available, check_health, record_upload_error
 from common.process_termination import terminate_process
 from common.redis_conn import get_redis_connection
 from common.mail.email_user import NotifyEmailUser
-from RepackingApp.services.record_task import update_recording_tasks, create_recording_task
+from RepackingApp.services.record_task import update_recording_tasks, create_recording_task, get_recording_tasks
+from RepackingApp.services.progress import update_task_progress, increment_segments_progress
 from RepackingApp.services.order_record import update_recording_orders, get_recording_orders, \
     get_recording_orders_with_type_recording
 from RepackingApp.services.notify_email_user import send_processed_video_notify_email
-from RepackingApp.services.downloads import create_recording_file, delete_recording_files, get_recording_files
-from RepackingApp.services.records import update_recording_by_record_id, \
-    upload_recordings_from_source_without_duplicate, get_recordings_foreinkey_type_recording, get_type_recording_by_id
+from RepackingApp.services.pending_upload import defer_upload, complete_upload, take_pending_uploads
+from RepackingApp.services.downloads import create_recording_file, delete_recording_files, get_recording_files, \
+    get_processed_recording_file, remove_recording_file, build_download_archive
+from RepackingApp.services.records import sync_recordings, get_recordings_foreinkey_type_recording
+
+
+# Ошибки обработки записи: источник недоступен (сеть, кэш, диск), ffprobe или ffmpeg завершились с ошибкой
+REPACK_ERRORS = (OSError, ValueError, requests.RequestException, subprocess.CalledProcessError)
 
 
 @app.task
@@ -69,16 +81,429 @@ def send_mail_use_broker_task(
         logging.warning('|||->The your mail is sent with failed.<-|||')
 
 
+def get_waiting_tasks_key(record_id, profile) -> str:
+    return settings.REDIS_KEY_RECORDING_WAITERS.format(record_id, profile)
+
+
+def pop_waiting_tasks(record_id, profile) -> List[str]:
+    """
+    Извлекает и очищает множество задач, ожидающих обработку записи с профилем profile
+    :param record_id:
+    :param profile:
+    :return: task_id ожидающих задач
+    """
+
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        task_ids, _ = pipe.smembers(get_waiting_tasks_key(record_id, profile)) \
+            .delete(get_waiting_tasks_key(record_id, profile)) \
+            .execute()
+
+    return [task_id.decode("utf-8") for task_id in task_ids]
+
+
+def link_recording_file(recording_task, recording_file, status) -> None:
+    """
+    Связывает задачу заказа с готовым архивом записи без повторной обработки.
+    Если архив не загружен в NextCloud, а владелец заказа загружает записи,
+    загрузка архива ставится в очередь загрузки
+    :param recording_task: RecordingTaskIdModel
+    :param recording_file: RecodingFileUserModel
+    :param status: 4 или 5, если архив уже загружен в NextCloud
+    :return:
+    """
+
+    task_id = recording_task.task_id
+
+    create_recording_file(recording_task_id=task_id,
+                          file=recording_file.file,
+                          file_size=recording_file.file_size)
+    update_recording_tasks(Q(task_id=task_id), status=status)
+    update_task_progress(task_id, status=status, stage="done", percent=100)
+
+    r = get_redis_connection()
+    r.incr(settings.REDIS_KEY_ORDER_PROCESSED.format(recording_task.order_id))
+
+    logging.info(f"Link recording task {task_id} to {recording_file.file}")
+
+    if status == 4 and recording_task.order.user.nextcloud_upload:
+        logging.info(f"Queue upload {recording_task.recording_id} to NEXTCLOUD")
+        upload_processed_records.delay(task_id,
+                                       recording_task.order.user_id,
+                                       recording_task.recording.type_recording.name,
+                                       recording_file.file)
+
+
+def link_waiting_tasks(record_id, profile, recording_file, status) -> None:
+    """
+    Связывает ожидающие задачи с архивом завершенной обработки.
+    Отмененные пользователем задачи (статус не 2) пропускаются
+    :param record_id:
+    :param profile:
+    :param recording_file:
+    :param status:
+    :return:
+    """
+
+    task_ids = pop_waiting_tasks(record_id, profile)
+    if not task_ids:
+        return
+
+    recording_tasks = get_recording_tasks(Q(task_id__in=task_ids) & Q(status=2)) \
+        .select_related("order__user", "recording__type_recording")
+    for recording_task in recording_tasks:
+        link_recording_file(recording_task, recording_file, status)
+
+
+def fail_waiting_tasks(record_id, profile) -> None:
+    """
+    Ожидающие задачи завершаются неудачно вместе с обработкой, которую они ожидали
+    :param record_id:
+    :param profile:
+    :return:
+    """
+
+    task_ids = pop_waiting_tasks(record_id, profile)
+    if not task_ids:
+        return
+
+    r = get_redis_connection()
+    recording_tasks = get_recording_tasks(Q(task_id__in=task_ids) & Q(status=2))
+    for recording_task in recording_tasks:
+        r.incr(settings.REDIS_KEY_ORDER_FAILED.format(recording_task.order_id))
+
+    update_recording_tasks(Q(task_id__in=[item.task_id for item in recording_tasks]), status=6)
+    for recording_task in recording_tasks:
+        update_task_progress(recording_task.task_id, status=6, stage="failed")
+
+
+def is_recording_processing(record_id, profile, waiting_task_ids) -> bool:
+    """
+    Есть ли задача, которая кодирует запись с профилем profile
+    :param record_id:
+    :param profile:
+    :param waiting_task_ids: задачи, которые сами ожидают обработку
+    :return:
+    """
+
+    return get_recording_tasks(
+        Q(recording_id=record_id) & Q(profile=profile) & Q(status__in=[2, 3]) & ~Q(task_id__in=waiting_task_ids)
+    ).exists()
+
+
+def reuse_processed_recording(recording_task: dict) -> bool:
+    """
+    Дедупликация обработки по record_id и профилю кодирования.
+    Если архив записи уже есть, задача заказа связывается с ним,
+    если запись сейчас обрабатывается, задача ожидает эту обработку
+    :param recording_task: поля RecordingTaskIdModel с заранее заданным task_id
+    :return: True, если кодирование не требуется
+    """
+
+    r = get_redis_connection()
+    record_id, profile = recording_task["recording_id"], recording_task["profile"]
+    task_id = recording_task["task_id"]
+    key = get_waiting_tasks_key(record_id, profile)
+
+    recording_file = get_processed_recording_file(record_id, profile)
+    if recording_file:
+        link_recording_file(create_recording_task(**recording_task), recording_file,
+                            recording_file.recording_task.status)
+        return True
+
+    waiting_task_ids = [item.decode("utf-8") for item in r.smembers(key)]
+    if not is_recording_processing(record_id, profile, waiting_task_ids):
+        return False
+
+    waiting_task = create_recording_task(**recording_task)
+    r.sadd(key, task_id)
+
+    # Обработка могла завершиться до добавления задачи в ожидающие
+    if is_recording_processing(record_id, profile, waiting_task_ids + [task_id]):
+        logging.info(f"Recording task {task_id} waits for {record_id} processing")
+        update_task_progress(task_id, stage="waiting")
+        return True
+
+    if not r.srem(key, task_id):
+        # Задачу уже связала с архивом завершенная обработка
+        return True
+
+    recording_file = get_processed_recording_file(record_id, profile)
+    if recording_file:
+        link_recording_file(waiting_task, recording_file, recording_file.recording_task.status)
+        return True
+
+    return False
+
+
+def release_waiting_tasks(recording_tasks) -> None:
+    """
+    Отмена задач с учетом дедупликации: отмененная ожидающая задача удаляется из ожидающих,
+    вместо отмененной обработки запускается первая из ожидающих ее задач
+    :param recording_tasks: отменяемые RecordingTaskIdModel
+    :return:
+    """
+
+    r = get_redis_connection()
+
+    for recording_task in recording_tasks:
+        key = get_waiting_tasks_key(recording_task.recording_id, recording_task.profile)
+        if r.srem(key, recording_task.task_id):
+            continue
+
+        while True:
+            task_id = r.spop(key)
+            if task_id is None:
+                break
+
+            waiting_task = get_recording_tasks(Q(task_id=task_id.decode("utf-8")) & Q(status=2)) \
+                .select_related("recording", "order") \
+                .first()
+            if waiting_task is None:
+                continue
+
+            logging.info(f"Start waiting recording task {waiting_task.task_id}")
+            update_task_progress(waiting_task.task_id, stage="queued")
+            repack_threads_video_task.apply_async(
+                kwargs={
+                    "resource": urlsplit(waiting_task.recording.url).netloc,
+                    "user_id": waiting_task.order.user_id,
+                    "recording_task": {
+                        "recording_id": waiting_task.recording_id,
+                        "task_id": waiting_task.task_id,
+                        "order_id": waiting_task.order_id,
+                        "profile": waiting_task.profile,
+                        "status": 2,
+                    },
+                },
+                task_id=waiting_task.task_id,
+            )
+            break
+
+
+def build_repack_context(recording, profile: str) -> dict:
+    """
+    Имена и пути файлов обработки записи
+    :param recording:
+    :param profile: имя профиля кодирования
+    :return:
+    """
+
+    fname_datetime = recording.datetime_created.astimezone(settings.TIME_ZONE_PYTZ).strftime('%Y-%m-%dT%H:%M')
+    unique_fdir = f"{fname_datetime}-{str(time.time()).replace('.', '')}"
+    local_source_dir = f"files/ffmpeg/{unique_fdir}"
+
+    fname = f"{fname_datetime}.mp4"
+    fname_chat = f"{fname_datetime}.txt"
+    fname_analytic_data = f"analytic_data_{fname_datetime}.csv"
+
+    return {
+        "record_id": recording.record_id,
+        "profile": profile,
+        "fname": fname,
+        "fname_chat": fname_chat,
+        "fname_analytic_data": fname_analytic_data,
+        "local_source_dir": local_source_dir,
+        "local_source_dir_media": f"{local_source_dir}/media",
+        "local_source_file": f"{local_source_dir}/{fname}",
+        "local_source_file_popcorn": f"{local_source_dir}/popcorn.xml",
+        "local_source_file_chat": f"{local_source_dir}/{fname_chat}",
+        "local_source_file_analytic_data": f"{local_source_dir}/{fname_analytic_data}",
+        "remote_dir": f"{recording.type_recording.name}/{unique_fdir}",
+    }
+
+
+def finish_repack(task_id, user_id, order_id, recording, context, timer):
+    """
+    Завершение обработки после кодирования: форматирование чата и копирование аналитики.
+    Загрузка в NextCloud выполняется отдельной задачей в очереди загрузки,
+    чтобы воркер ffmpeg не простаивал на сетевых операциях
+    :param task_id:
+    :param user_id:
+    :param order_id:
+    :param recording:
+    :param context: build_repack_context
+    :param timer:
+    :return:
+    """
+
+    user = get_user(pk=user_id)
+    local_source_file_analytic_data = context["local_source_file_analytic_data"]
+
+    update_task_progress(task_id, percent=100, eta=None)
+
+    # Закрепленные источники из кэша больше не нужны и не должны попасть в архив
+    if os.path.exists(context["local_source_dir_media"]):
+        shutil.rmtree(context["local_source_dir_media"])
+
+    # Форматирование чата конференции
+
+    logging.info("Start format chat file")
+    with timer.stage("chat"):
+        message_list_container = MessageListContainer(
+            recording.type_recording.name,
+            recording.participants,
+            recording.datetime_created,
+        )
+        read_xml_popcorn(context["local_source_file_popcorn"], message_list_container)
+        save_file(context["local_source_file_chat"], message_list_container.to_text())
+
+        os.remove(context["local_source_file_popcorn"])
+
+    # Копирование файла аналитики
+    if recording.analytic_file and os.path.exists(recording.analytic_file):
+        shutil.copy(recording.analytic_file, local_source_file_analytic_data)
+
+    if user.nextcloud_upload:
+        logging.info(f"Queue upload {recording.record_id} to NEXTCLOUD")
+        update_task_progress(task_id, stage="upload_queued")
+        upload_repack_task.delay(task_id, order_id, recording.record_id, context, timer.stages)
+        return
+
+    store_repack(task_id, order_id, recording, context, 4, timer)
+
+
+def get_upload_files(context) -> List[Tuple[str, str]]:
+    """
+    Файлы обработанной записи для загрузки в NextCloud
+    :param context: build_repack_context
+    :return: [(remote_file, local_source_file)]
+    """
+
+    remote_dir = context["remote_dir"]
+    files = [
+        (f"{remote_dir}/{context['fname']}", context["local_source_file"]),
+        (f"{remote_dir}/{context['fname_chat']}", context["local_source_file_chat"]),
+    ]
+    if os.path.exists(context["local_source_file_analytic_data"]):
+        files.append((f"{remote_dir}/{context['fname_analytic_data']}", context["local_source_file_analytic_data"]))
+
+    return files
+
+
+def store_repack(task_id, order_id, recording, context, status, timer):
+    """
+    Архивирование, сохранение файла записи в базе данных и связывание ожидающих задач
+    :param task_id:
+    :param order_id:
+    :param recording:
+    :param context: build_repack_context
+    :param status: 4 или 5, если файлы загружены в NextCloud
+    :param timer:
+    :return: файл записи
+    """
+
+    local_source_dir = context["local_source_dir"]
+
+    # Архивирование. После загрузки файлов в NextCloud хранилище
+    # файлы ахрвируются и появляется возможность скачать по ссылке.
+    # При ARCHIVE_ON_THE_FLY файлы остаются в директории,
+    # архив собирается при скачивании. При передаче файлов через nginx
+    # архив нужен на диске, поэтому файлы архивируются сразу.
+
+    archive_on_the_fly = settings.ARCHIVE_ON_THE_FLY and not settings.DOWNLOAD_X_ACCEL_REDIRECT
+    if archive_on_the_fly:
+        filename = local_source_dir
+        file_size = ZipStream.from_dir(local_source_dir).size()
+    else:
+        with timer.stage("archive"):
+            a = Archiving(path=local_source_dir, expansion="zip", remove=True)
+            filename = a.make_archive()
+        file_size = os.path.getsize(filename)
+    logging.info(f"Create archive {filename}")
+
+    # Добавление информации в базу данных о созданном архиве,
+    # чтобы иметь возможность скачать. Статус обновляется после создания файла,
+    # иначе новая задача на эту запись не найдет ни обработки, ни архива.
+
+    recording_file = create_recording_file(recording_task_id=task_id,
+                                           file=filename,
+                                           file_size=file_size)
+
+    logging.info("Upload to db recording file")
+
+    update_recording_tasks(Q(task_id=task_id), status=status)
+    update_task_progress(task_id, status=status, stage="done")
+
+    # Задачи других заказов, ожидавшие эту обработку, получают тот же архив
+
+    link_waiting_tasks(context["record_id"], context["profile"], recording_file, status)
+
+    # Рекурсивная очистка директорий (с видео и перепиской)
+
+    if not archive_on_the_fly:
+        shutil.rmtree(local_source_dir)
+
+    logging.info(f"Stop process {recording.record_id}. Stages: {timer}")
+
+    r = get_redis_connection()
+    r.incr(settings.REDIS_KEY_ORDER_PROCESSED.format(order_id))
+
+    return recording_file
+
+
+def fail_repack(task_id, order_id, context, error):
+    """
+    Обновление статусов, в том числе ожидающих задач, и очистка директории из-за ошибки обработки
+    :param task_id:
+    :param order_id:
+    :param context: build_repack_context
+    :param error:
+    :return:
+    """
+
+    logging.error(error)
+    local_source_dir = context["local_source_dir"]
+
+    r = get_redis_connection()
+    r.incr(settings.REDIS_KEY_ORDER_FAILED.format(order_id))
+
+    update_recording_tasks(Q(task_id=task_id), status=6)
+    update_task_progress(task_id, status=6, stage="failed", eta=None)
+
+    r.delete(task_id)
+    r.save()
+
+    if os.path.exists(local_source_dir):
+        shutil.rmtree(local_source_dir)
+
+    fail_waiting_tasks(context["record_id"], context["profile"])
+
+
+def get_media_cache() -> MediaCache | None:
+    """
+    Локальный кэш источников записей, None если кэш отключен
+    :return:
+    """
+
+    if not settings.MEDIA_CACHE_MAX_SIZE:
+        return None
+    return MediaCache(settings.MEDIA_CACHE_DIR, settings.MEDIA_CACHE_MAX_SIZE, settings.MEDIA_CACHE_RANGE_WORKERS)
+
+
+def is_recording_task_processing(task_id) -> bool:
+    """
+    Проверяет, что задача не была завершена пользователем
+    :param task_id:
+    :return:
+    """
+
+    return get_recording_tasks(Q(task_id=task_id) & Q(status=3)).exists()
+
+
 @app.task(bind=True)
 def repack_threads_video_task(
     self, resource, user_id, recording_task
 ):
     """
-    Перепакова видео через отложенный вызов
+    Перепакова видео через отложенный вызов.
+    Длинные записи в режиме split_mode кодируются отрезками через chord
+    из repack_segment_task, обработка завершается в finish_segmented_repack_task
     :param self:
     :param resource:
     :param recording_id:
     :param user_id:
+    :param recording_task: поля RecordingTaskIdModel, profile - имя профиля кодирования
     :return: None
     """
 
@@ -86,9 +511,6 @@ def repack_threads_video_task(
 
     r = get_redis_connection()
 
-    # Извелаем пользователя для проверки возможности загрузки и отправки эп.
-
-    user = get_user(pk=user_id)
     order_id = recording_task["order_id"]
     recording_id = recording_task["recording_id"]
 
@@ -105,24 +527,18 @@ def repack_threads_video_task(
             Q(task_id=self.request.id), status=3
         )
 
+    update_task_progress(self.request.id, status=3, stage="start")
+
     logging.info(f"Start process {resource}, {recording_id}")
 
     recordings = get_recordings_foreinkey_type_recording(Q(record_id=recording_id))
     first_recording = recordings[0]
 
-    fname_datetime = first_recording.datetime_created.astimezone(settings.TIME_ZONE_PYTZ).strftime('%Y-%m-%dT%H:%M')
-    fname = f"{fname_datetime}.mp4"
-    unique_fdir = f"{fname_datetime}-{str(time.time()).replace('.', '')}"
-    fname_popcorn = f"popcorn.xml"
-    fname_chat = f"{fname_datetime}.txt"
-    fname_analytic_data = f"analytic_data_{fname_datetime}.csv"
+    ffmpeg_settings = dynamic_settings.get_ffmpeg_settings()
+    encoder_profile = get_encoder_profile(recording_task["profile"], ffmpeg_settings["encoder_profiles"])
 
-    local_source_dir = f"files/ffmpeg/{unique_fdir}"
-    local_source_file = f"{local_source_dir}/{fname}"
-    local_source_file_popcorn = f"{local_source_dir}/{fname_popcorn}"
-    local_source_file_chat = f"{local_source_dir}/{fname_chat}"
-    local_source_file_analytic_data = f"{local_source_dir}/{fname_analytic_data}"
-    remote_dir = f"{first_recording.type_recording.name}/{unique_fdir}"
+    context = build_repack_context(first_recording, encoder_profile.name)
+    local_source_dir = context["local_source_dir"]
 
     # Добавляем идентификатор задачи и процессорное имя,
     # чтобы можно было завершить задачу
@@ -131,111 +547,198 @@ def repack_threads_video_task(
     r.save()
 
     try:
-        # Через модуль subprocess запускаем bash script, для обарботки видео потоков
-        # через ffmpeg.
+        # Перепаковка видео потоков через ffmpeg с отслеживанием прогресса
+        # и замером времени этапов.
         # Файлы сохраняются в директорию files/ffmpeg/
 
         logging.info("Start process ffmpeg")
-        subprocess.run(
-            [
-                "./scripts/start-repack-ffmpeg.sh",
-                "-r", resource,
-                "-i", recording_id,
-                "-o", local_source_file
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.STDOUT,
-            check=True
+        threads = thread_budget(settings.FFMPEG_CELERY_CONCURRENCY)
+
+        timer = StageTimer(on_stage=lambda stage: update_task_progress(self.request.id, stage=stage))
+        sources = prepare_sources(resource, recording_id, local_source_dir, timer, get_media_cache(),
+                                  context["local_source_dir_media"])
+
+        segment_duration = ffmpeg_settings["segment_duration"]
+        if ffmpeg_settings["split_mode"] and sources.can_split(encoder_profile, segment_duration):
+            # Кодирование отрезков на свободных воркерах очереди ffmpeg,
+            # склейка и завершение обработки выполняются после всех отрезков
+
+            segment_commands = build_segment_commands(sources, local_source_dir, encoder_profile,
+                                                      threads, segment_duration)
+            logging.info(f"Split {recording_id} into {len(segment_commands)} segments")
+            update_task_progress(self.request.id, stage="segments", percent=0,
+                                 segments_total=len(segment_commands), segments_done=0)
+
+            header = [
+                repack_segment_task.s(segment_file, command, self.request.id)
+                for segment_file, command in segment_commands
+            ]
+            body = finish_segmented_repack_task.s(
+                self.request.id, user_id, order_id, recording_id, context,
+                sources.webcams, sources.audio_args(encoder_profile), timer.stages, time.time()
+            )
+            chord(header)(body.on_error(
+                repack_segments_failed_task.s(self.request.id, order_id, context)
+            ))
+            return
+
+        def on_progress(progress):
+            logging.info(f"Process ffmpeg {recording_id}: {progress}")
+            update_task_progress(self.request.id,
+                                 percent=progress.percent(sources.duration),
+                                 eta=progress.eta(sources.duration))
+
+        encode_video(
+            sources, context["local_source_file"],
+            on_progress=on_progress,
+            timer=timer,
+            profile=encoder_profile,
+            threads=threads
         )
 
-        # Обновление статуса задачи на "завершена"
+        finish_repack(self.request.id, user_id, order_id, first_recording, context, timer)
 
-        update_recording_tasks(Q(task_id=self.request.id), status=4)
+    except REPACK_ERRORS as f:
+        fail_repack(self.request.id, order_id, context, f)
 
-        # Форматирование чата конференции
 
-        logging.info("Start format chat file")
-        message_list_container = MessageListContainer(
-            first_recording.type_recording.name,
-            first_recording.participants,
-            first_recording.datetime_created,
-        )
-        read_xml_popcorn(local_source_file_popcorn, message_list_container)
-        save_file(local_source_file_chat, message_list_container.to_text())
-
-        os.remove(local_source_file_popcorn)
+@app.task
+def repack_segment_task(segment_file, command, task_id=None):
+    """
+    Кодирование отрезка записи
+    :param segment_file:
+    :param command:
+    :param task_id: идентификатор repack_threads_video_task для учета прогресса
+    :return: segment_file
+    """
 
-        # Копирование файла аналитики
-        if first_recording.analytic_file and os.path.exists(first_recording.analytic_file):
-            shutil.copy(first_recording.analytic_file, local_source_file_analytic_data)
+    logging.info(f"Start process segment {segment_file}")
+    run_ffmpeg(command, on_progress=lambda progress: logging.info(f"Process ffmpeg {segment_file}: {progress}"))
 
-        # Загрузка файлов видео конференции и переписки чата в NextCloud хранилище.
+    if task_id:
+        increment_segments_progress(task_id)
+    return segment_file
 
-        if not health_check(domain=dynamic_settings.NEXTCLOUD_RESOURCE, schema="https"):
-            logging.error(f"The \"{dynamic_settings.NEXTCLOUD_RESOURCE}\" resource is not unavailable!")
-            update_recording_tasks(Q(task_id=self.request.id), status=4)
 
-        elif user.nextcloud_upload:
-            logging.info("Start upload to NEXTCLOUD")
+@app.task
+def finish_segmented_repack_task(segment_files, task_id, user_id, order_id, recording_id, context,
+                                 webcams, audio_args, stages, datetime_split):
+    """
+    Склейка закодированных отрезков и завершение обработки записи
+    :param segment_files: результаты repack_segment_task
+    :param task_id: идентификатор repack_threads_video_task
+    :param user_id:
+    :param order_id:
+    :param recording_id:
+    :param context: build_repack_context
+    :param webcams:
+    :param audio_args:
+    :param stages: этапы, замеренные до разделения на отрезки
+    :param datetime_split: время постановки отрезков в очередь
+    :return:
+    """
 
-            oc = set_up()
-            mkdir_root(oc)
+    local_source_dir = context["local_source_dir"]
 
-            upload_to_nextcloud(oc, f"{remote_dir}/{fname}", local_source_file)
-            upload_to_nextcloud(oc, f"{remote_dir}/{fname_chat}", local_source_file_chat)
+    if not is_recording_task_processing(task_id):
+        logging.info(f"Recording task {task_id} is terminated")
+        if os.path.exists(local_source_dir):
+            shutil.rmtree(local_source_dir)
+        return
 
-            if os.path.exists(local_source_file_analytic_data):
-                upload_to_nextcloud(oc, f"{remote_dir}/{fname_analytic_data}", local_source_file_analytic_data)
+    timer = StageTimer(on_stage=lambda stage: update_task_progress(task_id, stage=stage))
+    timer.stages = dict(stages)
+    timer.stages["segments"] = time.time() - datetime_split
 
-            logging.info("Upload successfully")
+    try:
+        concat_segments(segment_files, context["local_source_file"], webcams, audio_args, timer)
 
-            # Обновление статуса задачи на "загружена"
+        recording = get_recordings_foreinkey_type_recording(Q(record_id=recording_id))[0]
+        finish_repack(task_id, user_id, order_id, recording, context, timer)
 
-            update_recording_tasks(Q(task_id=self.request.id), status=5)
+    except REPACK_ERRORS as f:
+        fail_repack(task_id, order_id, context, f)
 
-        # Архивирование. После загрузки файлов в NextCloud хранилище
-        # файлы ахрвируются и появляется возможность скачать по ссылке.
 
-        a = Archiving(path=local_source_dir, expansion="zip")
-        filename = a.make_archive()
-        logging.info(f"Create archive {filename}")
+@app.task
+def repack_segments_failed_task(request, exc, traceback, task_id, order_id, context):
+    """
+    Обработка ошибки кодирования отрезков записи
+    :param request:
+    :param exc:
+    :param traceback:
+    :param task_id:
+    :param order_id:
+    :param context: build_repack_context
+    :return:
+    """
 
-        # Добавление информации в базу данных о созданном архиве,
-        # чтобы иметь возможность скачать.
+    local_source_dir = context["local_source_dir"]
 
-        create_recording_file(recording_task_id=self.request.id,
-                              file=filename,
-                              file_size=os.path.getsize(filename))
+    if not is_recording_task_processing(task_id):
+        logging.info(f"Recording task {task_id} is terminated")
+        if os.path.exists(local_source_dir):
+            shutil.rmtree(local_source_dir)
+        return
 
-        logging.info("Upload to db recording file")
+    fail_repack(task_id, order_id, context, exc)
 
-        # Рекурсивная очистка директорий (с видео и перепиской)
 
-        shutil.rmtree(local_source_dir)
+@app.task
+def upload_repack_task(task_id, order_id, recording_id, context, stages):
+    """
+    Загрузка файлов обработанной записи в NextCloud и завершение обработки.
+    Если хранилище недоступно или загрузка не удалась, запись остается доступной
+    для скачивания со статусом 4
+    :param task_id: идентификатор repack_threads_video_task
+    :param order_id:
+    :param recording_id:
+    :param context: build_repack_context
+    :param stages: этапы, замеренные воркером ffmpeg
+    :return:
+    """
 
-        logging.info(f"Stop process {resource}, {recording_id}")
+    local_source_dir = context["local_source_dir"]
 
-        r.incr(settings.REDIS_KEY_ORDER_PROCESSED.format(order_id))
+    if not is_recording_task_processing(task_id):
+        logging.info(f"Recording task {task_id} is terminated")
+        if os.path.exists(local_source_dir):
+            shutil.rmtree(local_source_dir)
+        return
 
-    except (FileNotFoundError, subprocess.CalledProcessError) as f:
-        logging.error(f)
+    timer = StageTimer(on_stage=lambda stage: update_task_progress(task_id, stage=stage))
+    timer.stages = dict(stages)
+    status = 4
+    failed = False
 
-        # Обновление статусов, очистка директорий из-за ошибки
+    # Состояние NextCloud проверяет периодическая задача, при недоступности загрузка откладывается
+    if is_available():
+        logging.info("Start upload to NEXTCLOUD")
 
-        r.incr(settings.REDIS_KEY_ORDER_FAILED.format(order_id))
+        try:
+            with timer.stage("upload"):
+                upload_files(get_upload_files(context))
 
-        update_recording_tasks(Q(task_id=self.request.id), status=6)
+            logging.info("Upload successfully")
+            status = 5
+        except UPLOAD_ERRORS as e:
+            logging.error(f"Upload {recording_id} is failed: {e}")
+            record_upload_error(e)
+            failed = True
 
-        r.delete(self.request.id)
-        r.save()
+    recording = get_recordings_foreinkey_type_recording(Q(record_id=recording_id))[0]
+    recording_file = store_repack(task_id, order_id, recording, context, status, timer)
 
-        shutil.rmtree(local_source_dir)
+    # Незагруженная запись загрузится из файла записи после восстановления NextCloud
+    if status == 4:
+        defer_upload(task_id, recording_file.file, failed=failed)
 
 
 @app.task
 def upload_processed_records(task_id, user_id, type_recording_name, local_source_file):
     """
-    Загрузка обработных записей
+    Загрузка обработных записей. Если NextCloud недоступен или загрузка не удалась,
+    загрузка откладывается и повторяется drain_pending_uploads_periodic_task
     :param task_id:
     :param user_id:
     :param type_recording_name:
@@ -244,39 +747,81 @@ def upload_processed_records(task_id, user_id, type_recording_name, local_source
     """
     user = get_user(pk=user_id)
 
-    if not health_check(domain=dynamic_settings.NEXTCLOUD_RESOURCE, schema="https"):
-        logging.error(f"The \"{dynamic_settings.NEXTCLOUD_RESOURCE}\" resource is not unavailable!")
+    if not user.nextcloud_upload:
+        complete_upload(task_id)
+        return
 
-    elif user.nextcloud_upload:
-        try:
-            logging.info("Start upload to NEXTCLOUD")
+    if not is_available():
+        defer_upload(task_id, local_source_file)
+        return
 
-            extract_dir = os.path.basename(local_source_file).split('.')[0]
-            fname = f"{'-'.join(extract_dir.split('-')[0:3])}.mp4"
-            local_source_dir = os.path.join(os.path.dirname(local_source_file), extract_dir)
-            remote_file = f"{type_recording_name}/{extract_dir}/{fname}"
+    extract_dir = os.path.basename(local_source_file).split('.')[0]
+    fname_datetime = '-'.join(extract_dir.split('-')[0:3])
+    fnames = [f"{fname_datetime}.mp4", f"{fname_datetime}.txt"]
 
-            a = ArchivingUnpack(local_source_file)
-            a.unpack_archive()
+    try:
+        logging.info("Start upload to NEXTCLOUD")
 
-            oc = set_up()
-            mkdir_root(oc)
-            upload_to_nextcloud(oc, remote_file, f"{local_source_dir}/{fname}")
-            upload_to_nextcloud(oc, f"{type_recording_name}/{extract_dir}/chat.xml", f"{local_source_dir}/popcorn.xml")
+        # Файлы записи хранятся в директории (ARCHIVE_ON_THE_FLY) или в zip архиве,
+        # участники архива загружаются напрямую из него без распаковки на диск
+        if os.path.isdir(local_source_file):
+            sources = [os.path.join(local_source_file, fname) for fname in fnames]
+        else:
+            sources = [ArchiveMember(local_source_file, fname) for fname in fnames]
 
-            shutil.rmtree(local_source_dir)
+        upload_files([
+            (f"{type_recording_name}/{extract_dir}/{fname}", source) for fname, source in zip(fnames, sources)
+        ])
 
-            logging.info("Upload successfully")
+        logging.info("Upload successfully")
 
-            update_recording_tasks(Q(task_id=task_id), status=5)
-        except FileNotFoundError as f:
-            logging.error(f)
-            logging.warning("PASS PASS PASS")
+        update_recording_tasks(Q(task_id=task_id), status=5)
+        complete_upload(task_id)
+    except FileNotFoundError as f:
+        logging.error(f)
+        logging.warning("PASS PASS PASS")
 
-            if os.path.exists(local_source_dir):
-                shutil.rmtree(local_source_dir)
+        update_recording_tasks(Q(task_id=task_id), status=6)
+        complete_upload(task_id)
+    except UPLOAD_ERRORS as e:
+        logging.error(f"Upload {task_id} is failed: {e}")
+        record_upload_error(e)
+        defer_upload(task_id, local_source_file, failed=True)
 
-            update_recording_tasks(Q(task_id=task_id), status=6)
+
+@app.task
+def drain_pending_uploads_periodic_task():
+    """
+    Переодическая задача отправки отложенных загрузок. Пока NextCloud недоступен, загрузки
+    остаются в очереди, после восстановления отправляются пакетами PENDING_UPLOADS_BATCH_SIZE.
+    Пробную загрузку не занимает: очередь отправляется после закрытия предохранителя
+    :return:
+    """
+
+    if not is_available(trial=False):
+        return
+
+    pending_uploads = take_pending_uploads(settings.PENDING_UPLOADS_BATCH_SIZE)
+    for item in pending_uploads:
+        upload_processed_records.delay(item.recording_task_id,
+                                       item.recording_task.order.user_id,
+                                       item.recording_task.recording.type_recording.name,
+                                       item.file)
+
+    if pending_uploads:
+        logging.info(f"Dispatch {len(pending_uploads)} pending uploads")
+
+
+@app.task
+def check_nextcloud_health_periodic_task():
+    """
+    Периодическая проверка доступности NextCloud, результат сохраняется в предохранителе,
+    который задачи загрузки читают вместо собственной проверки
+    :return:
+    """
+
+    if not check_health():
+        logging.error(f"The \"{dynamic_settings.NEXTCLOUD_RESOURCE}\" resource is not unavailable!")
 
 
 @app.task
@@ -287,7 +832,7 @@ def upload_recordings_periodic_task():
     """
 
     logging.info("Start uploading recordings periodic task")
-    upload_recordings_from_source_without_duplicate(dynamic_settings.BBB_RESOURCE)
+    sync_recordings(dynamic_settings.get_bbb_servers())
     logging.info("Stop uploading recordings periodic task")
 
 
@@ -313,9 +858,13 @@ def remove_expired_files_periodic_task():
     try:
         logging.info("Start remove files from storage")
         for item in recording_files:
+            # Архив может быть связан с более поздними задачами других заказов
+            if get_recording_files(Q(file=item.file) & ~query_filter).exists():
+                logging.info(f"Keep {item.file}, it is used by other recording tasks")
+                continue
+
             logging.info(f"Remove {item.file}")
-            if os.path.exists(item.file):
-                os.remove(item.file)
+            remove_recording_file(item.file)
 
         logging.info("Start remove files from db")
         delete_recording_files(query_filter)
@@ -325,6 +874,37 @@ def remove_expired_files_periodic_task():
     logging.info("Stop remove recordings files periodic task")
 
 
+def queue_download_archive(path) -> None:
+    """
+    Постановка сборки архива директории файлов записи, одна задача на директорию
+    :param path:
+    :return:
+    """
+
+    r = get_redis_connection()
+    if r.set(settings.REDIS_KEY_DOWNLOAD_ARCHIVE.format(path), 1, nx=True, ex=settings.DOWNLOAD_ARCHIVE_BUILD_TIMEOUT):
+        build_download_archive_task.delay(path)
+
+
+@app.task
+def build_download_archive_task(path):
+    """
+    Сборка архива директории файлов записи для передачи через nginx
+    :param path:
+    :return:
+    """
+
+    logging.info(f"Start build download archive {path}")
+
+    try:
+        build_download_archive(path)
+        logging.info(f"Stop build download archive {path}")
+    except OSError as e:
+        logging.error(f"Build download archive {path} is failed: {e}")
+    finally:
+        get_redis_connection().delete(settings.REDIS_KEY_DOWNLOAD_ARCHIVE.format(path))
+
+
 @app.task
 def remove_dirs_task(dirnames):
     """
@@ -1,9 +1,8 @@
-import os
-
 from django.contrib import admin
 
 from RepackingApp.models import TypeRecordingModel, RecordingModel, RecordingTaskIdModel, RecodingFileUserModel, \
-    OrderRecordingModel
+    OrderRecordingModel, PendingUploadModel
+from RepackingApp.services.downloads import remove_recording_file
 
 
 @admin.action(description="Перевести в статус 'Не обработана'")
@@ -44,8 +43,7 @@ class RecodingFileUserModelAdmin(admin.ModelAdmin):
 
     def delete_queryset(self, request, queryset):
         for obj in queryset:
-            if os.path.exists(obj.file):
-                os.remove(obj.file)
+            remove_recording_file(obj.file)
             obj.delete()
 
 
@@ -56,3 +54,9 @@ class OrderRecordingModelAdmin(admin.ModelAdmin):
 
     def has_change_permission(self, request, obj=None):
         return False
+
+
+@admin.register(PendingUploadModel)
+class PendingUploadModelAdmin(admin.ModelAdmin):
+    list_display = ("recording_task", "file", "attempts", "failed", "datetime_created", "datetime_dispatched")
+    list_filter = ("failed",)
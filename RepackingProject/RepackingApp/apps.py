@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class RepackingAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'RepackingApp'
+
+    def ready(self):
+        from common import http_client
+
+        http_client.configure(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT, settings.HTTP_POOL_MAXSIZE)
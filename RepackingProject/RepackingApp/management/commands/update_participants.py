@@ -2,38 +2,31 @@ from django.conf import settings
 from core import dynamic_settings
 from django.core.management import BaseCommand
 
-from RepackingApp.services.records import (add_checksum_to_url,
-                                           request_recordings,
-                                           parse_xml_only_recordings_dict, update_recording_by_record_id)
+from RepackingApp.services.records import request_recordings_pages, bulk_update_recordings
 
 
 class Command(BaseCommand):
-    help = 'This command update participants from BBB resource'
+    help = 'This command update participants from BBB resources'
 
     def handle(self, *args, **options):
         # upload_from_source("vcs-6.ict.nsc.ru")
 
-        url = dynamic_settings.BBB_URL.format(dynamic_settings.BBB_RESOURCE)
-        url = add_checksum_to_url(url, dynamic_settings.BBB_SHARED_SECRET)
-
-        response = request_recordings(url)
-        if not response:
-            self.stdout.write(self.style.ERROR('Request is not perform.'))
-            return
-
-        data = parse_xml_only_recordings_dict(response)
-        if not data:
-            self.stdout.write(self.style.ERROR('Data is None.'))
+        recordings = (
+            item["recording"]
+            for server in dynamic_settings.get_bbb_servers()
+            for page in request_recordings_pages(server["resource"], settings.BBB_RECORDINGS_PAGE_SIZE,
+                                                 server["shared_secret"])
+            for item in page.values()
+        )
+
+        try:
+            count = bulk_update_recordings(recordings, ["participants"])
+        except ConnectionError as e:
+            self.stdout.write(self.style.ERROR(f'Request is not perform. {e}'))
             return
 
-        recordings = data.get("recordings")
-        if not recordings:
+        if not count:
             self.stdout.write(self.style.ERROR('Recordings are not updated. Recordings is None.'))
             return
 
-        for key, value in recordings.items():
-            update_recording_by_record_id(
-                recording_id=value["recording"].record_id,
-                participants=value["recording"].participants
-            )
-        self.stdout.write(self.style.SUCCESS('Recordings are updated. OK.'))
+        self.stdout.write(self.style.SUCCESS(f'Recordings are updated ({count}). OK.'))
@@ -1,12 +1,19 @@
 from django.core.management import BaseCommand
 from core import dynamic_settings
 
-from RepackingApp.services.records import upload_recordings_from_source_without_duplicate
+from RepackingApp.services.records import sync_recordings
 
 
 class Command(BaseCommand):
-    help = 'This command upload recordings from BBB resource'
+    help = 'This command upload recordings from BBB resources'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true",
+                            help="Sync all recordings ignoring the last synchronization time")
 
     def handle(self, *args, **options):
-        upload_recordings_from_source_without_duplicate(dynamic_settings.BBB_RESOURCE)
+        if sync_recordings(dynamic_settings.get_bbb_servers(), full=options["full"]) is None:
+            self.stdout.write(self.style.ERROR('BBB servers are not available.'))
+            return
+
         self.stdout.write(self.style.SUCCESS('Recordings are uploaded. OK.'))
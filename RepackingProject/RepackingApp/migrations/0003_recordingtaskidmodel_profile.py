@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('RepackingApp', '0002_recordingmodel_analytic_file_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordingtaskidmodel',
+            name='profile',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='recordingtaskidmodel',
+            index=models.Index(fields=['recording', 'profile', 'status'], name='RepackingAp_recordi_7b7c85_idx'),
+        ),
+    ]
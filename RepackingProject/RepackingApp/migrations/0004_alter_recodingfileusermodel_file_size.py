@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('RepackingApp', '0003_recordingtaskidmodel_profile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recodingfileusermodel',
+            name='file_size',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
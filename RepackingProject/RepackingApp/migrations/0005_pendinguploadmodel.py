@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import pathlib
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('RepackingApp', '0004_alter_recodingfileusermodel_file_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingUploadModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FilePathField(path=pathlib.PurePosixPath('/home/grigoriy/PycharmProjects/RepackingPerfomanceVideos/RepackingProject'))),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('datetime_created', models.DateTimeField(auto_now_add=True)),
+                ('datetime_dispatched', models.DateTimeField(blank=True, null=True)),
+                ('recording_task', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='RepackingApp.recordingtaskidmodel', to_field='task_id')),
+            ],
+            options={
+                'verbose_name': 'Отложенная загрузка',
+                'verbose_name_plural': 'Отложенные загрузки',
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('RepackingApp', '0005_pendinguploadmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendinguploadmodel',
+            name='failed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
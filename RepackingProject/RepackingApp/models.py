@@ -68,10 +68,14 @@ class RecordingTaskIdModel(models.Model):
                                ], unique=True)
     order = models.ForeignKey(OrderRecordingModel, on_delete=models.CASCADE)
     status = models.PositiveSmallIntegerField(default=1, choices=STATUS_CHOICES)
+    profile = models.CharField(max_length=50, default="", blank=True)
     datetime_created = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = (("recording", "task_id"), )
+        indexes = [
+            models.Index(fields=["recording", "profile", "status"]),
+        ]
 
         verbose_name = "Запись обработки"
         verbose_name_plural = "Записи обработки"
@@ -81,8 +85,21 @@ class RecodingFileUserModel(models.Model):
     recording_task = models.ForeignKey(RecordingTaskIdModel, to_field="task_id", on_delete=models.CASCADE)
     file = models.FilePathField(path=settings.BASE_DIR)
     datetime_created = models.DateTimeField(auto_now=True)
-    file_size = models.PositiveIntegerField(default=0)
+    file_size = models.PositiveBigIntegerField(default=0)
 
     class Meta:
         verbose_name = "Файл конферении"
-        verbose_name_plural = "Файлы конферений"
\ No newline at end of file
+        verbose_name_plural = "Файлы конферений"
+
+
+class PendingUploadModel(models.Model):
+    recording_task = models.OneToOneField(RecordingTaskIdModel, to_field="task_id", on_delete=models.CASCADE)
+    file = models.FilePathField(path=settings.BASE_DIR)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    failed = models.BooleanField(default=False)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+    datetime_dispatched = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Отложенная загрузка"
+        verbose_name_plural = "Отложенные загрузки"
@@ -1,8 +1,13 @@
+from __future__ import annotations
+
+import os
+import shutil
 from typing import List, Dict
 
 from django.db.models import Q
 
 from RepackingApp.models import RecodingFileUserModel
+from common.archive import ZipStream
 
 
 def get_recording_files(filter_query: Q) -> List[RecodingFileUserModel]:
@@ -70,6 +75,30 @@ def get_download_recording_files(filter_query: Q) -> List[RecodingFileUserModel]
         .order_by("recording_task__recording__type_recording__name")
 
 
+def get_processed_recording_file(record_id: str, profile: str) -> RecodingFileUserModel | None:
+    """
+    Последний архив записи, обработанной с профилем кодирования profile
+    :param record_id:
+    :param profile:
+    :return:
+    """
+
+    recording_files = RecodingFileUserModel \
+        .objects \
+        .select_related("recording_task") \
+        .filter(
+            Q(recording_task__recording_id=record_id)
+            & Q(recording_task__profile=profile)
+            & Q(recording_task__status__in=[4, 5])
+        ) \
+        .order_by("-datetime_created")
+
+    for recording_file in recording_files:
+        if os.path.exists(recording_file.file):
+            return recording_file
+    return None
+
+
 def create_recording_file(**data) -> RecodingFileUserModel:
     """
     Загрука файла конференции
@@ -88,3 +117,51 @@ def delete_recording_files(filter_query: Q) -> None:
     """
 
     RecodingFileUserModel.objects.filter(filter_query).delete()
+
+
+def get_download_archive(path: str) -> str | None:
+    """
+    Zip архив файла записи для передачи через nginx
+    :param path: архив или директория файлов записи
+    :return: для директории (ARCHIVE_ON_THE_FLY) - <директория>.zip, None если архив еще не собран
+    """
+
+    if not os.path.isdir(path):
+        return path
+
+    archive_path = f"{path}.zip"
+    return archive_path if os.path.exists(archive_path) else None
+
+
+def build_download_archive(path: str) -> None:
+    """
+    Архивирование директории файлов записи без сжатия в <директория>.zip.
+    Архив записывается во временный файл и появляется под своим именем только целиком
+    :param path: директория файлов записи
+    :return:
+    """
+
+    if get_download_archive(path) is not None:
+        return
+
+    archive_path = f"{path}.zip"
+    ZipStream.from_dir(path).save(archive_path)
+
+    # Директория удалена по истечении срока хранения во время сборки
+    if not os.path.isdir(path):
+        os.remove(archive_path)
+
+
+def remove_recording_file(path: str) -> None:
+    """
+    Удаление файла записи с диска: архива или директории вместе с собранным для скачивания архивом
+    :param path:
+    :return:
+    """
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+        path = f"{path}.zip"
+
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import logging
+import datetime
+from typing import List
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+
+from RepackingApp.models import PendingUploadModel
+
+
+def defer_upload(task_id: str, file: str, failed: bool = False) -> None:
+    """
+    Постановка загрузки обработанной записи в очередь до восстановления NextCloud.
+    Повторная постановка той же задачи обновляет файл и возвращает загрузку в очередь
+    :param task_id:
+    :param file: директория или архив записи
+    :param failed: загрузка была выполнена с ошибкой, увеличивает счетчик попыток
+    :return:
+    """
+
+    with transaction.atomic():
+        pending, _ = PendingUploadModel.objects.get_or_create(recording_task_id=task_id, defaults={"file": file})
+        PendingUploadModel.objects.filter(pk=pending.pk).update(file=file, datetime_dispatched=None,
+                                                                attempts=F("attempts") + int(failed))
+
+
+def complete_upload(task_id: str) -> None:
+    """
+    Удаление загрузки из очереди после успешной загрузки или отказа от нее
+    :param task_id:
+    :return:
+    """
+
+    PendingUploadModel.objects.filter(recording_task_id=task_id).delete()
+
+
+def take_pending_uploads(limit: int) -> List[PendingUploadModel]:
+    """
+    Пакет загрузок для отправки воркерам, старые загрузки первыми. Отправленная загрузка
+    не выбирается повторно PENDING_UPLOADS_DISPATCH_TIMEOUT секунд, чтобы не запускать ее дважды.
+    Загрузки записей, которые больше не доступны для загрузки (статус не 4), удаляются.
+    Загрузки, исчерпавшие PENDING_UPLOADS_MAX_ATTEMPTS попыток, помечаются неудачными и больше
+    не отправляются: запись остается доступной для скачивания, а строка удаляется вместе
+    с истечением срока хранения файла записи
+    :param limit:
+    :return:
+    """
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    dispatched_before = now - datetime.timedelta(seconds=settings.PENDING_UPLOADS_DISPATCH_TIMEOUT)
+
+    PendingUploadModel.objects.filter(~Q(recording_task__status=4)).delete()
+    fail_pending_uploads()
+
+    pending_uploads = list(
+        PendingUploadModel
+        .objects
+        .select_related("recording_task",
+                        "recording_task__order",
+                        "recording_task__recording__type_recording")
+        .filter(Q(failed=False)
+                & (Q(datetime_dispatched__isnull=True) | Q(datetime_dispatched__lte=dispatched_before)))
+        .order_by("datetime_created")[:limit]
+    )
+
+    PendingUploadModel.objects.filter(pk__in=[item.pk for item in pending_uploads]).update(datetime_dispatched=now)
+    return pending_uploads
+
+
+def fail_pending_uploads() -> None:
+    """
+    Загрузки, исчерпавшие PENDING_UPLOADS_MAX_ATTEMPTS попыток, помечаются неудачными
+    :return:
+    """
+
+    with transaction.atomic():
+        failed_uploads = list(
+            PendingUploadModel
+            .objects
+            .select_for_update()
+            .filter(Q(failed=False) & Q(attempts__gte=settings.PENDING_UPLOADS_MAX_ATTEMPTS))
+        )
+        PendingUploadModel.objects.filter(pk__in=[item.pk for item in failed_uploads]).update(failed=True)
+
+    for item in failed_uploads:
+        logging.error(f"Upload {item.recording_task_id} is failed after {item.attempts} attempts, "
+                      f"the recording is kept only in {item.file}")
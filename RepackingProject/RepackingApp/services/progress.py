@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import time
+from typing import List, Dict
+
+from django.conf import settings
+
+from common.redis_conn import get_redis_connection
+
+
+def get_progress_key(task_id) -> str:
+    return settings.REDIS_KEY_TASK_PROGRESS.format(task_id)
+
+
+def get_room_progress_key(user_id, type_recording_id) -> str:
+    return settings.REDIS_KEY_ROOM_PROGRESS.format(user_id, type_recording_id)
+
+
+def track_task_progress(user_id, type_recording_id, task_id, record_id, status, stage) -> None:
+    """
+    Добавляет задачу в прогресс комнаты пользователя. Задачи комнаты хранятся в sorted set
+    со временем истечения прогресса задачи, истекшие задачи удаляются при каждом обращении
+    :param user_id:
+    :param type_recording_id:
+    :param task_id:
+    :param record_id:
+    :param status:
+    :param stage:
+    :return:
+    """
+
+    r = get_redis_connection()
+    room_key = get_room_progress_key(user_id, type_recording_id)
+    now = int(time.time())
+
+    with r.pipeline() as pipe:
+        pipe.hset(get_progress_key(task_id), mapping={
+            "record_id": record_id,
+            "room": room_key,
+            "status": status,
+            "stage": stage,
+            "percent": 0,
+            "eta": "",
+            "datetime_updated": now,
+        })
+        pipe.expire(get_progress_key(task_id), settings.PROGRESS_EXPIRATION)
+        pipe.zremrangebyscore(room_key, "-inf", now)
+        pipe.zadd(room_key, {task_id: now + settings.PROGRESS_EXPIRATION})
+        pipe.expire(room_key, settings.PROGRESS_EXPIRATION)
+        pipe.execute()
+
+
+def update_task_progress(task_id, **data) -> None:
+    """
+    Обновление прогресса задачи: status, stage, percent, eta.
+    Для незарегистрированной задачи прогресс не создается.
+    Завершенная задача остается в прогрессе комнаты PROGRESS_FINISHED_EXPIRATION секунд,
+    чтобы страница успела получить итоговый статус
+    :param task_id:
+    :param data:
+    :return:
+    """
+
+    r = get_redis_connection()
+    key = get_progress_key(task_id)
+
+    with r.pipeline() as pipe:
+        exists, room_key = pipe.exists(key).hget(key, "room").execute()
+    if not exists:
+        return
+
+    data = {name: "" if value is None else value for name, value in data.items()}
+    data["datetime_updated"] = int(time.time())
+
+    with r.pipeline() as pipe:
+        pipe.hset(key, mapping=data)
+        if data.get("status") in (4, 5, 6):
+            pipe.expire(key, settings.PROGRESS_FINISHED_EXPIRATION)
+            if room_key:
+                pipe.zadd(room_key.decode("utf-8"),
+                          {task_id: data["datetime_updated"] + settings.PROGRESS_FINISHED_EXPIRATION})
+        pipe.execute()
+
+
+def increment_segments_progress(task_id) -> None:
+    """
+    Учет закодированного отрезка записи в режиме split_mode
+    :param task_id:
+    :return:
+    """
+
+    r = get_redis_connection()
+    key = get_progress_key(task_id)
+    if not r.exists(key):
+        return
+
+    with r.pipeline() as pipe:
+        done, total = pipe.hincrby(key, "segments_done").hget(key, "segments_total").execute()
+
+    if total:
+        update_task_progress(task_id, percent=round(min(done / int(total), 1) * 100, 1))
+
+
+def delete_task_progress(task_ids: List[str]) -> None:
+    """
+    Удаление прогресса отмененных задач вместе с задачами в прогрессе комнат
+    :param task_ids:
+    :return:
+    """
+
+    if not task_ids:
+        return
+
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        for task_id in task_ids:
+            pipe.hget(get_progress_key(task_id), "room")
+        room_keys = pipe.execute()
+
+    with r.pipeline() as pipe:
+        for task_id, room_key in zip(task_ids, room_keys):
+            if room_key:
+                pipe.zrem(room_key.decode("utf-8"), task_id)
+        pipe.delete(*[get_progress_key(task_id) for task_id in task_ids])
+        pipe.execute()
+
+
+def get_room_progress(user_id, type_recording_id) -> List[Dict]:
+    """
+    Прогресс всех задач комнаты пользователя за два запроса к Redis
+    :param user_id:
+    :param type_recording_id:
+    :return: [{"record_id", "status", "stage", "percent", "eta", "datetime_updated"}]
+    """
+
+    r = get_redis_connection()
+    room_key = get_room_progress_key(user_id, type_recording_id)
+
+    with r.pipeline() as pipe:
+        _, task_ids = pipe.zremrangebyscore(room_key, "-inf", int(time.time())) \
+            .zrange(room_key, 0, -1) \
+            .execute()
+    if not task_ids:
+        return []
+
+    with r.pipeline() as pipe:
+        for task_id in task_ids:
+            pipe.hgetall(get_progress_key(task_id.decode("utf-8")))
+        items = pipe.execute()
+
+    result, expired = {}, []
+    for task_id, item in zip(task_ids, items):
+        if not item:
+            expired.append(task_id)
+            continue
+
+        item = {key.decode("utf-8"): value.decode("utf-8") for key, value in item.items()}
+
+        # У записи может быть несколько задач, например, повторная обработка после завершенной
+        previous = result.get(item["record_id"])
+        if previous and previous["datetime_updated"] > int(item["datetime_updated"]):
+            continue
+
+        result[item["record_id"]] = {
+            "record_id": item["record_id"],
+            "status": int(item["status"]),
+            "stage": item["stage"],
+            "percent": float(item["percent"] or 0),
+            "eta": int(item["eta"]) if item["eta"] else None,
+            "datetime_updated": int(item["datetime_updated"]),
+        }
+
+    if expired:
+        r.zrem(room_key, *expired)
+
+    return list(result.values())
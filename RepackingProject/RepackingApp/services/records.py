@@ -1,15 +1,19 @@
 from __future__ import annotations
 
+import json
+import hashlib
 import logging
 import os.path
 import pprint
-from typing import List, Tuple, Dict
+import tempfile
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Iterator, Iterable
 
-import httplib2
+import requests
 from lxml import etree
 from http import HTTPStatus
 from urllib.parse import urlsplit, parse_qs, urlencode
-from httplib2.error import ServerNotFoundError
 
 from django.conf import settings
 from django.db.models import Q
@@ -20,6 +24,8 @@ from django.core.validators import URLValidator
 
 from core import dynamic_settings
 from common.manage_datetime import from_timestamp
+from common.http_client import get_session
+from common.redis_conn import get_redis_connection
 from common.checksum import calculate_checksum, add_checksum_to_url
 from common.html_encoding_correcting import correct_symbol_html_encoding
 from RepackingApp.models import TypeRecordingModel, RecordingModel, RecordingTaskIdModel
@@ -185,22 +191,109 @@ def request_recordings(url: str) -> str | None:
     except ValidationError:
         return None
 
-    http = httplib2.Http()
     headers = {'content-type': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'}
 
     try:
-        resp, content = http.request(url, "GET", headers=headers)
-    except ServerNotFoundError:
+        resp = get_session().get(url, headers=headers)
+    except requests.RequestException:
         return None
 
     expected_content_type = "text/xml"
-    if expected_content_type not in resp["content-type"]:
+    if expected_content_type not in resp.headers.get("content-type", ""):
         return None
 
-    if resp.status != HTTPStatus.OK:
+    if resp.status_code != HTTPStatus.OK:
         return None
 
-    return content
+    return resp.content
+
+
+def iter_xml_recordings(source) -> Iterator[Tuple[TypeRecordingModel, RecordingModel]]:
+    """
+    Потоковый парсинг конференций: элементы <recording> разбираются по мере чтения
+    и удаляются из дерева, память не зависит от количества конференций
+    :param source: файлоподобный объект с xml ответом getRecordings
+    :return: (TypeRecordingModel, RecordingModel) для каждой конференции
+    """
+
+    for _, xml_recording in etree.iterparse(source, events=("end",), tag="recording"):
+        type_recording = parse_xml_type_recording(xml_recording)
+        recording = parse_xml_recording(xml_recording)
+
+        xml_recording.clear()
+        while xml_recording.getprevious() is not None:
+            del xml_recording.getparent()[0]
+
+        if type_recording and recording:
+            yield type_recording, recording
+
+
+def stream_recordings(url: str) -> Iterator[Tuple[TypeRecordingModel, RecordingModel]]:
+    """
+    Запрос конференций с потоковым парсингом ответа, разбор идет одновременно с загрузкой
+    :param url:
+    :return: (TypeRecordingModel, RecordingModel) для каждой конференции
+    """
+
+    try:
+        with get_session().get(url, stream=True) as response:
+            if response.status_code != HTTPStatus.OK or "text/xml" not in response.headers.get("content-type", ""):
+                raise ConnectionError(f"Recordings are not received from {urlsplit(url).netloc}: "
+                                      f"{response.status_code}")
+
+            response.raw.decode_content = True
+            yield from iter_xml_recordings(response.raw)
+    except (requests.RequestException, etree.XMLSyntaxError) as e:
+        raise ConnectionError(f"Recordings are not received from {urlsplit(url).netloc}: {e}") from e
+
+
+def request_recordings_page(url: str, state: dict | None) -> Tuple[dict, List | None]:
+    """
+    Условный запрос страницы getRecordings. Серверу передаются ETag и Last-Modified прошлого ответа,
+    ответ 304 или ответ с прежним хешем содержимого не разбирается. Ответ сохраняется
+    во временный файл, чтобы хеш был известен до разбора
+    :param url:
+    :param state: состояние прошлого ответа {"etag", "last_modified", "hash", "count"}, None - разобрать ответ
+    :return: новое состояние и конференции, None вместо конференций - страница не изменилась
+    """
+
+    headers = {}
+    if state and state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state and state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    try:
+        with get_session().get(url, stream=True, headers=headers) as response:
+            if state and response.status_code == HTTPStatus.NOT_MODIFIED:
+                return state, None
+
+            if response.status_code != HTTPStatus.OK or "text/xml" not in response.headers.get("content-type", ""):
+                raise ConnectionError(f"Recordings are not received from {urlsplit(url).netloc}: "
+                                      f"{response.status_code}")
+
+            digest = hashlib.sha256()
+            with tempfile.SpooledTemporaryFile(max_size=settings.BBB_RESPONSE_SPOOL_SIZE) as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    digest.update(chunk)
+                    f.write(chunk)
+
+                new_state = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "hash": digest.hexdigest(),
+                    "count": state["count"] if state else 0,
+                }
+                if state and new_state["hash"] == state["hash"]:
+                    return new_state, None
+
+                f.seek(0)
+                recordings = list(iter_xml_recordings(f))
+    except (requests.RequestException, etree.XMLSyntaxError) as e:
+        raise ConnectionError(f"Recordings are not received from {urlsplit(url).netloc}: {e}") from e
+
+    new_state["count"] = len(recordings)
+    return new_state, recordings
 
 
 def get_recording(recording_id: str) -> RecordingModel | None:
@@ -340,16 +433,54 @@ def update_recordings(filter_query: Q, **data) -> None:
         RecordingModel.objects.filter(filter_query).update(**data)
 
 
-def update_recordings_fields(new_recordings, fields_update: list):
+def iter_batches(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def bulk_update_recordings(recordings: Iterable[RecordingModel], fields: List[str], batch_size: int = None) -> int:
+    """
+    Массовое обновление полей конференций по record_id. На каждый пакет выполняется
+    запрос идентификаторов и один UPDATE, конференции, которых нет в базе данных, пропускаются
+    :param recordings: RecordingModel с данными от BBB, в том числе генератор
+    :param fields: обновляемые поля
+    :param batch_size: по умолчанию RECORDINGS_BULK_BATCH_SIZE
+    :return: количество обновленных конференций
     """
 
+    updated = 0
+    for batch in iter_batches(recordings, batch_size or settings.RECORDINGS_BULK_BATCH_SIZE):
+        ids = dict(
+            RecordingModel.objects
+            .filter(record_id__in=[recording.record_id for recording in batch])
+            .values_list("record_id", "id")
+        )
+
+        existing = []
+        for recording in batch:
+            if recording.record_id in ids:
+                recording.id = ids[recording.record_id]
+                existing.append(recording)
+
+        RecordingModel.objects.bulk_update(existing, fields)
+        updated += len(existing)
+
+    return updated
+
+
+def update_recordings_fields(new_recordings, fields_update: list):
+    """
+    Обновление полей конференций по record_id
     :param new_recordings:
     :param fields_update:
     :return:
     """
-    for recording in new_recordings:
-        data = {field: getattr(recording, field) for field in fields_update}
-        RecordingModel.objects.filter(record_id=recording.record_id).update(**data)
+
+    return bulk_update_recordings(new_recordings, fields_update)
 
 
 def upload_recordings_to_db(data: dict) -> Dict | None:
@@ -372,14 +503,14 @@ def upload_recordings_to_db(data: dict) -> Dict | None:
         unique_fields=["name"], update_fields=["name"]
     )
 
-    type_recording_ids = []
+    # Типы конференций извлекаются одним запросом, кэш каждой комнаты очищается один раз
+    names = set(key for key, _ in data["recordings"])
+    type_recordings = {item.name: item for item in TypeRecordingModel.objects.filter(name__in=names)}
+
     for key, recording in data["recordings"]:
-        type_recording = TypeRecordingModel.objects.get(name=key)
-        type_recording_ids.append(type_recording.id)
-        recording.type_recording = type_recording
+        recording.type_recording = type_recordings[key]
 
-    for i in type_recording_ids:
-        cache.delete(settings.CACHE_PK_RECORDINGS.format(i))
+    cache.delete_many([settings.CACHE_PK_RECORDINGS.format(item.id) for item in type_recordings.values()])
 
     RecordingModel.objects.bulk_create(
         list(map(lambda x: x[1], data["recordings"])),
@@ -425,32 +556,195 @@ def upload_recordings_and_update_fields() -> None:
     update_recordings_fields(recordings, ["url"])
 
 
-def upload_recordings_from_source_without_duplicate(resource):
-    url = dynamic_settings.BBB_URL.format(resource)
-    url = add_checksum_to_url(url, dynamic_settings.BBB_SHARED_SECRET)
+def get_recordings_page_url(resource: str, offset: int, limit: int, shared_secret: str = None) -> str:
+    """
+    Адрес страницы getRecordings с подписью checksum
+    :param resource:
+    :param offset:
+    :param limit:
+    :param shared_secret: секрет сервера resource, по умолчанию BBB_SHARED_SECRET
+    :return:
+    """
 
-    response = request_recordings(url)
-    if not response:
-        return None
+    split_url = urlsplit(dynamic_settings.BBB_URL.format(resource))
+    query = parse_qs(split_url.query)
+    query.update({"offset": [offset], "limit": [limit]})
 
-    data = parse_xml_only_recordings_dict(response)
-    if not data:
-        return None
+    url = f"{split_url.scheme}://{split_url.netloc}{split_url.path}?{urlencode(query, doseq=True)}"
+    return add_checksum_to_url(url, shared_secret or dynamic_settings.BBB_SHARED_SECRET)
 
-    recordings = data.get("recordings")
-    if not recordings:
-        return None
 
-    recordings_db = RecordingModel.objects.all().values("record_id")
-    recordings_ids_db = set(map(lambda x: x["record_id"], recordings_db))
-    recordings_ids = set(recordings.keys())
-    empty_recordings = recordings_ids.difference(recordings_ids_db)
+def request_recordings_pages(resource: str, page_size: int, shared_secret: str = None,
+                             pages: dict = None, force: bool = False) -> Iterator[Dict]:
+    """
+    Постраничный запрос конференций. Если сервер BBB не поддерживает offset и limit,
+    первая страница содержит все конференции и запросы прекращаются
+    :param resource:
+    :param page_size:
+    :param shared_secret:
+    :param pages: словарь для новых состояний страниц {ключ Redis: состояние}. Если передан,
+    страницы запрашиваются условно и неизмененные с прошлого сохранения страницы пропускаются
+    :param force: разобрать все страницы без учета сохраненных состояний
+    :return: {record_id: {"recording", "type_recording"}} для каждой страницы
+    """
+
+    r = get_redis_connection() if pages is not None else None
+    seen = set()
+    offset = 0
+
+    while True:
+        url = get_recordings_page_url(resource, offset, page_size, shared_secret)
+        if pages is None:
+            items = list(stream_recordings(url))
+            count = len(items)
+        else:
+            key = get_page_key(url)
+            state = None if force else r.get(key)
+            pages[key], items = request_recordings_page(url, json.loads(state) if state else None)
+            count = pages[key]["count"]
+
+        if items is not None:
+            recordings = {
+                recording.record_id: {"recording": recording, "type_recording": type_recording}
+                for type_recording, recording in items
+            }
+
+            new_ids = set(recordings.keys()).difference(seen)
+            if not new_ids:
+                return
+
+            seen.update(new_ids)
+            yield {record_id: recordings[record_id] for record_id in new_ids}
+
+        if count != page_size:
+            return
+        offset += page_size
+
+
+def get_page_key(url: str) -> str:
+    return settings.REDIS_KEY_RECORDINGS_PAGE.format(hashlib.sha1(url.encode()).hexdigest())
+
+
+# Поля конференции, которые BBB может изменить после публикации
+RECORDING_MUTABLE_FIELDS = ["url", "participants", "datetime_stopped"]
+
+
+def get_sync_key(resource: str) -> str:
+    return settings.REDIS_KEY_RECORDINGS_SYNC.format(resource)
+
+
+def fetch_recordings(server: dict, since: float | None) -> Tuple[Dict, float, Dict]:
+    """
+    Запрос конференций одного сервера BBB, начатых не раньше since. Выполняется
+    в потоке пула, поэтому не обращается к базе данных. Страницы, не изменившиеся
+    с прошлой синхронизации, не разбираются
+    :param server: {"resource", "shared_secret"}
+    :param since: время начала, None - все конференции и все страницы
+    :return: конференции, время начала самой поздней из них и новые состояния страниц
+    """
+
+    recordings = {}
+    latest = 0
+    pages = {}
+    for page in request_recordings_pages(server["resource"], settings.BBB_RECORDINGS_PAGE_SIZE,
+                                         server["shared_secret"], pages=pages, force=since is None):
+        for record_id, item in page.items():
+            started = item["recording"].datetime_created.timestamp()
+            latest = max(latest, started)
+            if since is None or started >= since:
+                recordings[record_id] = item
+
+    logging.info(f"Sync recordings from {server['resource']}: {len(recordings)} recordings since {since}")
+    return recordings, latest, pages
+
 
-    if not empty_recordings:
+def sync_recordings(servers: List[dict], full: bool = False) -> Dict | None:
+    """
+    Инкрементальная синхронизация конференций с серверами BBB. Серверы опрашиваются
+    параллельно, их конференции объединяются и проверяются по базе данных одним пакетом.
+    Для каждого сервера в Redis хранится время начала самой поздней полученной конференции,
+    разбираются только конференции, начатые позже него (с перекрытием BBB_RECORDINGS_SYNC_OVERLAP).
+    Страницы с прежним содержимым не разбираются и не проверяются по базе данных
+    :param servers: [{"resource", "shared_secret"}]
+    :param full: синхронизация всех конференций без учета последней синхронизации и состояний страниц
+    :return: None, если ни один сервер не ответил
+    """
+
+    r = get_redis_connection()
+    marks = r.mget([get_sync_key(server["resource"]) for server in servers])
+
+    recordings = {}
+    latest = {}
+    pages = {}
+    with ThreadPoolExecutor(max_workers=min(len(servers), settings.BBB_SYNC_WORKERS) or 1) as executor:
+        futures = []
+        for server, mark in zip(servers, marks):
+            since = None if full or mark is None else float(mark) - settings.BBB_RECORDINGS_SYNC_OVERLAP
+            futures.append((server, mark, executor.submit(fetch_recordings, server, since)))
+
+        for server, mark, future in futures:
+            try:
+                server_recordings, server_latest, server_pages = future.result()
+            except ConnectionError as e:
+                # Недоступный сервер не мешает синхронизации остальных, его отметка не меняется
+                logging.error(f"{server['resource']}: {e}")
+                continue
+
+            recordings.update(server_recordings)
+            pages.update(server_pages)
+            latest[server["resource"]] = max(float(mark) if mark is not None else 0, server_latest)
+
+    if not latest:
         return None
 
-    type_recordings_db = set(map(lambda x: x.name, TypeRecordingModel.objects.all()))
-    type_recordings_names = set(map(lambda x: x.name, parse_xml_recordings(response)["type_recordings"]))
+    recordings_ids_db = set(
+        RecordingModel.objects.filter(record_id__in=list(recordings.keys())).values_list("record_id", flat=True)
+    )
+    empty_recordings = set(recordings.keys()).difference(recordings_ids_db)
+
+    if empty_recordings:
+        upload_new_recordings(recordings, empty_recordings)
+
+    # Участники и ссылки известных конференций могут измениться после публикации
+    bulk_update_recordings([recordings[record_id]["recording"] for record_id in recordings_ids_db],
+                           RECORDING_MUTABLE_FIELDS)
+
+    # Состояния страниц сохраняются только после записи их конференций в базу данных
+    pipeline = r.pipeline()
+    for key, state in pages.items():
+        pipeline.set(key, json.dumps(state), ex=settings.RECORDINGS_PAGE_EXPIRATION)
+    pipeline.execute()
+
+    for resource, value in latest.items():
+        r.set(get_sync_key(resource), value)
+    return recordings
+
+
+def upload_recordings_from_source_without_duplicate(resource, full: bool = False, shared_secret: str = None):
+    """
+    Синхронизация конференций с одним сервером BBB
+    :param resource:
+    :param full: синхронизация всех конференций без учета последней синхронизации
+    :param shared_secret: секрет сервера resource, по умолчанию BBB_SHARED_SECRET
+    :return:
+    """
+
+    server = {"resource": resource, "shared_secret": shared_secret or dynamic_settings.BBB_SHARED_SECRET}
+    return sync_recordings([server], full=full)
+
+
+def upload_new_recordings(recordings: dict, empty_recordings: set) -> Dict | None:
+    """
+    Загрузка новых конференций и их типов в базу данных
+    :param recordings: {record_id: {"recording", "type_recording"}}
+    :param empty_recordings: record_id конференций, которых нет в базе данных
+    :return:
+    """
+
+    type_recordings_names = set(recordings[recording_id]["type_recording"].name for recording_id in empty_recordings)
+    type_recordings_db = set(
+        TypeRecordingModel.objects.filter(name__in=type_recordings_names).values_list("name", flat=True)
+    )
     empty_type_recordings = type_recordings_names.difference(type_recordings_db)
 
     if empty_type_recordings:
@@ -1,21 +1,29 @@
 import datetime
+import io
+import json
 import os
 import pprint
 import subprocess
 import time
 import uuid
+import zipfile
+import tempfile
 from typing import List
+from unittest import mock
 
+import requests
 from lxml import etree
 from django.db.models import Q
 from django.conf import settings
 from django.forms.models import model_to_dict
 from django.core.exceptions import ValidationError
-from django.test import TestCase, Client, RequestFactory
+from django.urls import reverse_lazy
+from django.test import TestCase, Client, RequestFactory, override_settings
 
 from AccountApp.models import UserModel
 from RepackingApp.forms import ProcessRecordingsForm
-from RepackingApp.models import RecordingModel, TypeRecordingModel, RecordingTaskIdModel, OrderRecordingModel
+from RepackingApp.models import RecordingModel, TypeRecordingModel, RecordingTaskIdModel, OrderRecordingModel, \
+    PendingUploadModel, RecodingFileUserModel
 from RepackingApp.services.order_record import create_recording_order, get_recording_orders, create_recording_orders, \
     update_recording_orders, delete_recording_orders
 from RepackingApp.services.records import request_recordings, parse_xml_recordings, \
@@ -24,11 +32,21 @@ from RepackingApp.services.records import request_recordings, parse_xml_recordin
     upload_from_source, get_recordings_foreinkey_type_recording, get_recordings_to_dict, get_type_recordings_to_dict, \
     update_recordings_fields, \
     upload_recordings_and_update_fields, get_recording, update_recording_by_record_id, update_recordings, \
-    parse_xml_only_recordings_dict, upload_recordings_from_source_without_duplicate, get_recordings_to_dict_with_status
+    parse_xml_only_recordings_dict, upload_recordings_from_source_without_duplicate, sync_recordings, get_recordings_to_dict_with_status, \
+    iter_xml_recordings, bulk_update_recordings, request_recordings_page
 from RepackingApp.services.record_task import create_recording_task, delete_recordings_tasks, get_recording_tasks, \
     update_recording_tasks, create_recording_tasks
+from RepackingApp.services.downloads import create_recording_file, get_processed_recording_file, \
+    remove_recording_file
+from RepackingApp.services.pending_upload import defer_upload, complete_upload, take_pending_uploads
+from RepackingApp.services.progress import track_task_progress, update_task_progress, delete_task_progress, \
+    get_room_progress
 from RepackingApp.validators import validate_recording_id
+from CeleryApp.tasks import reuse_processed_recording, link_waiting_tasks, release_waiting_tasks, \
+    fail_waiting_tasks, repack_threads_video_task, upload_processed_records, get_waiting_tasks_key, \
+    build_download_archive_task
 from common.nextcloud import upload_to_nextcloud
+from tests.helpers import FakeRedis
 
 
 class RepackingServiceTests(TestCase):
@@ -194,6 +212,15 @@ class RepackingServiceTests(TestCase):
         tm = RecordingModel.objects.all()
         self.assertEqual(len(tm), 7)
 
+    def test_upload_recordings_queries(self):
+        data = parse_xml_recordings(self.content)
+
+        # Типы, их извлечение и конференции - три запроса независимо от количества конференций
+        with self.assertNumQueries(3):
+            upload_recordings_to_db(data)
+
+        self.assertEqual(RecordingModel.objects.filter(type_recording__isnull=False).count(), 7)
+
     def test_get_type_recordings(self):
         data = parse_xml_recordings(self.content)
         upload_recordings_to_db(data)
@@ -238,6 +265,108 @@ class RepackingServiceTests(TestCase):
         # self.assertIsNotNone(None)
         self.assertGreaterEqual(recordings_len, 570)
 
+    def test_iter_xml_recordings(self):
+        recordings = list(iter_xml_recordings(io.BytesIO(self.content.encode())))
+        data = parse_xml_recordings(self.content)
+
+        self.assertEqual(len(recordings), 7)
+        self.assertEqual([recording.record_id for _, recording in recordings],
+                         [recording.record_id for _, recording in data["recordings"]])
+        self.assertEqual([type_recording.name for type_recording, _ in recordings],
+                         [name for name, _ in data["recordings"]])
+
+    def get_response(self, content: str = "", status_code: int = 200, headers: dict = None):
+        response = mock.MagicMock(status_code=status_code, headers={"content-type": "text/xml", **(headers or {})})
+        response.__enter__.return_value = response
+        response.iter_content.return_value = [content.encode()]
+        return response
+
+    def test_upload_recordings_incremental(self):
+        redis = mock.MagicMock()
+        redis.get.return_value = None
+        redis.mget.return_value = [None]
+
+        with mock.patch("RepackingApp.services.records.get_redis_connection", return_value=redis), \
+                mock.patch("RepackingApp.services.records.get_recordings_page_url", return_value="https://bbb/api"), \
+                mock.patch("common.http_client.HTTPClient.get",
+                           side_effect=lambda url, **kwargs: self.get_response(self.content)):
+            upload_recordings_from_source_without_duplicate("bbb")
+            self.assertEqual(RecordingModel.objects.count(), 7)
+
+            latest = redis.set.call_args[0][1]
+            self.assertEqual(latest, 1699343312.797)
+
+            # Повторная синхронизация разбирает только записи в пределах перекрытия
+            RecordingModel.objects.all().delete()
+            redis.mget.return_value = [str(latest).encode()]
+            upload_recordings_from_source_without_duplicate("bbb")
+            self.assertEqual(RecordingModel.objects.count(), 1)
+
+            RecordingModel.objects.all().delete()
+            upload_recordings_from_source_without_duplicate("bbb", full=True)
+            self.assertEqual(RecordingModel.objects.count(), 7)
+
+    def test_sync_recordings_servers(self):
+        redis = mock.MagicMock()
+        redis.get.return_value = None
+        redis.mget.return_value = [None, None, None]
+        other_content = self.content.replace("-1676974666046", "-1676974666047")
+
+        def get(url, **kwargs):
+            if url == "down":
+                raise requests.ConnectionError("BBB server is not available")
+            return self.get_response(self.content if url == "bbb" else other_content)
+
+        servers = [
+            {"resource": "bbb", "shared_secret": "secret"},
+            {"resource": "other", "shared_secret": "other-secret"},
+            {"resource": "down", "shared_secret": "secret"},
+        ]
+        with mock.patch("RepackingApp.services.records.get_redis_connection", return_value=redis), \
+                mock.patch("RepackingApp.services.records.get_recordings_page_url",
+                           side_effect=lambda resource, offset, limit, shared_secret: resource), \
+                mock.patch("common.http_client.HTTPClient.get", side_effect=get):
+            recordings = sync_recordings(servers)
+
+        self.assertEqual(len(recordings), 8)
+        self.assertEqual(RecordingModel.objects.count(), 8)
+        self.assertEqual(sorted(call[0][0] for call in redis.set.call_args_list),
+                         ["recordings-sync-bbb", "recordings-sync-other"])
+        self.assertEqual(len(redis.pipeline.return_value.set.call_args_list), 2)
+
+    def test_request_recordings_page(self):
+        response = self.get_response(self.content, headers={"ETag": '"v1"'})
+        with mock.patch("common.http_client.HTTPClient.get", return_value=response) as get:
+            state, recordings = request_recordings_page("https://bbb/api", None)
+            self.assertEqual(len(recordings), 7)
+            self.assertEqual(state["count"], 7)
+            self.assertEqual(state["etag"], '"v1"')
+
+            # Прежнее содержимое не разбирается, сервер получает ETag прошлого ответа
+            new_state, recordings = request_recordings_page("https://bbb/api", state)
+            self.assertIsNone(recordings)
+            self.assertEqual(new_state, state)
+            self.assertEqual(get.call_args[1]["headers"], {"If-None-Match": '"v1"'})
+
+            get.return_value = self.get_response(status_code=304)
+            new_state, recordings = request_recordings_page("https://bbb/api", state)
+            self.assertIsNone(recordings)
+            self.assertEqual(new_state, state)
+
+    def test_sync_recordings_not_modified(self):
+        redis = mock.MagicMock()
+        redis.mget.return_value = [b"1699343312.797"]
+        redis.get.return_value = json.dumps({"etag": '"v1"', "last_modified": None, "hash": "", "count": 7})
+
+        with mock.patch("RepackingApp.services.records.get_redis_connection", return_value=redis), \
+                mock.patch("RepackingApp.services.records.get_recordings_page_url", return_value="https://bbb/api"), \
+                mock.patch("common.http_client.HTTPClient.get",
+                           return_value=self.get_response(status_code=304)), \
+                self.assertNumQueries(0):
+            recordings = sync_recordings([{"resource": "bbb", "shared_secret": "secret"}])
+
+        self.assertEqual(recordings, {})
+
     def test_get_recordings_foreinkey_type_recording_by_name(self):
         data = parse_xml_recordings(self.content)
         upload_recordings_to_db(data)
@@ -357,6 +486,22 @@ class RepackingServiceTests(TestCase):
         recordings_filter = list(filter(lambda x: x.url != '', RecordingModel.objects.all()))
         self.assertEqual(len(recordings_filter), 2)
 
+    def test_bulk_update_recordings(self):
+        upload_recordings_to_db(parse_xml_recordings(self.content))
+
+        recordings = [recording for _, recording in parse_xml_recordings(self.content)["recordings"]]
+        for recording in recordings:
+            recording.participants = 100
+        recordings.append(RecordingModel(record_id="missing", participants=1))
+
+        # Запрос идентификаторов и UPDATE на каждый пакет
+        with self.assertNumQueries(4):
+            count = bulk_update_recordings(iter(recordings), ["participants"], batch_size=4)
+
+        self.assertEqual(count, 7)
+        self.assertEqual(RecordingModel.objects.filter(participants=100).count(), 7)
+        self.assertFalse(RecordingModel.objects.filter(record_id="missing").exists())
+
     def test_upload_recordings_and_update_fields(self):
         upload_recordings_and_update_fields()
 
@@ -729,6 +874,224 @@ class RecordingTaskTests(TestCase):
 
         self.assertEqual(count, 3)
 
+    def test_get_processed_recording_file(self):
+        data = parse_xml_recordings(self.content)
+        upload_recordings_to_db(data)
+        tmp_recording = RecordingModel.objects.all()[0]
+
+        order = OrderRecordingModel.objects.create(count=1, user_id=self.user.id,
+                                                   type_recording=tmp_recording.type_recording)
+        uid = str(uuid.uuid4())
+        create_recording_task(recording=tmp_recording, task_id=uid, order=order, profile="balanced", status=5)
+
+        with tempfile.NamedTemporaryFile(suffix=".zip") as f:
+            create_recording_file(recording_task_id=uid, file=f.name, file_size=10)
+
+            recording_file = get_processed_recording_file(tmp_recording.record_id, "balanced")
+            self.assertIsNotNone(recording_file)
+            self.assertEqual(recording_file.recording_task.status, 5)
+            self.assertIsNone(get_processed_recording_file(tmp_recording.record_id, "fast"))
+
+        self.assertIsNone(get_processed_recording_file(tmp_recording.record_id, "balanced"))
+
+
+class DeduplicationTests(TestCase):
+    def setUp(self):
+        self.owner = UserModel.objects.create_user(username="owner", email="owner@mail.ru", password="passwoRd4_")
+        self.user = UserModel.objects.create_user(username="user", email="user@mail.ru", password="passwoRd4_",
+                                                  nextcloud_upload=True)
+
+        type_recording = TypeRecordingModel.objects.create(name="room")
+        self.recording = RecordingModel.objects.create(
+            record_id="recording-1", meeting_id="meeting-1", type_recording=type_recording,
+            url="https://bbb/playback/presentation/2.3/recording-1",
+            datetime_created=datetime.datetime.now(datetime.timezone.utc),
+            datetime_stopped=datetime.datetime.now(datetime.timezone.utc),
+        )
+        self.owner_order = OrderRecordingModel.objects.create(count=1, user=self.owner, type_recording=type_recording)
+        self.user_order = OrderRecordingModel.objects.create(count=1, user=self.user, type_recording=type_recording)
+
+        self.task_id = str(uuid.uuid4())
+        self.processing = create_recording_task(recording=self.recording, task_id=self.task_id,
+                                                order=self.owner_order, profile="balanced", status=3)
+
+        self.redis = FakeRedis()
+        for target in ("CeleryApp.tasks.get_redis_connection", "RepackingApp.services.progress.get_redis_connection"):
+            patcher = mock.patch(target, return_value=self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_recording_task(self, order):
+        return {
+            "recording_id": self.recording.record_id,
+            "task_id": str(uuid.uuid4()),
+            "order_id": order.id,
+            "profile": "balanced",
+            "status": 2,
+        }
+
+    def store(self, status):
+        f = tempfile.NamedTemporaryFile(suffix=".zip")
+        self.addCleanup(f.close)
+        update_recording_tasks(Q(task_id=self.task_id), status=status)
+        return create_recording_file(recording_task_id=self.task_id, file=f.name, file_size=10)
+
+    def test_link_processed_recording(self):
+        recording_file = self.store(4)
+        recording_task = self.get_recording_task(self.user_order)
+
+        with mock.patch.object(upload_processed_records, "delay") as delay:
+            self.assertTrue(reuse_processed_recording(recording_task))
+
+        task_id = recording_task["task_id"]
+        self.assertEqual(get_recording_tasks(Q(task_id=task_id)).get().status, 4)
+        self.assertTrue(RecodingFileUserModel.objects.filter(recording_task_id=task_id,
+                                                             file=recording_file.file).exists())
+        self.assertEqual(self.redis.get(settings.REDIS_KEY_ORDER_PROCESSED.format(self.user_order.id)), b"1")
+
+        # Первый заказ не загружал запись, владелец второго заказа загружает записи в NextCloud
+        delay.assert_called_once_with(task_id, self.user.id, "room", recording_file.file)
+
+    def test_link_waiting_tasks(self):
+        recording_task = self.get_recording_task(self.owner_order)
+        with mock.patch.object(upload_processed_records, "delay") as delay:
+            self.assertTrue(reuse_processed_recording(recording_task))
+
+            task_id = recording_task["task_id"]
+            self.assertEqual(get_recording_tasks(Q(task_id=task_id)).get().status, 2)
+            self.assertEqual(self.redis.smembers(get_waiting_tasks_key(self.recording.record_id, "balanced")),
+                             {task_id.encode()})
+
+            recording_file = self.store(4)
+            link_waiting_tasks(self.recording.record_id, "balanced", recording_file, 4)
+
+        self.assertEqual(get_recording_tasks(Q(task_id=task_id)).get().status, 4)
+        self.assertTrue(RecodingFileUserModel.objects.filter(recording_task_id=task_id).exists())
+        self.assertFalse(self.redis.exists(get_waiting_tasks_key(self.recording.record_id, "balanced")))
+
+        # Владелец заказа не загружает записи в NextCloud
+        delay.assert_not_called()
+
+    def test_release_waiting_tasks(self):
+        first, second = self.get_recording_task(self.owner_order), self.get_recording_task(self.user_order)
+        self.assertTrue(reuse_processed_recording(first))
+        self.assertTrue(reuse_processed_recording(second))
+
+        # Отмененная ожидающая задача только удаляется из ожидающих
+        with mock.patch.object(repack_threads_video_task, "apply_async") as apply_async:
+            release_waiting_tasks(get_recording_tasks(Q(task_id=first["task_id"])))
+            apply_async.assert_not_called()
+
+            # Вместо отмененной обработки запускается оставшаяся ожидающая задача
+            release_waiting_tasks([self.processing])
+
+        apply_async.assert_called_once()
+        self.assertEqual(apply_async.call_args[1]["task_id"], second["task_id"])
+        self.assertEqual(apply_async.call_args[1]["kwargs"]["recording_task"]["profile"], "balanced")
+        self.assertEqual(apply_async.call_args[1]["kwargs"]["user_id"], self.user.id)
+        self.assertFalse(self.redis.exists(get_waiting_tasks_key(self.recording.record_id, "balanced")))
+
+    def test_fail_waiting_tasks(self):
+        recording_task = self.get_recording_task(self.user_order)
+        self.assertTrue(reuse_processed_recording(recording_task))
+
+        fail_waiting_tasks(self.recording.record_id, "balanced")
+
+        self.assertEqual(get_recording_tasks(Q(task_id=recording_task["task_id"])).get().status, 6)
+        self.assertEqual(self.redis.get(settings.REDIS_KEY_ORDER_FAILED.format(self.user_order.id)), b"1")
+        self.assertFalse(self.redis.exists(get_waiting_tasks_key(self.recording.record_id, "balanced")))
+
+    def test_repack_source_error(self):
+        recording_task = self.get_recording_task(self.user_order)
+        self.assertTrue(reuse_processed_recording(recording_task))
+
+        ffmpeg_settings = {"encoder_profile": "balanced", "encoder_profiles": {}, "split_mode": False,
+                           "segment_duration": 600}
+        patcher = mock.patch("CeleryApp.tasks.dynamic_settings.get_ffmpeg_settings", return_value=ffmpeg_settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Ошибки источника завершают обработку и ожидающие задачи неудачно, а не оставляют их в статусе 3
+        errors = (OSError("No space left on device"), ValueError("Invalid duration"),
+                  requests.ConnectionError("Connection refused"))
+        for error in errors:
+            with self.subTest(error=error):
+                repack_task = self.get_recording_task(self.owner_order)
+                task_id = repack_task.pop("task_id")
+                track_task_progress(self.owner.id, self.recording.type_recording_id, task_id,
+                                    self.recording.record_id, status=2, stage="queued")
+
+                with mock.patch("CeleryApp.tasks.prepare_sources", side_effect=error):
+                    repack_threads_video_task.apply(args=("https://bbb", self.owner.id, repack_task),
+                                                    task_id=task_id, throw=True)
+
+                self.assertEqual(get_recording_tasks(Q(task_id=task_id)).get().status, 6)
+                self.assertEqual(self.redis.hget(settings.REDIS_KEY_TASK_PROGRESS.format(task_id), "status"), b"6")
+                self.assertFalse(self.redis.exists(task_id))
+
+        self.assertEqual(get_recording_tasks(Q(task_id=recording_task["task_id"])).get().status, 6)
+        self.assertEqual(self.redis.get(settings.REDIS_KEY_ORDER_FAILED.format(self.owner_order.id)), b"3")
+
+
+class RecordingsProgressTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = UserModel.objects.create_user(username="owner", email="owner@mail.ru", password="passwoRd4_")
+        self.other_user = UserModel.objects.create_user(username="other", email="other@mail.ru",
+                                                        password="passwoRd4_")
+        self.type_recording = TypeRecordingModel.objects.create(name="room")
+
+        self.redis = FakeRedis()
+        patcher = mock.patch("RepackingApp.services.progress.get_redis_connection", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.task_ids = [str(uuid.uuid4()) for _ in range(3)]
+        track_task_progress(self.user.id, self.type_recording.id, self.task_ids[0], "recording-1", 2, "queued")
+        track_task_progress(self.user.id, self.type_recording.id, self.task_ids[1], "recording-2", 2, "queued")
+        track_task_progress(self.other_user.id, self.type_recording.id, self.task_ids[2], "recording-3", 2, "queued")
+
+    def get_progress(self, type_recording_id):
+        response = self.client.get(reverse_lazy("repacking-api-records-progress", kwargs={"pk": type_recording_id}))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_room_progress(self):
+        update_task_progress(self.task_ids[0], status=3, stage="encode", percent=42.5, eta=120)
+        self.client.force_login(self.user)
+
+        response = self.get_progress(self.type_recording.id)
+        self.assertTrue(response["success"])
+
+        recordings = {item["record_id"]: item for item in response["recordings"]}
+        self.assertEqual(set(recordings), {"recording-1", "recording-2"})
+        self.assertEqual(
+            {key: value for key, value in recordings["recording-1"].items() if key != "datetime_updated"},
+            {"record_id": "recording-1", "status": 3, "stage": "encode", "percent": 42.5, "eta": 120}
+        )
+        self.assertIsNone(recordings["recording-2"]["eta"])
+
+        # Задачи других пользователей и других комнат не отдаются
+        self.assertEqual(self.get_progress(self.type_recording.id + 1)["recordings"], [])
+        self.client.force_login(self.other_user)
+        self.assertEqual([item["record_id"] for item in self.get_progress(self.type_recording.id)["recordings"]],
+                         ["recording-3"])
+
+    def test_room_progress_cleanup(self):
+        room_key = settings.REDIS_KEY_ROOM_PROGRESS.format(self.user.id, self.type_recording.id)
+        now = time.time()
+
+        update_task_progress(self.task_ids[0], status=5, stage="done")
+        delete_task_progress([self.task_ids[1]])
+        self.assertEqual(self.redis.zrange(room_key, 0, -1), [self.task_ids[0].encode()])
+
+        # Итоговый статус доступен PROGRESS_FINISHED_EXPIRATION секунд, затем задача удаляется из комнаты
+        self.assertEqual(get_room_progress(self.user.id, self.type_recording.id)[0]["status"], 5)
+        with mock.patch("RepackingApp.services.progress.time.time",
+                        return_value=now + settings.PROGRESS_FINISHED_EXPIRATION + 1):
+            self.assertEqual(get_room_progress(self.user.id, self.type_recording.id), [])
+        self.assertFalse(self.redis.zrange(room_key, 0, -1))
+
 
 class StartSubProcessTests():
     def test_start_subprocess(self):
@@ -753,6 +1116,156 @@ class ProcessRecordingsAPIView(TestCase):
         self.factory = RequestFactory()
 
 
+class DownloadFileViewTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = UserModel.objects.create_user(username="owner", email="owner@mail.ru", password="passwoRd4_")
+        self.other_user = UserModel.objects.create_user(username="other", email="other@mail.ru",
+                                                        password="passwoRd4_")
+
+        type_recording = TypeRecordingModel.objects.create(name="room")
+        recording = RecordingModel.objects.create(
+            record_id="recording-1", meeting_id="meeting-1", type_recording=type_recording,
+            datetime_created=datetime.datetime.now(datetime.timezone.utc),
+            datetime_stopped=datetime.datetime.now(datetime.timezone.utc),
+        )
+        order = OrderRecordingModel.objects.create(count=1, user=self.user, type_recording=type_recording)
+        task_id = str(uuid.uuid4())
+        create_recording_task(recording=recording, task_id=task_id, order=order, status=4)
+
+        os.makedirs(os.path.join(settings.FILES_ROOT, "ffmpeg"), exist_ok=True)
+        self.file = os.path.join("files", "ffmpeg", f"{task_id}.zip")
+        with open(self.file, "wb") as f:
+            f.write(b"zip")
+        self.rfile = create_recording_file(recording_task_id=task_id, file=self.file, file_size=3)
+
+    def tearDown(self):
+        os.remove(self.file)
+
+    def test_download_other_user(self):
+        self.client.force_login(self.other_user)
+        response = self.client.get(reverse_lazy("repacking-downloads-id", kwargs={"id": self.rfile.id}))
+
+        # handler404 отдает страницу 404.html
+        self.assertTemplateUsed(response, "404.html")
+        self.assertNotIn("X-Accel-Redirect", response)
+
+    @override_settings(DOWNLOAD_X_ACCEL_REDIRECT=True)
+    def test_download_x_accel_redirect(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse_lazy("repacking-downloads-id", kwargs={"id": self.rfile.id}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected-files/ffmpeg/{os.path.basename(self.file)}")
+        self.assertEqual(response.content, b"")
+
+    @override_settings(ARCHIVE_ON_THE_FLY=True, DOWNLOAD_X_ACCEL_REDIRECT=True)
+    def test_download_dir_x_accel_redirect(self):
+        task_id = RecodingFileUserModel.objects.get(pk=self.rfile.id).recording_task_id
+        directory = os.path.join("files", "ffmpeg", f"{task_id}-dir")
+        os.makedirs(directory)
+        with open(os.path.join(directory, "record.mp4"), "wb") as f:
+            f.write(b"video")
+        self.addCleanup(remove_recording_file, directory)
+        RecodingFileUserModel.objects.filter(pk=self.rfile.id).update(file=directory)
+
+        self.client.force_login(self.user)
+        url = reverse_lazy("repacking-downloads-id", kwargs={"id": self.rfile.id})
+
+        # Пока архив не собран, директория передается потоком, сборка ставится в очередь один раз
+        with mock.patch("CeleryApp.tasks.get_redis_connection", return_value=FakeRedis()), \
+                mock.patch.object(build_download_archive_task, "delay") as delay:
+            for _ in range(2):
+                response = self.client.get(url)
+                self.assertNotIn("X-Accel-Redirect", response)
+                with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as zf:
+                    self.assertEqual(zf.read("record.mp4"), b"video")
+
+            delay.assert_called_once_with(directory)
+            build_download_archive_task(directory)
+
+        # Собранный архив передается nginx
+        response = self.client.get(url)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected-files/ffmpeg/{task_id}-dir.zip")
+        self.assertEqual(response.content, b"")
+        with zipfile.ZipFile(f"{directory}.zip") as zf:
+            self.assertEqual(zf.read("record.mp4"), b"video")
+
+
+class PendingUploadTests(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user(username="owner", email="owner@mail.ru", password="passwoRd4_")
+        type_recording = TypeRecordingModel.objects.create(name="room")
+        order = OrderRecordingModel.objects.create(count=3, user=self.user, type_recording=type_recording)
+
+        self.task_ids = []
+        for i in range(3):
+            recording = RecordingModel.objects.create(
+                record_id=f"recording-{i}", meeting_id=f"meeting-{i}", type_recording=type_recording,
+                datetime_created=datetime.datetime.now(datetime.timezone.utc),
+                datetime_stopped=datetime.datetime.now(datetime.timezone.utc),
+            )
+            task_id = str(uuid.uuid4())
+            create_recording_task(recording=recording, task_id=task_id, order=order, status=4)
+            self.task_ids.append(task_id)
+
+    def test_defer_upload(self):
+        defer_upload(self.task_ids[0], "files/ffmpeg/record.zip")
+        defer_upload(self.task_ids[0], "files/ffmpeg/record", failed=True)
+
+        pending = PendingUploadModel.objects.get(recording_task_id=self.task_ids[0])
+        self.assertEqual(pending.file, "files/ffmpeg/record")
+        self.assertEqual(pending.attempts, 1)
+
+        complete_upload(self.task_ids[0])
+        self.assertFalse(PendingUploadModel.objects.exists())
+
+    @override_settings(PENDING_UPLOADS_MAX_ATTEMPTS=2)
+    def test_take_pending_uploads(self):
+        for task_id in self.task_ids:
+            defer_upload(task_id, f"files/ffmpeg/{task_id}.zip")
+        PendingUploadModel.objects.filter(recording_task_id=self.task_ids[1]).update(attempts=2)
+
+        pending_uploads = take_pending_uploads(10)
+        self.assertEqual([item.recording_task_id for item in pending_uploads], [self.task_ids[0], self.task_ids[2]])
+        self.assertEqual(pending_uploads[0].recording_task.recording.type_recording.name, "room")
+
+        # Отправленные загрузки не выбираются повторно
+        self.assertEqual(take_pending_uploads(10), [])
+
+        # Запись больше не доступна для загрузки
+        update_recording_tasks(Q(task_id=self.task_ids[2]), status=1)
+        defer_upload(self.task_ids[0], f"files/ffmpeg/{self.task_ids[0]}.zip")
+        self.assertEqual(len(take_pending_uploads(10)), 1)
+        self.assertFalse(PendingUploadModel.objects.filter(recording_task_id=self.task_ids[2]).exists())
+
+    @override_settings(PENDING_UPLOADS_MAX_ATTEMPTS=2)
+    def test_fail_pending_uploads(self):
+        defer_upload(self.task_ids[0], "files/ffmpeg/record.zip", failed=True)
+        defer_upload(self.task_ids[0], "files/ffmpeg/record.zip", failed=True)
+        defer_upload(self.task_ids[1], "files/ffmpeg/record1.zip", failed=True)
+
+        with mock.patch("RepackingApp.services.pending_upload.logging.error") as error:
+            self.assertEqual([item.recording_task_id for item in take_pending_uploads(10)], [self.task_ids[1]])
+        error.assert_called_once()
+        self.assertIn(self.task_ids[0], error.call_args[0][0])
+
+        # Неудачная загрузка остается в очереди без повторных отправок, запись доступна для скачивания
+        pending = PendingUploadModel.objects.get(recording_task_id=self.task_ids[0])
+        self.assertTrue(pending.failed)
+        self.assertEqual(get_recording_tasks(Q(task_id=self.task_ids[0]))[0].status, 4)
+
+        PendingUploadModel.objects.update(datetime_dispatched=None)
+        with mock.patch("RepackingApp.services.pending_upload.logging.error") as error:
+            self.assertEqual([item.recording_task_id for item in take_pending_uploads(10)], [self.task_ids[1]])
+        error.assert_not_called()
+
+        # Строка удаляется, когда файл записи больше не доступен
+        update_recording_tasks(Q(task_id=self.task_ids[0]), status=1)
+        take_pending_uploads(10)
+        self.assertFalse(PendingUploadModel.objects.filter(recording_task_id=self.task_ids[0]).exists())
+
+
 class NextcloudUploadingTests():
     def test_upload_file(self):
         source_file = "test.txt"
@@ -5,6 +5,8 @@ from RepackingApp import views
 urlpatterns = [
     path("records/room/<int:pk>/", views.RecordingsAPIView.as_view(), name="repacking-api-records"),
     path("records/room/<int:pk>/status/", views.RecordingsStatusAPIView.as_view(), name="repacking-api-records-status"),
+    path("records/room/<int:pk>/progress/", views.RecordingsProgressAPIView.as_view(),
+         name="repacking-api-records-progress"),
     path("records/process/", views.ProcessRecordingsAPIView.as_view(), name="repacking-api-process-records"),
     path("records/terminate/", views.TerminateRecordingsAPIView.as_view(), name="repacking-api-terminate-records"),
     path("records/upload/", views.UploadRecordingsAPIView.as_view(), name="repacking-api-upload-records"),
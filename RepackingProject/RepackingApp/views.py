@@ -2,10 +2,11 @@ import logging
 import os
 import json
 import random
+import uuid
 import pprint
 from pathlib import Path
 from http import HTTPStatus
-from urllib.parse import urlsplit
+from urllib.parse import urlsplit, quote
 
 from django.db.models import Q
 from django.conf import settings
@@ -14,7 +15,8 @@ from django.core.cache import cache
 from django.shortcuts import get_object_or_404
 from django.views.generic import View
 from django.contrib.sessions.models import Session
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
 from django.views.decorators.cache import cache_page
 from django.utils.decorators import method_decorator
 from django.contrib.auth import authenticate, login, logout
@@ -28,22 +30,27 @@ from AccountApp.services.session_service import NotifySessionService
 from AccountApp.services.user import get_user
 from CeleryApp.app import app
 from CeleryApp.tasks import repack_threads_video_task, remove_dirs_task, \
-    upload_processed_records, terminate_process_task
+    upload_processed_records, terminate_process_task, reuse_processed_recording, release_waiting_tasks, \
+    queue_download_archive
 from RepackingApp import forms
 from RepackingApp.models import RecordingModel, RecordingTaskIdModel, RecodingFileUserModel
 from RepackingApp.permissions import SecureSignaturePermission
 from RepackingApp.services.analytic.main import AnalyticConverterFactory
 from RepackingApp.services.downloads import get_recording_files, get_download_recording_files, \
-    get_recording_files_for_upload
+    get_recording_files_for_upload, get_download_archive
 from RepackingApp.services.order_record import create_recording_order
 from RepackingApp.services.record_task import create_recording_task, delete_recordings_tasks, get_recording_tasks, \
     create_recording_tasks, update_recording_tasks, get_recording_tasks_status, \
     get_recording_tasks_left_outer_recording, get_recording_order_tasks, get_recording_order_tasks_distinct_record
+from RepackingApp.services.progress import track_task_progress, get_room_progress, delete_task_progress
 from RepackingApp.services.records import get_type_recordings, \
     get_recordings_to_dict, \
     get_type_recordings_to_dict, get_recordings_foreinkey_type_recording, \
     get_recordings, get_recording, update_recording_by_record_id
+from common.archive import ZipStream
 from common.redis_conn import get_redis_connection
+from common.ffmpeg_repack import get_encoder_profile
+from core import dynamic_settings
 
 
 class RecordingsView(LoginRequiredMixin, View):
@@ -98,6 +105,21 @@ class RecordingsStatusAPIView(LoginRequiredMixin, View):
         )
 
 
+class RecordingsProgressAPIView(LoginRequiredMixin, View):
+
+    def get(self, request, pk):
+        recordings = get_room_progress(request.user.id, pk)
+
+        return HttpResponse(
+            json.dumps({
+                "success": True,
+                "recordings": recordings
+            }, default=str),
+            content_type='application/json',
+            status=HTTPStatus.OK
+        )
+
+
 class ProcessRecordingsAPIView(LoginRequiredMixin, View):
     form_class = forms.ProcessRecordingsForm
 
@@ -141,6 +163,9 @@ class ProcessRecordingsAPIView(LoginRequiredMixin, View):
         order = create_recording_order(count=len(clean_recording_ids), user_id=request.user.id,
                                        type_recording_id=recordings[0].type_recording_id)
 
+        ffmpeg_settings = dynamic_settings.get_ffmpeg_settings()
+        profile = get_encoder_profile(ffmpeg_settings["encoder_profile"], ffmpeg_settings["encoder_profiles"]).name
+
         recording_task_list = []
         for recording in recordings:
             resource = urlsplit(recording.url).netloc
@@ -150,13 +175,21 @@ class ProcessRecordingsAPIView(LoginRequiredMixin, View):
                 "user_id": request.user.id,
                 "recording_task": {
                     "recording_id": recording.record_id,
-                    "task_id": None,
+                    "task_id": str(uuid.uuid4()),
                     "order_id": order.id,
+                    "profile": profile,
                     "status": 2,
-                }
+                },
             }
-            task = repack_threads_video_task.delay(**task_params)
-            task_params["recording_task"]["task_id"] = task
+
+            track_task_progress(request.user.id, order.type_recording_id, task_params["recording_task"]["task_id"],
+                                recording.record_id, status=2, stage="queued")
+
+            # Запись уже обработана или обрабатывается для другого заказа
+            if reuse_processed_recording(task_params["recording_task"]):
+                continue
+
+            repack_threads_video_task.apply_async(kwargs=task_params, task_id=task_params["recording_task"]["task_id"])
             recording_task_list.append(RecordingTaskIdModel(**task_params["recording_task"]))
 
         create_recording_tasks(recording_task_list)
@@ -224,6 +257,8 @@ class TerminateRecordingsAPIView(LoginRequiredMixin, View):
         tasks = [recording_task.task_id for recording_task in clean_recording_tasks]
         app.control.revoke(tasks, terminate=True, signal='SIGKILL')
         terminate_process_task.delay(tasks)
+        release_waiting_tasks(clean_recording_tasks)
+        delete_task_progress(tasks)
 
         # delete_recordings_tasks(Q(task_id__in=tasks))
         update_recording_tasks(
@@ -362,11 +397,39 @@ class DownloadView(View):
 
 class DownloadFileView(LoginRequiredMixin, View):
     def get(self, request, id):
-        rfile = get_object_or_404(RecodingFileUserModel, pk=id)
+        rfile = get_object_or_404(RecodingFileUserModel, pk=id, recording_task__order__user_id=request.user.id)
 
         if not os.path.exists(rfile.file):
             return redirect("not-found")
 
+        # Передача файла nginx, рабочий процесс gunicorn освобождается сразу.
+        # nginx поддерживает Range запросы для докачки. Директория файлов записи
+        # (ARCHIVE_ON_THE_FLY) передается через архив, который собирает фоновая задача
+        path = os.path.relpath(os.path.abspath(rfile.file), settings.FILES_ROOT)
+        if settings.DOWNLOAD_X_ACCEL_REDIRECT and not path.startswith(os.pardir):
+            archive = get_download_archive(rfile.file)
+            if archive is not None:
+                path = os.path.relpath(os.path.abspath(archive), settings.FILES_ROOT)
+
+                response = HttpResponse(content_type="application/zip")
+                response["X-Accel-Redirect"] = quote(f"{settings.DOWNLOAD_X_ACCEL_LOCATION}{path}")
+                response["Content-Disposition"] = content_disposition_header(True, os.path.basename(archive))
+                return response
+
+            # Пока архив не собран, zip собирается при передаче
+            queue_download_archive(rfile.file)
+
+        # Файлы записи без архива, zip собирается при передаче
+        if os.path.isdir(rfile.file):
+            zip_stream = ZipStream.from_dir(rfile.file)
+
+            response = StreamingHttpResponse(zip_stream, content_type="application/zip")
+            response["Content-Length"] = zip_stream.size()
+            response["Content-Disposition"] = content_disposition_header(
+                True, f"{os.path.basename(rfile.file)}.zip"
+            )
+            return response
+
         return FileResponse(open(rfile.file, "rb"))
 
 
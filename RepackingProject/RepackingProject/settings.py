@@ -229,6 +229,24 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # BBB_RESOURCE = os.getenv("BBB_RESOURCE")
 # BBB_URL = os.getenv("BBB_URL")
 
+# Синхронизация записей BBB: getRecordings запрашивается страницами (offset, limit),
+# разбираются только записи, начатые не раньше последней синхронизации минус перекрытие,
+# перекрытие покрывает записи, опубликованные позже более новых
+BBB_RECORDINGS_PAGE_SIZE = int(os.getenv("BBB_RECORDINGS_PAGE_SIZE", 100))
+BBB_RECORDINGS_SYNC_OVERLAP = 60 * 60 * 24 * 3
+# Ответ getRecordings хранится в памяти до этого размера, больший ответ записывается во временный файл
+BBB_RESPONSE_SPOOL_SIZE = 10 * 1024 * 1024
+# Число серверов BBB (настройка bbb_servers), опрашиваемых одновременно
+BBB_SYNC_WORKERS = int(os.getenv("BBB_SYNC_WORKERS", 8))
+# Размер пакета при массовом обновлении конференций
+RECORDINGS_BULK_BATCH_SIZE = 500
+
+# Общий HTTP клиент (BBB API, проверки доступности, источники записей): таймауты в секундах
+# и число keep-alive соединений с одним сервером
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 60))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 20))
+
 # Celery settings
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND")
@@ -238,6 +256,38 @@ BROKER_TRANSPORT_OPTIONS = {
     'visibility_timeout': 3600
 }
 
+# FFmpeg settings
+# Количество параллельных задач ffmpeg воркера, по нему делится бюджет потоков ffmpeg
+FFMPEG_CELERY_CONCURRENCY = int(os.getenv("FFMPEG_CELERY_CONCURRENCY", 1))
+# Локальный кэш источников записей, размер в гигабайтах (0 - ffmpeg читает источники по сети)
+MEDIA_CACHE_DIR = "files/cache"
+MEDIA_CACHE_MAX_SIZE = int(os.getenv("MEDIA_CACHE_MAX_SIZE", 50)) * 1024 ** 3
+MEDIA_CACHE_RANGE_WORKERS = int(os.getenv("MEDIA_CACHE_RANGE_WORKERS", 4))
+# Файлы записи хранятся без архива, zip собирается при скачивании.
+# Каждое скачивание такой записи занимает рабочий процесс gunicorn на все время передачи
+ARCHIVE_ON_THE_FLY = bool(int(os.getenv("ARCHIVE_ON_THE_FLY", 0)))
+
+# Download settings
+# Передача файлов записей через nginx (X-Accel-Redirect) после проверки владельца в Django
+DOWNLOAD_X_ACCEL_REDIRECT = bool(int(os.getenv("DOWNLOAD_X_ACCEL_REDIRECT", 0)))
+DOWNLOAD_X_ACCEL_LOCATION = "/protected-files/"
+# Архив директории файлов записи собирается фоновой задачей, повторная постановка
+# блокируется на время сборки
+DOWNLOAD_ARCHIVE_BUILD_TIMEOUT = 60 * 60
+FILES_ROOT = os.path.join(BASE_DIR, "files")
+
+# NextCloud settings
+# Файлы больше размера части (в мегабайтах) загружаются по частям (chunked upload v2) параллельно
+NEXTCLOUD_CHUNK_SIZE = int(os.getenv("NEXTCLOUD_CHUNK_SIZE", 20)) * 1024 ** 2
+NEXTCLOUD_UPLOAD_WORKERS = int(os.getenv("NEXTCLOUD_UPLOAD_WORKERS", 4))
+NEXTCLOUD_UPLOAD_RETRIES = int(os.getenv("NEXTCLOUD_UPLOAD_RETRIES", 5))
+# Асинхронная загрузка: файлы задачи и их части загружаются одновременно через один пул соединений,
+# NEXTCLOUD_UPLOAD_WORKERS запросов всего и NEXTCLOUD_UPLOAD_PER_HOST к одному серверу
+NEXTCLOUD_ASYNC_UPLOAD = bool(int(os.getenv("NEXTCLOUD_ASYNC_UPLOAD", 1)))
+NEXTCLOUD_UPLOAD_PER_HOST = int(os.getenv("NEXTCLOUD_UPLOAD_PER_HOST", 4))
+# Ограничение скорости загрузки процесса в мегабайтах в секунду (0 - без ограничения)
+NEXTCLOUD_UPLOAD_BANDWIDTH = int(float(os.getenv("NEXTCLOUD_UPLOAD_BANDWIDTH", 0)) * 1024 ** 2)
+
 # Redis settings
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT"))
@@ -271,6 +321,35 @@ REDIS_KEY_CHECKER = "rediskeyckecker"
 REDIS_KEY_ORDER_PROCESSED = "order-{}"
 REDIS_KEY_ORDER_FAILED = "order-{}-failed"
 REDIS_KEY_ORDER_CANCELLED = "order-{}-cancelled"
+REDIS_KEY_RECORDING_WAITERS = "recording-{}-{}-waiters"
+REDIS_KEY_TASK_PROGRESS = "progress-{}"
+REDIS_KEY_ROOM_PROGRESS = "progress-user-{}-room-{}-tasks"
+REDIS_KEY_NEXTCLOUD_DIR = "nextcloud-dir-{}"
+REDIS_KEY_NEXTCLOUD_HEALTH = "nextcloud-health"
+REDIS_KEY_RECORDINGS_SYNC = "recordings-sync-{}"
+REDIS_KEY_RECORDINGS_PAGE = "recordings-page-{}"
+REDIS_KEY_DOWNLOAD_ARCHIVE = "download-archive-{}"
+
+# Время хранения прогресса обработки задач в Redis
+PROGRESS_EXPIRATION = 60 * 60 * 24 * 2
+PROGRESS_FINISHED_EXPIRATION = 60 * 30
+# Время хранения в Redis директорий NextCloud, существование которых уже проверено
+NEXTCLOUD_DIR_EXPIRATION = 60 * 60 * 24
+# Состояние страницы getRecordings (ETag, Last-Modified, хеш), по истечении страница разбирается заново
+RECORDINGS_PAGE_EXPIRATION = 60 * 60 * 24
+
+# Проверка доступности NextCloud: периодическая задача раз в NEXTCLOUD_HEALTH_CHECK_INTERVAL секунд,
+# после NEXTCLOUD_BREAKER_THRESHOLD ошибок подряд загрузки пропускаются на NEXTCLOUD_BREAKER_RESET_TIMEOUT секунд
+NEXTCLOUD_HEALTH_CHECK_INTERVAL = 60
+NEXTCLOUD_BREAKER_THRESHOLD = 3
+NEXTCLOUD_BREAKER_RESET_TIMEOUT = 60 * 5
+# Отложенные загрузки: раз в PENDING_UPLOADS_INTERVAL секунд отправляется пакет PENDING_UPLOADS_BATCH_SIZE загрузок,
+# отправленная загрузка повторно выбирается через PENDING_UPLOADS_DISPATCH_TIMEOUT секунд,
+# после PENDING_UPLOADS_MAX_ATTEMPTS неудачных попыток загрузка помечается неудачной
+PENDING_UPLOADS_INTERVAL = 60 * 5
+PENDING_UPLOADS_BATCH_SIZE = 10
+PENDING_UPLOADS_DISPATCH_TIMEOUT = 60 * 60
+PENDING_UPLOADS_MAX_ATTEMPTS = 5
 
 # Session keys
 KIND_CODE_2FA = "2fa"
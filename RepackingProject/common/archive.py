@@ -1,22 +1,351 @@
+from __future__ import annotations
+
+import io
 import os
+import time
+import zlib
 import shutil
+import struct
 import zipfile
+import tempfile
+from typing import BinaryIO, Iterator, List, Tuple
+
+
+# Текстовые файлы сжимаются, видео и аудио уже сжаты кодеком и записываются без сжатия
+DEFLATED_EXTENSIONS = (".txt", ".csv", ".xml", ".json")
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def get_compress_type(filename: str) -> int:
+    """
+    Метод сжатия участника архива по расширению файла
+    :param filename:
+    :return:
+    """
+
+    if filename.lower().endswith(DEFLATED_EXTENSIONS):
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+
+class ArchiveWriter:
+    """
+    Потоковая запись zip архива: участники добавляются по мере готовности,
+    медиафайлы копируются без сжатия со скоростью диска, ZIP64 для архивов больше 4 ГБ.
+    При remove=True исходный файл удаляется сразу после записи,
+    чтобы архив и исходные файлы не занимали место на диске одновременно
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.zip_file = None
+
+    def __enter__(self) -> ArchiveWriter:
+        self.zip_file = zipfile.ZipFile(self.path, "w", allowZip64=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.zip_file.close()
+        if exc_type is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def add_file(self, path: str, arcname: str = None, remove: bool = False) -> None:
+        arcname = arcname or os.path.basename(path)
+
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = get_compress_type(arcname)
+
+        with open(path, "rb") as src, self.zip_file.open(zinfo, "w") as dest:
+            shutil.copyfileobj(src, dest, COPY_BUFFER_SIZE)
+
+        if remove:
+            os.remove(path)
+
+    def add_bytes(self, arcname: str, data: bytes) -> None:
+        self.zip_file.writestr(arcname, data, compress_type=get_compress_type(arcname))
+
+    def add_dir(self, path: str, remove: bool = False) -> None:
+        for dirpath, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                self.add_file(file_path, os.path.relpath(file_path, path), remove)
+
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+# Бит 3 - crc и размеры записываются после данных, бит 11 - имена в UTF-8
+ZIP_STREAM_FLAGS = 0x08 | 0x800
+
+
+class ZipStreamMember:
+    """
+    Участник потокового архива: файл на диске, записываемый без сжатия
+    """
+
+    def __init__(self, path: str, arcname: str = None):
+        stat = os.stat(path)
+        self.path = path
+        self.arcname = (arcname or os.path.basename(path)).encode("utf-8")
+        self.size = stat.st_size
+        self.mode = stat.st_mode
+        self.date_time = time.localtime(stat.st_mtime)[0:6]
+        self.offset = 0
+        self.crc = 0
+
+    @property
+    def is_zip64(self) -> bool:
+        return self.size >= ZIP64_LIMIT
+
+    @property
+    def dos_date_time(self) -> Tuple[int, int]:
+        year, month, day, hour, minute, second = self.date_time
+        year = max(year, 1980)
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+    def local_header(self) -> bytes:
+        dos_time, dos_date = self.dos_date_time
+        extra = b""
+        size = 0
+        if self.is_zip64:
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            size = ZIP64_MARKER
+
+        return struct.pack(
+            "<IHHHHHIIIHH", 0x04034b50, ZIP64_VERSION if self.is_zip64 else ZIP_VERSION, ZIP_STREAM_FLAGS,
+            zipfile.ZIP_STORED, dos_time, dos_date, 0, size, size, len(self.arcname), len(extra)
+        ) + self.arcname + extra
+
+    def data_descriptor(self) -> bytes:
+        if self.is_zip64:
+            return struct.pack("<IIQQ", 0x08074b50, self.crc, self.size, self.size)
+        return struct.pack("<IIII", 0x08074b50, self.crc, self.size, self.size)
+
+    def central_header(self) -> bytes:
+        dos_time, dos_date = self.dos_date_time
+        size, offset = self.size, self.offset
+        extra_fields = []
+        if self.is_zip64:
+            extra_fields += [self.size, self.size]
+            size = ZIP64_MARKER
+        if self.offset >= ZIP64_LIMIT:
+            extra_fields.append(self.offset)
+            offset = ZIP64_MARKER
+
+        extra = b""
+        if extra_fields:
+            extra = struct.pack(f"<HH{len(extra_fields)}Q", 1, 8 * len(extra_fields), *extra_fields)
+        version = ZIP64_VERSION if extra_fields else ZIP_VERSION
+
+        return struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | version, version, ZIP_STREAM_FLAGS,
+            zipfile.ZIP_STORED, dos_time, dos_date, self.crc, size, size, len(self.arcname), len(extra),
+            0, 0, 0, (self.mode & 0xFFFF) << 16, offset
+        ) + self.arcname + extra
+
+
+class ZipStream:
+    """
+    Zip архив, собираемый при скачивании из файлов записи без сохранения на диск.
+    Участники записываются без сжатия, crc считается при чтении и записывается
+    в дескриптор после данных, поэтому размер архива известен до начала передачи
+    """
+
+    def __init__(self, members: List[ZipStreamMember], chunk_size: int = COPY_BUFFER_SIZE):
+        self.members = members
+        self.chunk_size = chunk_size
+
+        offset = 0
+        for member in self.members:
+            member.offset = offset
+            offset += len(member.local_header()) + member.size + len(member.data_descriptor())
+        self.central_offset = offset
+
+    @classmethod
+    def from_dir(cls, path: str) -> ZipStream:
+        members = []
+        for dirpath, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                members.append(ZipStreamMember(file_path, os.path.relpath(file_path, path)))
+        return cls(members)
+
+    def central_size(self) -> int:
+        return sum(len(member.central_header()) for member in self.members)
+
+    @property
+    def is_zip64(self) -> bool:
+        return self.central_offset >= ZIP64_LIMIT or len(self.members) >= 0xFFFF
+
+    def end_record(self) -> bytes:
+        central_size = self.central_size()
+        count = len(self.members)
+        end = b""
+
+        if self.is_zip64:
+            zip64_end_offset = self.central_offset + central_size
+            end += struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, (3 << 8) | ZIP64_VERSION, ZIP64_VERSION,
+                               0, 0, count, count, central_size, self.central_offset)
+            end += struct.pack("<IIQI", 0x07064b50, 0, zip64_end_offset, 1)
+
+        count_marker = 0xFFFF if self.is_zip64 else count
+        return end + struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count_marker, count_marker,
+                                 ZIP64_MARKER if self.is_zip64 else central_size,
+                                 ZIP64_MARKER if self.is_zip64 else self.central_offset, 0)
+
+    def size(self) -> int:
+        """
+        Размер архива в байтах для Content-Length
+        :return:
+        """
+
+        return self.central_offset + self.central_size() + len(self.end_record())
+
+    def __iter__(self) -> Iterator[bytes]:
+        for member in self.members:
+            yield member.local_header()
+
+            crc = 0
+            with open(member.path, "rb") as f:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    yield chunk
+            member.crc = crc
+
+            yield member.data_descriptor()
+
+        for member in self.members:
+            yield member.central_header()
+
+        yield self.end_record()
+
+    def save(self, path: str) -> None:
+        """
+        Запись архива в файл. Архив появляется под именем path только целиком,
+        параллельные вызовы не видят недописанный файл
+        :param path:
+        :return:
+        """
+
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path) or None)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class MemberReader(io.RawIOBase):
+    """
+    Чтение несжатого участника архива: окно [start, start + size) файла архива
+    с произвольным позиционированием
+    """
+
+    def __init__(self, f: BinaryIO, start: int, size: int):
+        super().__init__()
+        self.f = f
+        self.start = start
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = min(max(base + offset, 0), self.size)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+
+        self.f.seek(self.start + self.position)
+        count = self.f.readinto(memoryview(buffer)[:length])
+        self.position += count
+        return count
+
+    def close(self) -> None:
+        self.f.close()
+        super().close()
+
+
+class ArchiveMember:
+    """
+    Участник zip архива как источник загрузки без распаковки на диск.
+    Несжатый участник (видео) читается напрямую из архива по смещению данных,
+    поэтому части файла читаются в любом порядке; сжатый (текст) - через ZipFile.open
+    """
+
+    def __init__(self, path: str, name: str):
+        with zipfile.ZipFile(path) as zf:
+            try:
+                info = zf.getinfo(name)
+            except KeyError:
+                raise FileNotFoundError(f"{name} is not found in {path}")
+
+        self.path = path
+        self.name = name
+        self.size = info.file_size
+        self.mtime = os.path.getmtime(path)
+        self.compress_type = info.compress_type
+        self.header_offset = info.header_offset
+
+    def open(self) -> BinaryIO:
+        if self.compress_type != zipfile.ZIP_STORED:
+            # Файл архива остается открытым, пока открыт участник
+            with zipfile.ZipFile(self.path) as zf:
+                return zf.open(self.name)
+
+        f = open(self.path, "rb")
+        try:
+            f.seek(self.header_offset)
+            header = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+            if header[0] != zipfile.stringFileHeader:
+                raise zipfile.BadZipFile(f"Bad local header of {self.name} in {self.path}")
+        except (struct.error, zipfile.BadZipFile):
+            f.close()
+            raise
+
+        # Данные следуют за локальным заголовком, именем и дополнительными полями
+        start = self.header_offset + zipfile.sizeFileHeader + header[10] + header[11]
+        return MemberReader(f, start, self.size)
 
 
 class Archiving:
-    def __init__(self, path, expansion, filename=None):
+    def __init__(self, path, expansion, filename=None, remove=False):
         self.filename = filename
         self.path = path
         self.expansion = expansion
+        self.remove = remove
 
     def make_archive(self) -> str:
         path = self.path
         if self.filename:
             path = self.path+self.filename
 
-        shutil.make_archive(path, self.expansion, self.path)
+        if self.expansion != "zip":
+            shutil.make_archive(path, self.expansion, self.path)
+            return f"{path}.{self.expansion}"
+
+        with ArchiveWriter(f"{path}.zip") as archive:
+            archive.add_dir(self.path, self.remove)
 
-        return f"{path}.{self.expansion}"
+        return f"{path}.zip"
 
 
 class ArchivingUnpack:
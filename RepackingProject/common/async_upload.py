@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import time
+import asyncio
+import logging
+import threading
+from typing import AsyncIterator, Callable, List, Tuple
+
+import aiohttp
+
+from common.chunked_upload import DEFAULT_CHUNK_SIZE, PROPFIND_BODY, RETRY_STATUS_CODES, UPLOAD_TIMEOUT, \
+    LocalFile, as_source, get_upload_id, get_upload_urls, parse_uploaded_chunks, split_chunks
+
+
+READ_BUFFER_SIZE = 256 * 1024
+
+
+class UploadError(Exception):
+    """
+    Ошибочный ответ NextCloud при асинхронной загрузке
+    """
+
+    def __init__(self, method: str, url: str, status_code: int):
+        super().__init__(f"{status_code} {method} {url}")
+        self.status_code = status_code
+
+
+class TokenBucket:
+    """
+    Ограничение скорости загрузки, общее для всех загрузок процесса.
+    Отправка уходит в долг, следующая отправка ждет, пока долг не будет погашен,
+    поэтому блокировка удерживается только на время расчета задержки
+    """
+
+    def __init__(self, rate: int, capacity: int = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: int) -> float:
+        """
+        Резервирует amount байт
+        :param amount:
+        :return: задержка в секундах перед отправкой
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(-self.tokens / self.rate, 0)
+
+    async def consume(self, amount: int) -> None:
+        if self.rate <= 0:
+            return
+
+        delay = self.reserve(amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class AsyncUploader:
+    """
+    Асинхронная загрузка файлов в NextCloud: все файлы и их части загружаются
+    через один пул соединений, одновременно выполняется не больше concurrency запросов
+    и не больше per_host запросов к одному серверу. Большие файлы загружаются
+    по протоколу chunked upload v2 с продолжением загрузки, как в ChunkedUpload
+    """
+
+    def __init__(self, url: str, user: str, password: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 concurrency: int = 8, per_host: int = 4, bandwidth: TokenBucket = None,
+                 retries: int = 5, backoff: float = 1.0):
+        self.url = url if url.endswith("/") else f"{url}/"
+        self.user = user
+        self.password = password
+        self.chunk_size = chunk_size
+        self.concurrency = max(concurrency, 1)
+        self.per_host = max(per_host, 1)
+        self.bandwidth = bandwidth or TokenBucket(0)
+        self.retries = retries
+        self.backoff = backoff
+
+    def run(self, files: List[Tuple[str, str]]) -> None:
+        """
+        Загрузка файлов из синхронного кода
+        :param files: [(remote_path, local_source_file)], remote_path от корня файлов пользователя,
+        local_source_file - путь к файлу или источник загрузки
+        :return:
+        """
+
+        asyncio.run(self.upload_files(files))
+
+    async def upload_files(self, files: List[Tuple[str, str]]) -> None:
+        # Семафор создается внутри цикла событий (в python 3.8 он привязывается к текущему циклу)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=UPLOAD_TIMEOUT)
+
+        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.user, self.password),
+                                         connector=connector, timeout=timeout) as session:
+            await asyncio.gather(*[
+                self.upload(session, semaphore, remote_path, local_source_file)
+                for remote_path, local_source_file in files
+            ])
+
+    async def upload(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                     remote_path: str, local_source_file) -> None:
+        source = as_source(local_source_file)
+        size = source.size
+        upload_url, destination = get_upload_urls(self.url, self.user, get_upload_id(remote_path, source),
+                                                  remote_path)
+
+        if size <= self.chunk_size:
+            await self.request(session, semaphore, "PUT", destination,
+                               data=lambda: self.read_file(source, 0, size),
+                               headers={"Content-Length": str(size)})
+            logging.info(f"Upload {remote_path} successfully")
+            return
+
+        headers = {"Destination": destination, "OC-Total-Length": str(size)}
+
+        status, content = await self.request(session, semaphore, "PROPFIND", upload_url, allow=(404,),
+                                             data=lambda: PROPFIND_BODY.encode(), headers={"Depth": "1"})
+        if status == 404:
+            await self.request(session, semaphore, "MKCOL", upload_url, headers=headers)
+            uploaded = {}
+        else:
+            uploaded = parse_uploaded_chunks(content)
+
+        chunks = split_chunks(size, self.chunk_size)
+        pending = [chunk for chunk in chunks if uploaded.get(chunk[0]) != chunk[2]]
+        logging.info(f"Upload {remote_path}: {len(chunks)} chunks, {len(chunks) - len(pending)} already uploaded")
+
+        await asyncio.gather(*[
+            self.request(session, semaphore, "PUT", f"{upload_url}/{name}",
+                         data=lambda offset=offset, length=length: self.read_file(source, offset, length),
+                         headers={**headers, "Content-Length": str(length)})
+            for name, offset, length in pending
+        ])
+
+        await self.request(session, semaphore, "MOVE", f"{upload_url}/.file", headers=headers)
+        logging.info(f"Upload {remote_path} successfully")
+
+    async def read_file(self, source: LocalFile, offset: int, length: int) -> AsyncIterator[bytes]:
+        """
+        Чтение части файла с ограничением скорости
+        :param source:
+        :param offset:
+        :param length:
+        :return:
+        """
+
+        with source.open() as f:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(READ_BUFFER_SIZE, length))
+                if not data:
+                    break
+                length -= len(data)
+
+                await self.bandwidth.consume(len(data))
+                yield data
+
+    async def request(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, method: str, url: str,
+                      data: Callable = None, headers: dict = None, allow: Tuple[int, ...] = ()) -> Tuple[int, bytes]:
+        """
+        Запрос с повторами при сетевых ошибках и временных ответах сервера
+        :param session:
+        :param semaphore:
+        :param method:
+        :param url:
+        :param data: функция, возвращающая тело запроса (тело создается заново при повторе)
+        :param headers:
+        :param allow: коды ответа, которые не считаются ошибкой
+        :return: код и тело ответа
+        """
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore:
+                    async with session.request(method, url, data=data() if data else None,
+                                               headers=headers) as response:
+                        content = await response.read()
+
+                if response.status not in RETRY_STATUS_CODES:
+                    if response.status >= 400 and response.status not in allow:
+                        raise UploadError(method, url, response.status)
+                    return response.status, content
+                error = UploadError(method, url, response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == self.retries:
+                raise error
+
+            delay = self.backoff * 2 ** attempt
+            logging.warning(f"{method} {url} is failed: {error!r}. Retry in {delay}s")
+            await asyncio.sleep(delay)
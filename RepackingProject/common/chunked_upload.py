@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Tuple
+from urllib.parse import quote, unquote
+from xml.etree import ElementTree
+
+import requests
+
+from common.archive import MemberReader
+
+
+DEFAULT_CHUNK_SIZE = 20 * 1024 * 1024
+MIN_CHUNK_SIZE = 5 * 1024 * 1024
+MAX_CHUNKS = 10000
+UPLOAD_TIMEOUT = 120
+RETRY_STATUS_CODES = (423, 429, 500, 502, 503, 504)
+
+PROPFIND_BODY = """<?xml version="1.0"?>
+<d:propfind xmlns:d="DAV:"><d:prop><d:getcontentlength/></d:prop></d:propfind>"""
+
+
+class LocalFile:
+    """
+    Файл на диске как источник загрузки
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    @property
+    def mtime(self) -> float:
+        return os.path.getmtime(self.path)
+
+    def open(self) -> BinaryIO:
+        return open(self.path, "rb")
+
+
+def as_source(local_source_file):
+    """
+    Источник загрузки: путь к файлу или объект с size, mtime и open() (например, ArchiveMember)
+    :param local_source_file:
+    :return:
+    """
+
+    return LocalFile(local_source_file) if isinstance(local_source_file, str) else local_source_file
+
+
+def get_upload_id(remote_path: str, local_source_file) -> str:
+    """
+    Идентификатор загрузки зависит только от пути и файла, поэтому повторная загрузка
+    того же файла продолжает начатую
+    :param remote_path:
+    :param local_source_file: путь к файлу или источник загрузки
+    :return:
+    """
+
+    source = as_source(local_source_file)
+    key = f"{remote_path}|{source.size}|{int(source.mtime)}"
+    return f"repack-{hashlib.sha1(key.encode()).hexdigest()}"
+
+
+def split_chunks(size: int, chunk_size: int) -> List[Tuple[str, int, int]]:
+    """
+    Части файла (имя, смещение, размер). Имена - номера от 1 до 10000
+    :param size:
+    :param chunk_size:
+    :return:
+    """
+
+    chunk_size = max(chunk_size, MIN_CHUNK_SIZE, -(-size // MAX_CHUNKS))
+    return [
+        (f"{number:05d}", offset, min(chunk_size, size - offset))
+        for number, offset in enumerate(range(0, size, chunk_size), start=1)
+    ] or [("00001", 0, 0)]
+
+
+def parse_uploaded_chunks(content: bytes) -> Dict[str, int]:
+    """
+    Части из ответа PROPFIND директории загрузки
+    :param content:
+    :return: {имя части: размер}
+    """
+
+    chunks = {}
+    for item in ElementTree.fromstring(content).iter("{DAV:}response"):
+        name = unquote(item.findtext("{DAV:}href", "").rstrip("/").rsplit("/", 1)[-1])
+        length = item.findtext(".//{DAV:}getcontentlength")
+        if name.isdigit() and length is not None:
+            chunks[name] = int(length)
+    return chunks
+
+
+def get_upload_urls(url: str, user: str, upload_id: str, remote_path: str) -> Tuple[str, str]:
+    """
+    Адрес директории загрузки и адрес назначения файла
+    :param url: адрес NextCloud с / на конце
+    :param user:
+    :param upload_id:
+    :param remote_path:
+    :return:
+    """
+
+    return (
+        f"{url}remote.php/dav/uploads/{quote(user)}/{upload_id}",
+        f"{url}remote.php/dav/files/{quote(user)}/{quote(remote_path.lstrip('/'))}",
+    )
+
+
+class ChunkedUpload:
+    """
+    Загрузка файла в NextCloud по протоколу chunked upload v2:
+    MKCOL директории загрузки, параллельные PUT частей и MOVE .file в место назначения.
+    Идентификатор загрузки вычисляется по пути и файлу, поэтому после перезапуска
+    воркера уже принятые сервером части не загружаются повторно.
+    Каждая часть повторяется с экспоненциальной задержкой при сетевых ошибках и ответах 423/429/5xx
+    """
+
+    def __init__(self, session: requests.Session, url: str, user: str,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 4, retries: int = 5, backoff: float = 1.0):
+        self.session = session
+        self.url = url if url.endswith("/") else f"{url}/"
+        self.user = user
+        self.chunk_size = max(chunk_size, MIN_CHUNK_SIZE)
+        self.workers = max(workers, 1)
+        self.retries = retries
+        self.backoff = backoff
+
+    def upload(self, remote_path: str, local_source_file) -> None:
+        """
+        Загрузка файла
+        :param remote_path: путь относительно корня файлов пользователя
+        :param local_source_file: путь к файлу или источник загрузки
+        :return:
+        """
+
+        source = as_source(local_source_file)
+        size = source.size
+        upload_url, destination = get_upload_urls(self.url, self.user, get_upload_id(remote_path, source),
+                                                   remote_path)
+        headers = {"Destination": destination, "OC-Total-Length": str(size)}
+
+        uploaded = self.uploaded_chunks(upload_url)
+        if uploaded is None:
+            self.request("MKCOL", upload_url, headers=headers)
+            uploaded = {}
+
+        chunks = self.split_chunks(size)
+        pending = [chunk for chunk in chunks if uploaded.get(chunk[0]) != chunk[2]]
+        logging.info(f"Upload {remote_path}: {len(chunks)} chunks, {len(chunks) - len(pending)} already uploaded")
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, max(len(pending), 1))) as executor:
+            list(executor.map(
+                lambda chunk: self.put_chunk(upload_url, source, chunk, headers), pending
+            ))
+
+        self.request("MOVE", f"{upload_url}/.file", headers=headers)
+
+    def split_chunks(self, size: int) -> List[Tuple[str, int, int]]:
+        return split_chunks(size, self.chunk_size)
+
+    def uploaded_chunks(self, upload_url: str) -> Dict[str, int] | None:
+        """
+        Части, уже принятые сервером, None если директории загрузки нет
+        :param upload_url:
+        :return: {имя части: размер}
+        """
+
+        response = self.request("PROPFIND", upload_url, headers={"Depth": "1"}, data=PROPFIND_BODY, allow=(404,))
+        if response.status_code == 404:
+            return None
+
+        return parse_uploaded_chunks(response.content)
+
+    def put_chunk(self, upload_url: str, source: LocalFile, chunk: Tuple[str, int, int],
+                  headers: Dict[str, str]) -> None:
+        name, offset, length = chunk
+
+        # Часть файла передается потоком из окна [offset, offset + length), а не читается в память целиком
+        with MemberReader(source.open(), offset, length) as data:
+            self.request("PUT", f"{upload_url}/{name}", headers={**headers, "Content-Length": str(length)},
+                         data=data)
+
+    def request(self, method: str, url: str, allow: Tuple[int, ...] = (), **kwargs) -> requests.Response:
+        """
+        Запрос с повторами при сетевых ошибках и временных ответах сервера
+        :param method:
+        :param url:
+        :param allow: коды ответа, которые не считаются ошибкой
+        :param kwargs:
+        :return:
+        """
+
+        for attempt in range(self.retries + 1):
+            # Тело запроса из файла при повторе передается с начала
+            if hasattr(kwargs.get("data"), "seek"):
+                kwargs["data"].seek(0)
+
+            try:
+                response = self.session.request(method, url, timeout=UPLOAD_TIMEOUT, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    if response.status_code not in allow:
+                        response.raise_for_status()
+                    return response
+                error = requests.HTTPError(f"{response.status_code} {method} {url}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt == self.retries:
+                raise error
+
+            delay = self.backoff * 2 ** attempt
+            logging.warning(f"{method} {url} is failed: {error}. Retry in {delay}s")
+            time.sleep(delay)
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import time
+import logging
+from typing import Tuple
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    Предохранитель внешнего сервиса, состояние хранится в Redis и общее для всех воркеров.
+    closed - сервис доступен, ошибки подряд считаются; после threshold ошибок - open,
+    обращения к сервису пропускаются; через reset_timeout - half-open, одно пробное обращение
+    проверяет сервис: успех закрывает предохранитель, ошибка снова открывает его
+    """
+
+    def __init__(self, redis, key: str, threshold: int = 3, reset_timeout: float = 300):
+        self.redis = redis
+        self.key = key
+        self.threshold = max(threshold, 1)
+        self.reset_timeout = reset_timeout
+        # Пробное обращение в half-open получает один воркер, ключ истекает, если проба не завершилась
+        self.trial_key = f"{key}-trial"
+
+    def get_state(self) -> Tuple[str, int]:
+        """
+        Состояние предохранителя, один запрос к Redis
+        :return: состояние и число ошибок подряд
+        """
+
+        data = self.redis.hgetall(self.key)
+        failures = int(data.get(b"failures", 0))
+        if failures < self.threshold:
+            return CLOSED, failures
+
+        if time.time() - float(data.get(b"opened", 0)) >= self.reset_timeout:
+            return HALF_OPEN, failures
+        return OPEN, failures
+
+    def allow(self, trial: bool = True) -> bool:
+        """
+        Разрешено ли обращение к сервису
+        :param trial: в half-open занять пробное обращение, иначе обращение не разрешается
+        :return:
+        """
+
+        state = self.get_state()[0]
+        if state == CLOSED:
+            return True
+        if state == OPEN or not trial:
+            return False
+        return bool(self.redis.set(self.trial_key, 1, nx=True, ex=max(int(self.reset_timeout), 1)))
+
+    def record_success(self) -> None:
+        self.redis.delete(self.key, self.trial_key)
+
+    def record_failure(self) -> None:
+        # Время последней ошибки сохраняется вместе со счетчиком одной транзакцией: до threshold
+        # оно не учитывается, после - ошибка в half-open снова открывает предохранитель на reset_timeout
+        with self.redis.pipeline() as pipe:
+            pipe.hincrby(self.key, "failures", 1)
+            pipe.hset(self.key, "opened", time.time())
+            pipe.delete(self.trial_key)
+            failures = pipe.execute()[0]
+
+        if failures >= self.threshold:
+            logging.warning(f"Circuit {self.key} is open after {failures} failures")
@@ -1,11 +1,15 @@
 import requests
-from requests.exceptions import ConnectTimeout
+
+from common.http_client import get_session
 
 
 def health_check(domain: str, schema: str = "https") -> bool:
     url = f"{schema}://{domain}"
     try:
-        r = requests.get(url, timeout=2)
-        return True
-    except ConnectTimeout:
+        # HEAD через соединение процесса: тело страницы не нужно, TLS рукопожатие не повторяется
+        r = get_session().head(url, timeout=2)
+    except requests.RequestException:
         return False
+
+    # 5xx - сервер в режиме обслуживания или перегружен, 4xx - ресурс недоступен по адресу или без авторизации
+    return 200 <= r.status_code < 400
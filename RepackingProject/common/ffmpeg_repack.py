@@ -1,31 +1,758 @@
-from ffmpeg import FFmpeg
+from __future__ import annotations
+
+import os
+import re
+import json
+import time
+import shutil
+import logging
+import subprocess
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import requests
+
+from common.http_client import get_session
+from common.media_cache import MediaCache
 
 
 PREFIX = "https://{0}/presentation/{1}"
-I1 = f"{PREFIX}/deskshare/deskshare.webm"
-I2 = f"{PREFIX}/video/webcams.webm"
-OUTPUT = "{0}.mp4"
+DESKSHARE = f"{PREFIX}/deskshare/deskshare.webm"
+WEBCAMS = f"{PREFIX}/video/webcams.webm"
+POPCORN = f"{PREFIX}/slides_new.xml"
+
+SOURCES = {
+    "deskshare": DESKSHARE,
+    "webcams": WEBCAMS,
+    "popcorn": POPCORN,
+}
 
 FILTER_COMPLEX = "[1]scale=320:-1,setpts=PTS-STARTPTS[pip];" \
                 "[0]pad=w=1630:h=ih+20:x=10:y=10:color=LightGrey,setpts=PTS-STARTPTS[slides];" \
                 "[slides][pip] overlay=main_w-overlay_w-10:main_h-overlay_h-10[v]"
 
+# Профили кодирования, могут быть переопределены в ffmpeg_settings__encoder_profiles
+DEFAULT_ENCODER_PROFILE = "balanced"
+DEFAULT_ENCODER_PROFILES = {
+    "quality": {"preset": "medium", "crf": 21, "tune": "", "threads": 0, "scale": 0, "stream_copy": False},
+    "balanced": {"preset": "medium", "crf": 21, "tune": "", "threads": 0, "scale": 0, "stream_copy": True},
+    "fast": {"preset": "veryfast", "crf": 23, "tune": "", "threads": 0, "scale": 1280, "stream_copy": True},
+}
+
+# Кодеки, которые можно скопировать в контейнер mp4 без перекодирования
+COPY_VIDEO_CODECS = ("h264", "hevc", "vp9", "av1")
+COPY_AUDIO_CODECS = ("aac", "mp3")
+
+SINGLE_SOURCE_PRESET = "veryfast"
+ENCODE_AUDIO_ARGS = ["-c:a", "aac", "-q:a", "0.8"]
+
+PROBE_TIMEOUT = 10
+PROGRESS_INTERVAL = 5
+PROGRESS_LINE = re.compile(r"^(\w+)=(.*)$")
+
+
+class EncoderProfile:
+    """
+    Профиль кодирования h264.
+    threads = 0 - количество потоков определяется бюджетом воркера,
+    scale = 0 - без масштабирования, иначе максимальная ширина кадра,
+    stream_copy - запись только с webcams копируется без перекодирования видео,
+    если кодек допустим в mp4, иначе кодируется с пресетом veryfast
+    """
+
+    def __init__(self, name: str, preset: str = "medium", crf: int = 21, tune: str = "",
+                 threads: int = 0, scale: int = 0, stream_copy: bool = True):
+        self.name = name
+        self.preset = preset
+        self.crf = int(crf)
+        self.tune = tune
+        self.threads = int(threads)
+        self.scale = int(scale)
+        self.stream_copy = bool(stream_copy)
+
+    def video_args(self, threads: int = 0, preset: str = None) -> List[str]:
+        args = ["-c:v", "h264", "-preset", preset or self.preset, "-crf", str(self.crf)]
+
+        if self.tune:
+            args += ["-tune", self.tune]
+
+        threads = self.threads or threads
+        if threads:
+            args += ["-threads", str(threads)]
+
+        return args
+
+    def scale_filter(self) -> str | None:
+        if not self.scale:
+            return None
+        return f"scale='min({self.scale},iw)':-2"
+
+    def __str__(self):
+        return f"{self.name} (preset={self.preset}, crf={self.crf}, threads={self.threads}, scale={self.scale})"
+
+
+def get_encoder_profile(name: str = None, profiles: Dict[str, Dict] = None) -> EncoderProfile:
+    """
+    Извлекает профиль кодирования по имени, неизвестное имя заменяется профилем по умолчанию
+    :param name:
+    :param profiles: {"name": {"preset": str, "crf": int, ...}}
+    :return:
+    """
+
+    profiles = profiles or DEFAULT_ENCODER_PROFILES
+    name = name or DEFAULT_ENCODER_PROFILE
+
+    if name not in profiles:
+        logging.warning(f"Encoder profile {name} is not found, use {DEFAULT_ENCODER_PROFILE}")
+        name = DEFAULT_ENCODER_PROFILE
+
+    data = dict(DEFAULT_ENCODER_PROFILES.get(name, {}))
+    data.update(profiles.get(name, {}))
+    return EncoderProfile(name, **data)
+
+
+def thread_budget(concurrency: int, cpu_count: int = None) -> int:
+    """
+    Количество потоков ffmpeg на одну задачу, чтобы параллельные задачи
+    воркера не конкурировали за ядра
+    :param concurrency: FFMPEG_CELERY_CONCURRENCY
+    :param cpu_count:
+    :return:
+    """
+
+    cpu_count = cpu_count or os.cpu_count() or 1
+    return max(1, cpu_count // max(1, concurrency))
+
+
+class StageTimer:
+    """
+    Замер времени выполнения этапов перепаковки,
+    on_stage вызывается с именем этапа при его начале
+    """
+
+    def __init__(self, on_stage: Callable[[str], None] = None):
+        self.stages = {}
+        self.on_stage = on_stage
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.on_stage:
+            self.on_stage(name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.monotonic() - start
+
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    def __str__(self):
+        stages = ", ".join([f"{name}={seconds:.2f}s" for name, seconds in self.stages.items()])
+        return f"{stages}, total={self.total():.2f}s"
+
+
+class FFmpegProgress:
+    """
+    Событие прогресса ffmpeg, полученное из вывода -progress
+    """
+
+    def __init__(self, data: Dict[str, str]):
+        self.data = data
+        self.frame = int(data.get("frame", 0) or 0)
+        self.fps = float(data.get("fps", 0) or 0)
+        self.speed = data.get("speed", "").strip()
+        self.status = data.get("progress")
+
+        out_time_us = data.get("out_time_us", data.get("out_time_ms", "0"))
+        self.out_time_us = int(out_time_us) if out_time_us.lstrip("-").isdigit() else 0
+
+    @property
+    def out_time(self) -> float:
+        return max(self.out_time_us, 0) / 1_000_000
+
+    @property
+    def is_end(self) -> bool:
+        return self.status == "end"
+
+    @property
+    def speed_ratio(self) -> float:
+        try:
+            return float(self.speed.rstrip("x"))
+        except ValueError:
+            return 0
+
+    def percent(self, duration: float) -> float:
+        """
+        Процент кодирования записи длительностью duration секунд
+        """
+        if duration <= 0:
+            return 0
+        return 100.0 if self.is_end else round(min(self.out_time / duration, 1) * 100, 1)
+
+    def eta(self, duration: float) -> int | None:
+        """
+        Оставшееся время кодирования в секундах по текущей скорости ffmpeg
+        """
+        if duration <= 0 or self.speed_ratio <= 0:
+            return None
+        return int(max(duration - self.out_time, 0) / self.speed_ratio)
+
+    def __str__(self):
+        return f"frame={self.frame} fps={self.fps} time={self.out_time:.1f}s speed={self.speed} {self.status}"
+
+
+def parse_progress(lines: Iterable[str]) -> Iterator[FFmpegProgress]:
+    """
+    Разбирает блоки key=value из вывода ffmpeg -progress, каждый блок
+    завершается ключом progress
+    :param lines:
+    :return:
+    """
+
+    block = {}
+    for line in lines:
+        match = PROGRESS_LINE.match(line.strip())
+        if not match:
+            continue
+
+        key, value = match.groups()
+        block[key] = value
+        if key == "progress":
+            yield FFmpegProgress(block)
+            block = {}
+
+
+def probe_url(url: str) -> bool:
+    """
+    Проверяет доступность файла на сервере BBB
+    :param url:
+    :return:
+    """
+
+    try:
+        r = get_session().head(url, timeout=PROBE_TIMEOUT, allow_redirects=True)
+        return r.status_code == 200
+    except requests.RequestException as e:
+        logging.warning(f"Probe {url} is failed: {e}")
+        return False
+
+
+def probe_sources(resource: str, record_id: str) -> Dict[str, bool]:
+    """
+    Параллельная проверка наличия deskshare, webcams и popcorn у записи
+    :param resource:
+    :param record_id:
+    :return: {"deskshare": bool, "webcams": bool, "popcorn": bool}
+    """
+
+    urls = {name: url.format(resource, record_id) for name, url in SOURCES.items()}
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        results = dict(zip(urls.keys(), executor.map(probe_url, urls.values())))
+
+    logging.info(f"Probe {record_id}: {results}")
+    return results
+
+
+def download_file(url: str, path: str) -> None:
+    """
+    Скачивание файла по url
+    :param url:
+    :param path:
+    :return:
+    """
+
+    with get_session().get(url, stream=True, timeout=PROBE_TIMEOUT) as r:
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=1024 * 64):
+                f.write(chunk)
+
+
+class MediaInfo:
+    """
+    Сведения о медиафайле, полученные через ffprobe
+    """
+
+    def __init__(self, data: Dict):
+        self.streams = data.get("streams", [])
+        self.duration = float(data.get("format", {}).get("duration", 0) or 0)
+
+    def codec(self, codec_type: str) -> str | None:
+        for stream in self.streams:
+            if stream.get("codec_type") == codec_type:
+                return stream.get("codec_name")
+        return None
+
+    @property
+    def video_codec(self) -> str | None:
+        return self.codec("video")
+
+    @property
+    def audio_codec(self) -> str | None:
+        return self.codec("audio")
+
+
+def probe_media(url: str) -> MediaInfo:
+    """
+    Извлечение кодеков и длительности медиафайла через ffprobe
+    :param url:
+    :return:
+    """
+
+    result = subprocess.run(
+        [
+            "ffprobe", "-v", "error",
+            "-show_entries", "stream=codec_type,codec_name:format=duration",
+            "-of", "json", url
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return MediaInfo(json.loads(result.stdout or "{}"))
+
+
+def encode_video_args(profile: EncoderProfile, threads: int = 0, preset: str = None) -> List[str]:
+    """
+    Параметры кодирования видео с учетом масштабирования профиля
+    :param profile:
+    :param threads:
+    :param preset:
+    :return:
+    """
+
+    args = profile.video_args(threads, preset)
+    if profile.scale_filter():
+        args = ["-vf", profile.scale_filter()] + args
+    return args
+
+
+def single_source_video_args(media_info: MediaInfo | None, profile: EncoderProfile, threads: int = 0) -> List[str]:
+    """
+    Параметры видео для записи только с webcams. Если профиль допускает stream_copy,
+    видео копируется, когда кодек допустим в mp4, иначе кодируется с быстрым пресетом
+    :param media_info:
+    :param profile:
+    :param threads:
+    :return:
+    """
+
+    if not profile.stream_copy or media_info is None:
+        return encode_video_args(profile, threads)
+
+    video_codec = media_info.video_codec
+
+    if video_codec is None:
+        return ["-vn"]
+    elif video_codec in COPY_VIDEO_CODECS:
+        return ["-c:v", "copy"]
+
+    return encode_video_args(profile, threads, SINGLE_SOURCE_PRESET)
+
+
+def single_source_audio_args(media_info: MediaInfo | None, profile: EncoderProfile) -> List[str]:
+    """
+    Параметры аудио для записи только с webcams: при stream_copy аудио копируется,
+    если кодек допустим в mp4, иначе перекодируется в aac
+    :param media_info:
+    :param profile:
+    :return:
+    """
+
+    if not profile.stream_copy or media_info is None:
+        return list(ENCODE_AUDIO_ARGS)
+
+    audio_codec = media_info.audio_codec
+
+    if audio_codec is None:
+        return ["-an"]
+    elif audio_codec in COPY_AUDIO_CODECS:
+        return ["-c:a", "copy"]
+
+    return list(ENCODE_AUDIO_ARGS)
+
+
+def single_source_codec_args(media_info: MediaInfo | None, profile: EncoderProfile, threads: int = 0) -> List[str]:
+    """
+    Подбирает параметры кодирования для записи только с webcams.
+    Если профиль допускает stream_copy, видео копируется, когда кодек допустим в mp4
+    (иначе кодируется с быстрым пресетом), аудио копируется или перекодируется в aac.
+    Иначе поток перекодируется по профилю
+    :param media_info:
+    :param profile:
+    :param threads:
+    :return:
+    """
+
+    return single_source_video_args(media_info, profile, threads) + single_source_audio_args(media_info, profile)
+
+
+def build_command(output: str, webcams: str, deskshare: str = None, profile: EncoderProfile = None,
+                  threads: int = 0, codec_args: List[str] = None, segment: Tuple[float, float] = None) -> List[str]:
+    """
+    Формирует команду ffmpeg. Если deskshare отсутствует, обрабатывается только webcams
+    с параметрами codec_args, иначе webcams накладывается поверх deskshare.
+    Если задан segment (начало, длительность), кодируется только видео этого отрезка
+    :param output:
+    :param webcams:
+    :param deskshare:
+    :param profile:
+    :param threads:
+    :param codec_args:
+    :param segment:
+    :return:
+    """
+
+    profile = profile or get_encoder_profile()
+    command = ["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1", "-y"]
+    seek = ["-ss", f"{segment[0]:.3f}", "-t", f"{segment[1]:.3f}"] if segment else []
+
+    if deskshare:
+        filter_complex, video = FILTER_COMPLEX, "[v]"
+        if profile.scale_filter():
+            filter_complex, video = f"{FILTER_COMPLEX};[v]{profile.scale_filter()}[vs]", "[vs]"
+
+        command += seek + ["-i", deskshare]
+        command += seek + ["-i", webcams]
+        command += ["-filter_complex", filter_complex, "-map", video]
+
+        if segment:
+            command += profile.video_args(threads) + ["-an"]
+        else:
+            command += ["-map", "1:a"] + profile.video_args(threads) + ENCODE_AUDIO_ARGS
+    else:
+        command += seek + ["-i", webcams]
+
+        if segment:
+            command += (codec_args or encode_video_args(profile, threads)) + ["-an"]
+        else:
+            command += codec_args or encode_video_args(profile, threads) + ENCODE_AUDIO_ARGS
+
+    command.append(output)
+    return command
+
+
+def split_segments(duration: float, segment_duration: float) -> List[Tuple[float, float]]:
+    """
+    Делит запись на отрезки (начало, длительность), последний отрезок
+    короче половины segment_duration присоединяется к предыдущему
+    :param duration:
+    :param segment_duration:
+    :return:
+    """
+
+    if duration <= 0 or segment_duration <= 0:
+        return []
+
+    segments = []
+    start = 0.0
+    while start < duration:
+        length = min(segment_duration, duration - start)
+        if segments and length < segment_duration / 2:
+            prev_start, prev_length = segments.pop()
+            segments.append((prev_start, prev_length + length))
+        else:
+            segments.append((start, length))
+        start += length
+
+    return segments
+
+
+def build_concat_command(segments_list: str, output: str, webcams: str, audio_args: List[str]) -> List[str]:
+    """
+    Склеивает закодированные отрезки видео через concat demuxer без перекодирования
+    и добавляет аудио webcams целиком, чтобы на стыках отрезков не было разрывов звука
+    :param segments_list: файл со списком отрезков для concat demuxer
+    :param output:
+    :param webcams:
+    :param audio_args:
+    :return:
+    """
+
+    return [
+        "ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1", "-y",
+        "-f", "concat", "-safe", "0", "-i", segments_list,
+        "-i", webcams,
+        "-map", "0:v", "-map", "1:a?",
+        "-c:v", "copy",
+    ] + audio_args + [output]
+
+
+def write_segments_list(path: str, segment_files: List[str]) -> str:
+    """
+    Записывает список отрезков в формате concat demuxer
+    :param path:
+    :param segment_files:
+    :return:
+    """
+
+    with open(path, "w") as f:
+        for segment_file in segment_files:
+            segment_file = os.path.abspath(segment_file).replace("'", "'\\''")
+            f.write(f"file '{segment_file}'\n")
+    return path
+
+
+class RepackSources:
+    """
+    Источники записи: url webcams, deskshare (если есть) и сведения ffprobe о webcams
+    """
+
+    def __init__(self, webcams: str, deskshare: str = None, media_info: MediaInfo = None):
+        self.webcams = webcams
+        self.deskshare = deskshare
+        self.media_info = media_info
+
+    @property
+    def duration(self) -> float:
+        return self.media_info.duration if self.media_info else 0
+
+    def codec_args(self, profile: EncoderProfile, threads: int = 0) -> List[str] | None:
+        if self.deskshare:
+            return None
+        return single_source_codec_args(self.media_info, profile, threads)
+
+    def audio_args(self, profile: EncoderProfile) -> List[str]:
+        if self.deskshare:
+            return list(ENCODE_AUDIO_ARGS)
+        return single_source_audio_args(self.media_info, profile)
+
+    def is_video_encoded(self, profile: EncoderProfile) -> bool:
+        if self.deskshare:
+            return True
+
+        video_args = single_source_video_args(self.media_info, profile)
+        return "-c:v" in video_args and "copy" not in video_args
+
+    def can_split(self, profile: EncoderProfile, segment_duration: float) -> bool:
+        """
+        Отрезки имеют смысл, только если видео перекодируется и запись
+        длиннее двух отрезков
+        """
+        return segment_duration > 0 and self.duration >= 2 * segment_duration and self.is_video_encoded(profile)
+
+
+def fetch_source(cache: MediaCache | None, url: str, pin_dir: str = None) -> str:
+    """
+    Локальная копия источника из кэша. Без кэша или при ошибке скачивания
+    ffmpeg читает источник по url
+    :param cache:
+    :param url:
+    :param pin_dir: директория, в которой копия закрепляется до конца обработки
+    :return:
+    """
+
+    if cache is None:
+        return url
+
+    try:
+        return cache.fetch(url, pin_dir)
+    except (requests.RequestException, IOError) as e:
+        logging.warning(f"Media cache fetch {url} is failed: {e}")
+        return url
+
+
+def prepare_sources(resource: str, record_id: str, output_dir: str, timer: StageTimer = None,
+                    cache: MediaCache = None, pin_dir: str = None) -> RepackSources:
+    """
+    Проверка источников записи, загрузка popcorn.xml в output_dir и ffprobe webcams.
+    Если задан cache, deskshare, webcams и popcorn.xml скачиваются в локальный кэш.
+    Видео закрепляются в pin_dir, чтобы вытеснение из кэша не удалило их, пока
+    отрезки записи кодируются на других воркерах
+    :param resource:
+    :param record_id:
+    :param output_dir:
+    :param timer:
+    :param cache:
+    :param pin_dir: удаляется после завершения кодирования
+    :return:
+    """
+
+    timer = timer or StageTimer()
+    os.makedirs(output_dir, exist_ok=True)
+
+    with timer.stage("probe"):
+        sources = probe_sources(resource, record_id)
+
+    if not sources["webcams"]:
+        raise FileNotFoundError(f"Webcams is not found: {WEBCAMS.format(resource, record_id)}")
+
+    with timer.stage("download"):
+        if sources["popcorn"]:
+            popcorn = fetch_source(cache, POPCORN.format(resource, record_id))
+            try:
+                if popcorn == POPCORN.format(resource, record_id):
+                    download_file(popcorn, os.path.join(output_dir, "popcorn.xml"))
+                else:
+                    shutil.copy(popcorn, os.path.join(output_dir, "popcorn.xml"))
+            except (requests.RequestException, OSError) as e:
+                logging.warning(f"Popcorn is not downloaded: {e}")
+
+        webcams = fetch_source(cache, WEBCAMS.format(resource, record_id), pin_dir)
+        deskshare = fetch_source(cache, DESKSHARE.format(resource, record_id), pin_dir) \
+            if sources["deskshare"] else None
+
+    with timer.stage("probe"):
+        try:
+            media_info = probe_media(webcams)
+        except (subprocess.CalledProcessError, ValueError) as e:
+            logging.warning(f"ffprobe {webcams} is failed: {e}")
+            media_info = None
+
+    return RepackSources(webcams, deskshare, media_info)
+
+
+def build_segment_commands(sources: RepackSources, output_dir: str, profile: EncoderProfile,
+                           threads: int, segment_duration: float) -> List[Tuple[str, List[str]]]:
+    """
+    Формирует команды кодирования отрезков видео
+    :param sources:
+    :param output_dir:
+    :param profile:
+    :param threads:
+    :param segment_duration:
+    :return: [(файл отрезка, команда ffmpeg)]
+    """
+
+    codec_args = None
+    if not sources.deskshare:
+        codec_args = single_source_video_args(sources.media_info, profile, threads)
+
+    commands = []
+    for index, segment in enumerate(split_segments(sources.duration, segment_duration)):
+        segment_file = os.path.join(output_dir, f"segment-{index:04d}.mp4")
+        command = build_command(segment_file, sources.webcams, sources.deskshare, profile, threads,
+                                codec_args, segment=segment)
+        commands.append((segment_file, command))
+
+    return commands
+
+
+def run_ffmpeg(command: List[str],
+               on_progress: Callable[[FFmpegProgress], None] = None,
+               progress_interval: float = PROGRESS_INTERVAL) -> None:
+    """
+    Запускает ffmpeg и передает события прогресса в on_progress не чаще, чем
+    раз в progress_interval секунд (событие завершения передается всегда)
+    :param command:
+    :param on_progress:
+    :param progress_interval:
+    :return:
+    """
+
+    logging.info(f"Run {' '.join(command)}")
+    tail = deque(maxlen=20)
+
+    def lines(stream):
+        for line in stream:
+            if not PROGRESS_LINE.match(line.strip()):
+                tail.append(line.rstrip())
+            yield line
+
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+
+    last_notify = 0
+    try:
+        for progress in parse_progress(lines(process.stdout)):
+            now = time.monotonic()
+            if on_progress and (progress.is_end or now - last_notify >= progress_interval):
+                last_notify = now
+                on_progress(progress)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output="\n".join(tail))
+
+
+def encode_video(sources: RepackSources, output: str,
+                 on_progress: Callable[[FFmpegProgress], None] = None,
+                 timer: StageTimer = None,
+                 profile: EncoderProfile = None,
+                 threads: int = 0) -> StageTimer:
+    """
+    Кодирование записи целиком одним процессом ffmpeg.
+    Запись только с webcams при stream_copy профиля перепаковывается без перекодирования видео
+    :param sources:
+    :param output:
+    :param on_progress:
+    :param timer:
+    :param profile:
+    :param threads: бюджет потоков, если в профиле threads = 0
+    :return:
+    """
+
+    timer = timer or StageTimer()
+    profile = profile or get_encoder_profile()
+
+    codec_args = sources.codec_args(profile, threads)
+    if codec_args:
+        logging.info(f"Single source {sources.webcams}: {' '.join(codec_args)}")
+
+    logging.info(f"Encoder profile {profile}, threads {profile.threads or threads}")
+    command = build_command(output, sources.webcams, sources.deskshare, profile, threads, codec_args)
+
+    with timer.stage("encode"):
+        run_ffmpeg(command, on_progress)
+
+    return timer
+
+
+def concat_segments(segment_files: List[str], output: str, webcams: str, audio_args: List[str],
+                    timer: StageTimer = None) -> StageTimer:
+    """
+    Склейка отрезков видео в output с аудио webcams и удаление отрезков
+    :param segment_files:
+    :param output:
+    :param webcams:
+    :param audio_args: RepackSources.audio_args
+    :param timer:
+    :return:
+    """
+
+    timer = timer or StageTimer()
+    segments_list = write_segments_list(os.path.join(os.path.dirname(output), "segments.txt"), segment_files)
+
+    with timer.stage("concat"):
+        run_ffmpeg(build_concat_command(segments_list, output, webcams, audio_args))
+
+    for path in segment_files + [segments_list]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    return timer
+
+
+def repack_video(resource: str, record_id: str, output: str,
+                 on_progress: Callable[[FFmpegProgress], None] = None,
+                 timer: StageTimer = None,
+                 profile: EncoderProfile = None,
+                 threads: int = 0,
+                 cache: MediaCache = None) -> StageTimer:
+    """
+    Перепаковка видео конференции: проверка источников, загрузка popcorn.xml
+    в директорию с output и кодирование через ffmpeg
+    :param resource:
+    :param record_id:
+    :param output:
+    :param on_progress:
+    :param timer:
+    :param profile:
+    :param threads: бюджет потоков, если в профиле threads = 0
+    :param cache: локальный кэш источников
+    :return:
+    """
 
-def repack_video(resource, record_id):
-    ffmpeg = FFmpeg() \
-        .input(I1.format(resource, record_id)) \
-        .input(I2.format(resource, record_id)) \
-        .output(
-            OUTPUT.format(record_id),
-            filter_complex=FILTER_COMPLEX,
-            crf=21,
-            y=None,
-            map=["[v]", "1:a"],
-            options={
-                "c:v": "h264",
-                "c:a": "aac",
-                "q:a": 0.8,
-            }
-        )
-    ffmpeg.terminate()
-    ffmpeg.execute()
+    timer = timer or StageTimer()
+    sources = prepare_sources(resource, record_id, os.path.dirname(output), timer, cache)
+    return encode_video(sources, output, on_progress, timer, profile, threads)
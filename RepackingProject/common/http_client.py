@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import os
+import threading
+from typing import Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+POOL_MAXSIZE = 20
+
+# Сессия процесса: keep-alive соединения (и их TLS сессии) общие для всех задач процесса
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+
+class HTTPClient(requests.Session):
+    """
+    Сессия с пулом keep-alive соединений и таймаутами по умолчанию.
+    Повторные запросы к тому же серверу используют открытое соединение без нового TLS рукопожатия
+    """
+
+    def __init__(self, timeout: Tuple[float, float] = None, pool_maxsize: int = None):
+        super().__init__()
+        self.timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize or POOL_MAXSIZE)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def configure(connect_timeout: float, read_timeout: float, pool_maxsize: int) -> None:
+    """
+    Таймауты и размер пула соединений сессий, созданных после вызова
+    :param connect_timeout:
+    :param read_timeout:
+    :param pool_maxsize: соединений с одним сервером, не меньше числа потоков, выполняющих запросы
+    :return:
+    """
+
+    global CONNECT_TIMEOUT, READ_TIMEOUT, POOL_MAXSIZE
+
+    CONNECT_TIMEOUT, READ_TIMEOUT, POOL_MAXSIZE = connect_timeout, read_timeout, pool_maxsize
+    reset_session()
+
+
+def get_session() -> HTTPClient:
+    """
+    Сессия процесса. После fork воркера создается новая сессия, соединения родителя не используются
+    :return:
+    """
+
+    global _session, _session_pid
+
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            _session, _session_pid = HTTPClient(), os.getpid()
+        return _session
+
+
+def reset_session() -> None:
+    global _session
+
+    with _lock:
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+        _session = None
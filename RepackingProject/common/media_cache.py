@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import os
+import glob
+import fcntl
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+from urllib.parse import urlparse
+
+from common.http_client import get_session
+
+
+CACHE_TIMEOUT = 30
+CHUNK_SIZE = 1024 * 1024
+MIN_RANGE_SIZE = 16 * 1024 * 1024
+SERVICE_SUFFIXES = (".lock", ".tmp")
+
+
+class MediaCache:
+    """
+    Локальный кэш медиафайлов записей BBB.
+    Файл адресуется по sha256 от url, ETag и размера, поэтому повторная обработка
+    той же записи не скачивает файлы заново, а изменившийся на сервере файл скачивается как новый.
+    Файл скачивается параллельными Range запросами в части <файл>.part<N>,
+    при повторном вызове части докачиваются с места обрыва.
+    Использованный файл обновляет mtime, при нехватке места удаляются
+    наиболее давно использованные файлы. Файл, закрепленный за обработкой (pin_dir),
+    не теряется при вытеснении, пока обработка не удалит свою ссылку
+    """
+
+    def __init__(self, root: str, max_size: int, workers: int = 4, min_range_size: int = MIN_RANGE_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.workers = max(workers, 1)
+        self.min_range_size = min_range_size
+
+    def fetch(self, url: str, pin_dir: str = None) -> str:
+        """
+        Возвращает путь к локальной копии url, скачивая ее при отсутствии в кэше
+        :param url:
+        :param pin_dir: директория обработки, в которой закрепляется копия
+        :return: путь в кэше или закрепленная копия в pin_dir
+        """
+
+        if pin_dir is None:
+            return self.fetch_entry(url)
+
+        # Файл могли вытеснить между скачиванием и закреплением
+        for _ in range(2):
+            pinned = self.pin(self.fetch_entry(url), pin_dir)
+            if pinned:
+                return pinned
+        raise IOError(f"Media cache entry of {url} is evicted before pinning")
+
+    def fetch_entry(self, url: str) -> str:
+        """
+        Путь к файлу кэша url, файл скачивается при отсутствии в кэше
+        :param url:
+        :return:
+        """
+
+        size, etag, accept_ranges = self.head(url)
+        path = self.path(url, size, etag)
+
+        if self.touch(path):
+            logging.info(f"Media cache hit {url}: {path}")
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock(path):
+            # Файл мог скачать другой воркер, пока ожидалась блокировка
+            if self.touch(path):
+                logging.info(f"Media cache hit {url}: {path}")
+                return path
+
+            if size:
+                self.evict(size)
+
+            if size and accept_ranges:
+                self.download_ranges(url, path, size)
+            else:
+                self.download(url, path)
+
+        logging.info(f"Media cache store {url}: {path}")
+        return path
+
+    def pin(self, path: str, pin_dir: str) -> str | None:
+        """
+        Жесткая ссылка на файл кэша в pin_dir (копия, если директории на разных файловых системах).
+        Вытеснение удаляет только запись кэша, данные остаются доступны задачам обработки
+        до удаления pin_dir
+        :param path:
+        :param pin_dir:
+        :return: путь ссылки, None если файл уже вытеснен
+        """
+
+        os.makedirs(pin_dir, exist_ok=True)
+        pinned = os.path.join(pin_dir, os.path.basename(path))
+
+        with self.lock(path):
+            if not os.path.exists(path):
+                return None
+
+            if os.path.exists(pinned):
+                os.remove(pinned)
+            try:
+                os.link(path, pinned)
+            except OSError:
+                shutil.copyfile(path, pinned)
+
+        return pinned
+
+    def path(self, url: str, size: int | None, etag: str | None) -> str:
+        key = hashlib.sha256(f"{url}|{etag or ''}|{size or ''}".encode()).hexdigest()
+        ext = os.path.splitext(urlparse(url).path)[1]
+        return os.path.join(self.root, key[:2], f"{key}{ext}")
+
+    @staticmethod
+    def head(url: str) -> Tuple[int | None, str | None, bool]:
+        """
+        Размер, ETag и поддержка Range запросов файла на сервере
+        :param url:
+        :return:
+        """
+
+        r = get_session().head(url, timeout=CACHE_TIMEOUT, allow_redirects=True)
+        r.raise_for_status()
+
+        size = r.headers.get("Content-Length")
+        size = int(size) if size and size.isdigit() and "Content-Encoding" not in r.headers else None
+        accept_ranges = r.headers.get("Accept-Ranges", "").lower() == "bytes"
+        return size, r.headers.get("ETag"), accept_ranges
+
+    @staticmethod
+    def touch(path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        os.utime(path)
+        return True
+
+    @staticmethod
+    @contextmanager
+    def lock(path: str, blocking: bool = True) -> Iterator[bool]:
+        """
+        Межпроцессная блокировка файла кэша через fcntl.
+        Файл блокировки удаляется вытеснением вместе с файлом кэша, поэтому после получения
+        блокировки проверяется, что она взята на текущий файл, а не на удаленный
+        :param path:
+        :param blocking: если False, возвращает False, когда блокировка занята
+        :return:
+        """
+
+        lock_path = f"{path}.lock"
+        while True:
+            f = open(lock_path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                yield False
+                return
+
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(f.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def split_ranges(self, size: int) -> List[Tuple[int, int]]:
+        """
+        Делит файл на диапазоны байт (начало, конец включительно)
+        :param size:
+        :return:
+        """
+
+        range_size = max(self.min_range_size, -(-size // self.workers))
+        return [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+
+    def download_ranges(self, url: str, path: str, size: int) -> None:
+        """
+        Параллельное скачивание диапазонов в части и их склейка в path
+        :param url:
+        :param path:
+        :param size:
+        :return:
+        """
+
+        ranges = self.split_ranges(size)
+        parts = [f"{path}.part{i}" for i in range(len(ranges))]
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(ranges))) as executor:
+            list(executor.map(lambda item: download_range(url, *item), zip(parts, ranges)))
+
+        with open(f"{path}.tmp", "wb") as f:
+            for part in parts:
+                with open(part, "rb") as p:
+                    while True:
+                        chunk = p.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+
+        if os.path.getsize(f"{path}.tmp") != size:
+            os.remove(f"{path}.tmp")
+            raise IOError(f"Size of {url} does not match {size}")
+
+        os.replace(f"{path}.tmp", path)
+        for part in parts:
+            os.remove(part)
+
+    @staticmethod
+    def download(url: str, path: str) -> None:
+        """
+        Скачивание файла целиком, если сервер не поддерживает Range запросы
+        :param url:
+        :param path:
+        :return:
+        """
+
+        with get_session().get(url, stream=True, timeout=CACHE_TIMEOUT) as r:
+            r.raise_for_status()
+            with open(f"{path}.tmp", "wb") as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+
+        os.replace(f"{path}.tmp", path)
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """
+        Файлы кэша (mtime, размер, путь), включая недокачанные части
+        :return:
+        """
+
+        result = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(SERVICE_SUFFIXES):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def evict(self, required: int) -> None:
+        """
+        Удаляет наиболее давно использованные файлы, пока в кэше не освободится required байт.
+        Файлы, которые сейчас скачиваются или закрепляются, не удаляются.
+        Файл блокировки удаляется вместе с последним файлом записи кэша
+        :param required:
+        :return:
+        """
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total + required <= self.max_size:
+                break
+
+            entry = path.rsplit(".part", 1)[0] if ".part" in os.path.basename(path) else path
+            with self.lock(entry, blocking=False) as locked:
+                if not locked:
+                    continue
+
+                os.remove(path)
+                total -= size
+                if not os.path.exists(entry) and not glob.glob(f"{glob.escape(entry)}.part*"):
+                    os.remove(f"{entry}.lock")
+
+        logging.info(f"Media cache size {total} bytes")
+
+
+def download_range(url: str, part: str, byte_range: Tuple[int, int]) -> None:
+    """
+    Скачивание диапазона байт в часть, уже скачанное начало части не запрашивается повторно
+    :param url:
+    :param part:
+    :param byte_range:
+    :return:
+    """
+
+    start, end = byte_range
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if start + offset > end:
+        return
+
+    headers = {"Range": f"bytes={start + offset}-{end}"}
+    with get_session().get(url, headers=headers, stream=True, timeout=CACHE_TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError(f"Range request to {url} is not supported")
+
+        with open(part, "ab") as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
@@ -1,9 +1,34 @@
 import os.path
+import asyncio
+import logging
+from typing import List, Tuple
 
+import aiohttp
 import owncloud
+import requests
+from requests.adapters import HTTPAdapter
 from django.conf import settings
 from core import dynamic_settings
 
+from common.async_upload import AsyncUploader, TokenBucket, UploadError
+from common.chunked_upload import ChunkedUpload, as_source
+from common.circuit_breaker import CircuitBreaker
+from common.conn_check import health_check
+from common.redis_conn import get_redis_connection
+
+
+# Ошибки загрузки, после которых файлы записи остаются только локально
+UPLOAD_ERRORS = (requests.RequestException, owncloud.owncloud.HTTPResponseError, UploadError,
+                 aiohttp.ClientError, asyncio.TimeoutError)
+# Ограничение скорости загрузки, общее для всех загрузок процесса
+_bandwidth = TokenBucket(settings.NEXTCLOUD_UPLOAD_BANDWIDTH)
+
+# Клиент NextCloud процесса воркера: авторизация и keep-alive соединения общие для всех задач процесса
+_client = None
+_client_pid = None
+# Директории, существование которых процесс уже проверил или создал
+_known_dirs = set()
+
 
 def set_up():
     oc = owncloud.Client(f'https://{dynamic_settings.NEXTCLOUD_RESOURCE}')
@@ -11,57 +36,272 @@ def set_up():
     return oc
 
 
-def mkdir_root(oc):
-    for item in oc.list("/"):
-        if item.path == f"/{dynamic_settings.NEXTCLOUD_PATH}/":
-            break
-    else:
-        oc.mkdir(dynamic_settings.NEXTCLOUD_PATH)
+def get_client():
+    """
+    Клиент NextCloud процесса воркера. Создается и авторизуется при первом обращении,
+    корневая директория проверяется один раз
+    :return:
+    """
 
+    global _client, _client_pid
 
-def is_exist_dir(oc, remote_dir):
-    try:
-        rd = remote_dir
-        if rd[0] != '/' and rd[-1] == '/':
-            rd = '/'+remote_dir[:-1]
-            remote_dir = f"/{remote_dir}"
-        elif rd[0] == '/' and rd[-1] != '/':
-            remote_dir = f"{remote_dir}/"
-        elif rd[0] != '/' and rd[-1] != '/':
-            remote_dir = f"/{remote_dir}/"
-        else:
-            rd = remote_dir[:-1]
+    if _client is None or _client_pid != os.getpid():
+        _known_dirs.clear()
+
+        oc = set_up()
+        # Пул соединений рассчитан на параллельную загрузку частей файла
+        adapter = HTTPAdapter(pool_maxsize=max(settings.NEXTCLOUD_UPLOAD_WORKERS, 10))
+        oc._session.mount("https://", adapter)
+        oc._session.mount("http://", adapter)
+
+        ensure_dir(oc, dynamic_settings.NEXTCLOUD_PATH)
+        _client, _client_pid = oc, os.getpid()
 
-        split_remote_dir, _ = os.path.split(rd)
-        for item in oc.list(f"{split_remote_dir}"):
-            if item.path == remote_dir:
-                return True
+    return _client
 
-    except owncloud.owncloud.HTTPResponseError:
-        pass
 
+def reset_client():
+    global _client
+
+    if _client is not None and _client_pid == os.getpid():
+        _client._session.close()
+    _client = None
+    _known_dirs.clear()
+
+
+def get_breaker() -> CircuitBreaker:
+    return CircuitBreaker(get_redis_connection(), settings.REDIS_KEY_NEXTCLOUD_HEALTH,
+                          settings.NEXTCLOUD_BREAKER_THRESHOLD, settings.NEXTCLOUD_BREAKER_RESET_TIMEOUT)
+
+
+def is_available(trial: bool = True) -> bool:
+    """
+    Доступность NextCloud по состоянию предохранителя, без запроса к NextCloud
+    :param trial: после reset_timeout занять пробную загрузку, если ее еще не занял другой воркер
+    :return:
+    """
+
+    if get_breaker().allow(trial):
+        return True
+
+    logging.error(f"The \"{dynamic_settings.NEXTCLOUD_RESOURCE}\" resource is not unavailable!")
     return False
 
 
-def mkdir_parent(oc, remote_dir):
-    dirname = ''
-    dirs = remote_dir.split('/')
-    for i in range(1, len(dirs)-1):
-        dirname = os.path.join(dirname, dirs[i])
+def check_health() -> bool:
+    """
+    Проверка доступности NextCloud и обновление состояния предохранителя
+    :return:
+    """
+
+    breaker = get_breaker()
+    if health_check(domain=dynamic_settings.NEXTCLOUD_RESOURCE, schema="https"):
+        breaker.record_success()
+        return True
+
+    breaker.record_failure()
+    return False
+
+
+def get_error_status(error):
+    if isinstance(error, (owncloud.owncloud.HTTPResponseError, UploadError)):
+        return error.status_code
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code
+    return None
+
+
+def record_upload_error(error) -> None:
+    """
+    Сетевые ошибки и ответы 5xx загрузки считаются недоступностью NextCloud
+    :param error: одна из UPLOAD_ERRORS
+    :return:
+    """
+
+    status = get_error_status(error)
+    if status is None or status >= 500:
+        get_breaker().record_failure()
+
+
+def upload_files(files: List[Tuple[str, str]]) -> None:
+    """
+    Загрузка файлов клиентом процесса. При NEXTCLOUD_ASYNC_UPLOAD файлы загружаются одновременно
+    через AsyncUploader, иначе по одному. При истечении авторизации (401) или удалении
+    известной директории (404, 409) клиент создается заново и загрузка повторяется один раз
+    :param files: [(remote_file, local_source_file)], local_source_file - путь к файлу или участник архива
+    :return:
+    """
+
+    if settings.NEXTCLOUD_ASYNC_UPLOAD:
+        retry_upload(upload_async, files)
+        return
+
+    for item in files:
+        retry_upload(upload_sync, [item])
+
+
+def retry_upload(upload, files: List[Tuple[str, str]]) -> None:
+    try:
+        upload(get_client(), files)
+    except (owncloud.owncloud.HTTPResponseError, requests.HTTPError, UploadError) as e:
+        if get_error_status(e) not in (401, 404, 409):
+            raise
+
+        logging.warning(f"Upload {[remote_file for remote_file, _ in files]} is failed: {e}. Reconnect to NEXTCLOUD")
+        for remote_file, _ in files:
+            forget_dir(os.path.dirname(get_remote_path(remote_file)))
+        reset_client()
+        upload(get_client(), files)
 
-        if not is_exist_dir(oc, dirname):
-            oc.mkdir(f"/{dirname}/")
+
+def upload_sync(oc, files: List[Tuple[str, str]]) -> None:
+    for remote_file, local_source_file in files:
+        upload_to_nextcloud(oc, remote_file, local_source_file)
+
+
+def upload_async(oc, files: List[Tuple[str, str]]) -> None:
+    AsyncUploader(
+        oc.url, dynamic_settings.NEXTCLOUD_USER, dynamic_settings.NEXTCLOUD_PASSWORD,
+        chunk_size=settings.NEXTCLOUD_CHUNK_SIZE,
+        concurrency=settings.NEXTCLOUD_UPLOAD_WORKERS,
+        per_host=settings.NEXTCLOUD_UPLOAD_PER_HOST,
+        bandwidth=_bandwidth,
+        retries=settings.NEXTCLOUD_UPLOAD_RETRIES,
+    ).run([(prepare_upload(oc, remote_file), local_source_file) for remote_file, local_source_file in files])
+
+
+def get_remote_path(remote_path):
+    return f"/{dynamic_settings.NEXTCLOUD_PATH}/{remote_path.strip('/')}"
+
+
+def get_dir_key(remote_dir):
+    return settings.REDIS_KEY_NEXTCLOUD_DIR.format(remote_dir)
+
+
+def get_dir_paths(remote_dir) -> List[str]:
+    """
+    Директория и все родительские: /a/b/ -> ["/a/", "/a/b/"]
+    :param remote_dir:
+    :return:
+    """
+
+    parts = remote_dir.strip('/').split('/')
+    return [f"/{'/'.join(parts[:i])}/" for i in range(1, len(parts) + 1)]
+
+
+def ensure_dir(oc, remote_dir) -> bool:
+    """
+    Создание директории вместе с родительскими. Проверенные директории запоминаются в процессе
+    и в Redis на NEXTCLOUD_DIR_EXPIRATION (общий кэш воркеров), для известной директории запросов нет.
+    Иначе один PROPFIND (Depth: 0) проверяет директорию целиком, а для отсутствующей
+    выполняется MKCOL неизвестных уровней, ответ 405 означает, что уровень уже существует
+    :param oc:
+    :param remote_dir: путь от корня файлов пользователя
+    :return: True, если директория создана этим вызовом
+    """
+
+    paths = get_dir_paths(remote_dir)
+    if paths[-1] in _known_dirs:
+        return False
+
+    r = get_redis_connection()
+    for path, cached in zip(paths, r.mget([get_dir_key(path) for path in paths])):
+        if cached:
+            _known_dirs.add(path)
+    if paths[-1] in _known_dirs:
+        return False
+
+    missing = [path for path in paths if path not in _known_dirs]
+    created = False
+    try:
+        exists = oc.file_info(paths[-1]) is not None
+    except owncloud.owncloud.HTTPResponseError as e:
+        if e.status_code != 404:
+            raise
+        exists = False
+
+    if not exists:
+        for path in missing:
+            try:
+                oc.mkdir(path)
+                created = True
+            except owncloud.owncloud.HTTPResponseError as e:
+                if e.status_code != 405:
+                    raise
+                created = False
+
+    _known_dirs.update(missing)
+    with r.pipeline() as pipe:
+        for path in missing:
+            pipe.set(get_dir_key(path), 1, ex=settings.NEXTCLOUD_DIR_EXPIRATION)
+        pipe.execute()
+
+    return created
+
+
+def forget_dir(remote_dir) -> None:
+    """
+    Удаление директории и родительских из кэша, например, после удаления директории в NextCloud
+    :param remote_dir:
+    :return:
+    """
+
+    paths = get_dir_paths(remote_dir)
+
+    _known_dirs.difference_update(paths)
+    get_redis_connection().delete(*[get_dir_key(path) for path in paths])
+
+
+def prepare_upload(oc, remote_file):
+    """
+    Создание директории файла и удаление директории с именем файла
+    :param oc:
+    :param remote_file:
+    :return: путь файла от корня файлов пользователя
+    """
+
+    remote_full = get_remote_path(remote_file)
+
+    # В только что созданной директории нет директории с именем файла
+    if not ensure_dir(oc, os.path.dirname(remote_full)):
+        try:
+            info = oc.file_info(remote_full)
+        except owncloud.owncloud.HTTPResponseError as e:
+            if e.status_code != 404:
+                raise
+            info = None
+
+        if info is not None and info.is_dir():
+            oc.delete(f"{remote_full}/")
+
+    return remote_full
 
 
 def upload_to_nextcloud(oc, remote_file, local_source_file):
-    remote_dir = os.path.dirname(remote_file)
-    remote_dir_full = f"/{dynamic_settings.NEXTCLOUD_PATH}/{remote_dir}/"
-    remote_full = f"/{dynamic_settings.NEXTCLOUD_PATH}/{remote_file}"
+    """
+    Загрузка файла клиентом oc
+    :param oc:
+    :param remote_file:
+    :param local_source_file: путь к файлу или источник загрузки (участник архива)
+    :return:
+    """
 
-    if is_exist_dir(oc, f"{remote_full}/"):
-        oc.delete(f"{remote_full}/")
+    remote_full = prepare_upload(oc, remote_file)
+    source = as_source(local_source_file)
 
-    if remote_dir and not is_exist_dir(oc, remote_dir_full):
-        mkdir_parent(oc, remote_dir_full)
+    if source.size <= settings.NEXTCLOUD_CHUNK_SIZE:
+        if isinstance(local_source_file, str):
+            oc.put_file(remote_full, local_source_file, chunked=False)
+        else:
+            with source.open() as f:
+                oc.put_file_contents(remote_full, f.read())
+        return
 
-    oc.put_file(remote_full, local_source_file, chunked=False)
+    # Большие файлы загружаются частями параллельно, с повтором частей и продолжением после перезапуска
+    ChunkedUpload(
+        oc._session, oc.url, dynamic_settings.NEXTCLOUD_USER,
+        chunk_size=settings.NEXTCLOUD_CHUNK_SIZE,
+        workers=settings.NEXTCLOUD_UPLOAD_WORKERS,
+        retries=settings.NEXTCLOUD_UPLOAD_RETRIES,
+    ).upload(remote_full, source)
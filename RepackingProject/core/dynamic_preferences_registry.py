@@ -1,15 +1,21 @@
 
+import json
+
 from django import forms
+from django.core.exceptions import ValidationError
 
 from dynamic_preferences.preferences import Section
-from dynamic_preferences.types import StringPreference, LongStringPreference
+from dynamic_preferences.types import StringPreference, LongStringPreference, BooleanPreference, \
+    IntegerPreference
 from dynamic_preferences.registries import global_preferences_registry
 
 from core.dynamic_serializer import EncryptedSerializer
+from common.ffmpeg_repack import DEFAULT_ENCODER_PROFILE, DEFAULT_ENCODER_PROFILES, EncoderProfile
 
 
 bbb_settings = Section("bbb_settings")
 nextcloud_settings = Section("nextcloud_settings")
+ffmpeg_settings = Section("ffmpeg_settings")
 
 global_pref = global_preferences_registry.manager()
 
@@ -52,6 +58,29 @@ class BBBURL(StringPreference):
     required = True
 
 
+@global_preferences_registry.register
+class BBBServers(CustomPreference):
+    section = bbb_settings
+    name = "bbb_servers"
+    default = ""
+    required = False
+    help_text = "JSON: [{\"resource\", \"shared_secret\"}]. Если не задано, используются bbb_resource и bbb_shared_secret"
+
+    serializer = EncryptedSerializer
+
+    def validate(self, value):
+        if not value:
+            return
+
+        try:
+            servers = json.loads(value)
+            for server in servers:
+                if not server["resource"] or not server["shared_secret"]:
+                    raise ValueError("пустой resource или shared_secret")
+        except (ValueError, TypeError, KeyError) as e:
+            raise ValidationError(f"Некорректный список серверов BBB: {e}")
+
+
 # Nextcloud settings
 @global_preferences_registry.register
 class NextCloudResource(StringPreference):
@@ -109,3 +138,48 @@ class NextCloudShareLinkPassword(CustomPreference):
     field_kwargs = {
         "widget": forms.PasswordInput()
     }
+
+
+# FFmpeg settings
+@global_preferences_registry.register
+class FFmpegEncoderProfile(StringPreference):
+    section = ffmpeg_settings
+    name = "encoder_profile"
+    default = DEFAULT_ENCODER_PROFILE
+    required = True
+    help_text = "Имя активного профиля из encoder_profiles"
+
+
+@global_preferences_registry.register
+class FFmpegEncoderProfiles(LongStringPreference):
+    section = ffmpeg_settings
+    name = "encoder_profiles"
+    default = json.dumps(DEFAULT_ENCODER_PROFILES, indent=4)
+    required = True
+    help_text = "JSON: {\"name\": {\"preset\", \"crf\", \"tune\", \"threads\", \"scale\", \"stream_copy\"}}"
+
+    def validate(self, value):
+        try:
+            profiles = json.loads(value)
+            for name, data in profiles.items():
+                EncoderProfile(name, **data)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise ValidationError(f"Некорректные профили кодирования: {e}")
+
+
+@global_preferences_registry.register
+class FFmpegSplitMode(BooleanPreference):
+    section = ffmpeg_settings
+    name = "split_mode"
+    default = False
+    required = False
+    help_text = "Кодировать длинные записи отрезками параллельно на нескольких воркерах"
+
+
+@global_preferences_registry.register
+class FFmpegSegmentDuration(IntegerPreference):
+    section = ffmpeg_settings
+    name = "segment_duration"
+    default = 60 * 15
+    required = True
+    help_text = "Длительность отрезка в секундах, делятся записи длиннее двух отрезков"
@@ -1,4 +1,5 @@
 import sys
+import json
 
 from dynamic_preferences.registries import global_preferences_registry
 
@@ -20,3 +21,41 @@ if "migrate" not in sys.argv:
     NEXTCLOUD_PATH = global_pref["nextcloud_settings__nextcloud_path"]
     NEXTCLOUD_SHARE_LINK = global_pref["nextcloud_settings__nextcloud_share_link"]
     NEXTCLOUD_SHARE_LINK_PASSWORD = str(fernet.decrypt(global_pref["nextcloud_settings__nextcloud_share_link_password"]).decode())
+
+
+def get_ffmpeg_settings() -> dict:
+    """
+    Настройки ffmpeg читаются при каждом вызове, чтобы изменения
+    в панели администратора применялись без перезапуска воркеров
+    :return:
+    """
+
+    global_pref = global_preferences_registry.manager()
+
+    return {
+        "encoder_profile": global_pref["ffmpeg_settings__encoder_profile"],
+        "encoder_profiles": json.loads(global_pref["ffmpeg_settings__encoder_profiles"]),
+        "split_mode": global_pref["ffmpeg_settings__split_mode"],
+        "segment_duration": global_pref["ffmpeg_settings__segment_duration"],
+    }
+
+
+def get_bbb_servers() -> list:
+    """
+    Серверы BBB, с которых загружаются конференции. Список читается при каждом вызове,
+    без настройки bbb_servers используется единственный сервер bbb_resource
+    :return: [{"resource", "shared_secret"}]
+    """
+
+    global_pref = global_preferences_registry.manager()
+    fernet = EncryptedSerializer().get_fernet()
+
+    value = global_pref["bbb_settings__bbb_servers"]
+    servers = json.loads(fernet.decrypt(value).decode() or "[]") if value else []
+    if servers:
+        return servers
+
+    return [{
+        "resource": global_pref["bbb_settings__bbb_resource"],
+        "shared_secret": str(fernet.decrypt(global_pref["bbb_settings__bbb_shared_secret"]).decode()),
+    }]
@@ -0,0 +1,123 @@
+import io
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+
+from RepackingProject.common import archive
+from RepackingProject.common.archive import Archiving, ArchiveMember, ArchiveWriter, ZipStream, get_compress_type
+
+
+class ArchiveWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "record")
+        os.makedirs(self.source_dir)
+
+        self.files = {
+            "2025-01-01T10:00.mp4": os.urandom(1024 * 64),
+            "2025-01-01T10:00.txt": "Чат конференции\n".encode() * 100,
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.source_dir, name), "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_compress_type(self):
+        self.assertEqual(get_compress_type("video.mp4"), zipfile.ZIP_STORED)
+        self.assertEqual(get_compress_type("analytic_data.CSV"), zipfile.ZIP_DEFLATED)
+
+    def test_make_archive(self):
+        filename = Archiving(path=self.source_dir, expansion="zip").make_archive()
+
+        self.assertEqual(filename, f"{self.source_dir}.zip")
+        with zipfile.ZipFile(filename) as zf:
+            self.assertEqual(sorted(zf.namelist()), sorted(self.files.keys()))
+            self.assertEqual(zf.getinfo("2025-01-01T10:00.mp4").compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo("2025-01-01T10:00.txt").compress_type, zipfile.ZIP_DEFLATED)
+            for name, data in self.files.items():
+                self.assertEqual(zf.read(name), data)
+
+        self.assertTrue(os.path.exists(os.path.join(self.source_dir, "2025-01-01T10:00.mp4")))
+
+    def test_make_archive_remove(self):
+        filename = Archiving(path=self.source_dir, expansion="zip", remove=True).make_archive()
+
+        self.assertEqual(os.listdir(self.source_dir), [])
+        with zipfile.ZipFile(filename) as zf:
+            self.assertIsNone(zf.testzip())
+
+    def test_add_bytes(self):
+        path = os.path.join(self.tmp_dir, "chat.zip")
+        with ArchiveWriter(path) as archive:
+            archive.add_bytes("chat.txt", "сообщение".encode())
+
+        with zipfile.ZipFile(path) as zf:
+            self.assertEqual(zf.read("chat.txt").decode(), "сообщение")
+
+    def test_remove_archive_on_error(self):
+        path = os.path.join(self.tmp_dir, "broken.zip")
+        with self.assertRaises(FileNotFoundError):
+            with ArchiveWriter(path) as archive:
+                archive.add_file(os.path.join(self.tmp_dir, "missing.mp4"))
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_archive_member(self):
+        filename = Archiving(path=self.source_dir, expansion="zip").make_archive()
+
+        video = ArchiveMember(filename, "2025-01-01T10:00.mp4")
+        self.assertEqual(video.size, len(self.files["2025-01-01T10:00.mp4"]))
+        with video.open() as f:
+            f.seek(1000)
+            self.assertEqual(f.read(500), self.files["2025-01-01T10:00.mp4"][1000:1500])
+            f.seek(video.size - 10)
+            self.assertEqual(f.read(), self.files["2025-01-01T10:00.mp4"][-10:])
+
+        chat = ArchiveMember(filename, "2025-01-01T10:00.txt")
+        with chat.open() as f:
+            self.assertEqual(f.read(), self.files["2025-01-01T10:00.txt"])
+
+        with self.assertRaises(FileNotFoundError):
+            ArchiveMember(filename, "missing.mp4")
+
+
+class ZipStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = {
+            "2025-01-01T10:00.mp4": os.urandom(1024 * 300),
+            "2025-01-01T10:00.txt": "Чат конференции\n".encode() * 100,
+            "analytic_data_2025-01-01T10:00.csv": b"",
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.tmp_dir, name), "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assertZipStream(self, zip_stream):
+        size = zip_stream.size()
+        data = b"".join(zip_stream)
+
+        self.assertEqual(len(data), size)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            for name, content in self.files.items():
+                self.assertEqual(zf.read(name), content)
+                self.assertEqual(zf.getinfo(name).compress_type, zipfile.ZIP_STORED)
+
+    def test_zip_stream(self):
+        self.assertZipStream(ZipStream.from_dir(self.tmp_dir))
+
+    def test_zip_stream_zip64(self):
+        with mock.patch.object(archive, "ZIP64_LIMIT", 1000):
+            zip_stream = ZipStream.from_dir(self.tmp_dir)
+
+            self.assertTrue(zip_stream.is_zip64)
+            self.assertZipStream(zip_stream)
@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+from RepackingProject.common import circuit_breaker
+from RepackingProject.common.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from .helpers import FakeRedis
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(FakeRedis(), "health", threshold=2, reset_timeout=60)
+
+    def test_open(self):
+        self.assertEqual(self.breaker.get_state(), (CLOSED, 0))
+
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.get_state(), (OPEN, 2))
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open(self):
+        with mock.patch.object(circuit_breaker.time, "time", return_value=1000):
+            self.breaker.record_failure()
+            self.breaker.record_failure()
+
+        with mock.patch.object(circuit_breaker.time, "time", return_value=1060):
+            self.assertEqual(self.breaker.get_state()[0], HALF_OPEN)
+            self.assertFalse(self.breaker.allow(trial=False))
+
+            # Пробное обращение получает только один воркер
+            self.assertTrue(self.breaker.allow())
+            self.assertFalse(self.breaker.allow())
+
+            # Ошибка проверки снова открывает предохранитель
+            self.breaker.record_failure()
+            self.assertEqual(self.breaker.get_state()[0], OPEN)
+
+        with mock.patch.object(circuit_breaker.time, "time", return_value=1200):
+            # После новой ошибки следующий half-open снова разрешает пробу
+            self.assertTrue(self.breaker.allow())
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.get_state(), (CLOSED, 0))
+        self.assertEqual(self.breaker.redis.data, {})
+        self.assertTrue(self.breaker.allow())
@@ -0,0 +1,219 @@
+import os
+import threading
+import unittest
+from urllib.parse import unquote, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+CONTENT = os.urandom(10500)
+
+
+class FakeRedis:
+    """
+    Redis в памяти: ключи, счетчики, множества, sorted set и хеши
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def exists(self, *keys):
+        return sum(key in self.data for key in keys)
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def expire(self, key, time):
+        return key in self.data
+
+    def get(self, key):
+        value = self.data.get(key)
+        return None if value is None else str(value).encode()
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def save(self):
+        return True
+
+    def incr(self, key, amount=1):
+        self.data[key] = int(self.data.get(key, 0)) + amount
+        return self.data[key]
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def sadd(self, key, *values):
+        members = self.data.setdefault(key, set())
+        count = len(members)
+        members.update(str(value).encode() for value in values)
+        return len(members) - count
+
+    def srem(self, key, *values):
+        members = self.data.get(key, set())
+        count = len(members)
+        members.difference_update(str(value).encode() for value in values)
+        if not members:
+            self.data.pop(key, None)
+        return count - len(members)
+
+    def spop(self, key):
+        members = self.data.get(key)
+        if not members:
+            return None
+        value = members.pop()
+        if not members:
+            self.data.pop(key)
+        return value
+
+    def zadd(self, key, mapping):
+        members = self.data.setdefault(key, {})
+        count = len(members)
+        members.update({str(value).encode(): float(score) for value, score in mapping.items()})
+        return len(members) - count
+
+    def zrem(self, key, *values):
+        members = self.data.get(key, {})
+        return sum(members.pop(str(value).encode() if isinstance(value, str) else value, None) is not None
+                   for value in values)
+
+    def zrange(self, key, start, end):
+        members = sorted(self.data.get(key, {}).items(), key=lambda item: item[1])
+        return [value for value, _ in members[start:None if end == -1 else end + 1]]
+
+    def zremrangebyscore(self, key, min, max):
+        members = self.data.get(key, {})
+        expired = [value for value, score in members.items() if float(min) <= score <= float(max)]
+        for value in expired:
+            members.pop(value)
+        return len(expired)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        self.data.setdefault(key, {}).update({
+            str(name).encode(): str(value).encode() for name, value in items.items()
+        })
+        return len(items)
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field.encode())
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hincrby(self, key, field, amount=1):
+        value = int(self.data.setdefault(key, {}).get(field.encode(), 0)) + amount
+        self.data[key][field.encode()] = str(value).encode()
+        return value
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class DavHandler(BaseHTTPRequestHandler):
+    uploads = {}
+    files = {}
+    requests = []
+    fail_once = set()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b""):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PROPFIND(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.requests.append(("PROPFIND", self.path))
+        chunks = self.uploads.get(self.path)
+        if chunks is None:
+            return self.reply(404)
+
+        responses = "".join(
+            f"<d:response><d:href>{self.path}/{name}</d:href><d:propstat><d:prop>"
+            f"<d:getcontentlength>{len(data)}</d:getcontentlength></d:prop></d:propstat></d:response>"
+            for name, data in chunks.items()
+        )
+        body = f'<?xml version="1.0"?><d:multistatus xmlns:d="DAV:"><d:response><d:href>{self.path}/</d:href>' \
+               f'</d:response>{responses}</d:multistatus>'
+        self.reply(207, body.encode())
+
+    def do_MKCOL(self):
+        self.requests.append(("MKCOL", self.path))
+        self.uploads[self.path] = {}
+        self.reply(201)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        self.requests.append(("PUT", self.path))
+        if self.path in self.fail_once:
+            self.fail_once.discard(self.path)
+            return self.reply(503)
+
+        if self.path.startswith("/remote.php/dav/files/"):
+            self.files[unquote(self.path)] = data
+            return self.reply(201)
+
+        upload_dir, name = self.path.rsplit("/", 1)
+        self.uploads[upload_dir][name] = data
+        self.reply(201)
+
+    def do_MOVE(self):
+        self.requests.append(("MOVE", self.path))
+        upload_dir = self.path.rsplit("/", 1)[0]
+        chunks = self.uploads.pop(upload_dir)
+        destination = unquote(urlsplit(self.headers["Destination"]).path)
+        self.files[destination] = b"".join(chunks[name] for name in sorted(chunks))
+        self.reply(201)
+
+
+class DavServerTestCase(unittest.TestCase):
+    """
+    Тесты с WebDAV сервером NextCloud в отдельном потоке, загруженные файлы сбрасываются перед каждым тестом
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), DavHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        DavHandler.uploads, DavHandler.files, DavHandler.requests = {}, {}, []
+        DavHandler.fail_once = set()
@@ -0,0 +1,60 @@
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from RepackingProject.common import http_client
+from RepackingProject.common.http_client import get_session, reset_session
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.connections.add(self.client_address)
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HTTPClientTests(unittest.TestCase):
+    def setUp(self):
+        reset_session()
+        self.addCleanup(reset_session)
+
+    def test_default_timeout(self):
+        with mock.patch.object(requests.Session, "request") as request:
+            get_session().get("http://127.0.0.1/")
+            self.assertEqual(request.call_args[1]["timeout"], (http_client.CONNECT_TIMEOUT, http_client.READ_TIMEOUT))
+
+            get_session().head("http://127.0.0.1/", timeout=2)
+            self.assertEqual(request.call_args[1]["timeout"], 2)
+
+    def test_configure(self):
+        session = get_session()
+        self.assertIs(get_session(), session)
+
+        with mock.patch.multiple(http_client, CONNECT_TIMEOUT=5, READ_TIMEOUT=60, POOL_MAXSIZE=20):
+            http_client.configure(1, 2, 4)
+            self.assertIsNot(get_session(), session)
+            self.assertEqual(get_session().timeout, (1, 2))
+
+    def test_keep_alive(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        KeepAliveHandler.connections = set()
+
+        for _ in range(3):
+            self.assertEqual(get_session().get(f"http://127.0.0.1:{server.server_port}/").content, b"ok")
+
+        self.assertEqual(len(KeepAliveHandler.connections), 1)
@@ -0,0 +1,96 @@
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+from common import async_upload, chunked_upload
+from common.async_upload import AsyncUploader, TokenBucket, UploadError
+from common.archive import ArchiveMember, ArchiveWriter
+from common.chunked_upload import get_upload_id
+from .helpers import CONTENT, DavHandler, DavServerTestCase
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(1000)
+
+        self.assertEqual(bucket.reserve(1000), 0)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, places=2)
+
+    def test_consume_unlimited(self):
+        bucket = TokenBucket(0)
+
+        started = time.monotonic()
+        asyncio.run(bucket.consume(10 ** 9))
+        self.assertLess(time.monotonic() - started, 0.1)
+
+
+class AsyncUploaderTests(DavServerTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.local_file = os.path.join(self.tmp_dir, "record.mp4")
+        with open(self.local_file, "wb") as f:
+            f.write(CONTENT)
+        self.local_chat = os.path.join(self.tmp_dir, "record.txt")
+        with open(self.local_chat, "wb") as f:
+            f.write("Чат конференции".encode())
+
+        patcher = mock.patch.object(chunked_upload, "MIN_CHUNK_SIZE", 1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.uploader = AsyncUploader(self.url, "repack", "password", chunk_size=1000, concurrency=4, backoff=0)
+        self.upload_dir = f"/remote.php/dav/uploads/repack/{get_upload_id('/records/record.mp4', self.local_file)}"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_upload_files(self):
+        DavHandler.fail_once = {f"{self.upload_dir}/00004"}
+
+        self.uploader.run([
+            ("/records/record.mp4", self.local_file),
+            ("/records/record.txt", self.local_chat),
+        ])
+
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.mp4"], CONTENT)
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.txt"],
+                         "Чат конференции".encode())
+        self.assertIn(("MOVE", f"{self.upload_dir}/.file"), DavHandler.requests)
+
+    def test_upload_archive_member(self):
+        archive_file = os.path.join(self.tmp_dir, "record-archive.zip")
+        with ArchiveWriter(archive_file) as archive:
+            archive.add_file(self.local_file, "record.mp4")
+            archive.add_file(self.local_chat, "record.txt")
+
+        self.uploader.run([
+            ("/records/record.mp4", ArchiveMember(archive_file, "record.mp4")),
+            ("/records/record.txt", ArchiveMember(archive_file, "record.txt")),
+        ])
+
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.mp4"], CONTENT)
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.txt"],
+                         "Чат конференции".encode())
+
+    def test_upload_resume(self):
+        DavHandler.uploads[self.upload_dir] = {"00001": CONTENT[:1000], "00002": CONTENT[1000:2000]}
+
+        self.uploader.run([("/records/record.mp4", self.local_file)])
+
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.mp4"], CONTENT)
+        self.assertEqual(len([method for method, _ in DavHandler.requests if method == "PUT"]), 9)
+
+    def test_upload_error(self):
+        uploader = AsyncUploader(self.url, "repack", "password", chunk_size=1000, retries=1, backoff=0)
+        DavHandler.fail_once = {"/remote.php/dav/files/repack/records/record.txt"}
+
+        with mock.patch.object(async_upload, "RETRY_STATUS_CODES", ()):
+            with self.assertRaises(UploadError) as error:
+                uploader.run([("/records/record.txt", self.local_chat)])
+
+        self.assertEqual(error.exception.status_code, 503)
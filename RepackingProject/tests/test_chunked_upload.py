@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import requests
+
+from common import chunked_upload
+from common.archive import ArchiveMember, ArchiveWriter, MemberReader
+from common.chunked_upload import ChunkedUpload, get_upload_id
+from .helpers import CONTENT, DavHandler, DavServerTestCase
+
+
+class ChunkedUploadTests(DavServerTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.local_file = os.path.join(self.tmp_dir, "record.zip")
+        with open(self.local_file, "wb") as f:
+            f.write(CONTENT)
+
+        patcher = mock.patch.object(chunked_upload, "MIN_CHUNK_SIZE", 1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.uploader = ChunkedUpload(requests.Session(), self.url, "repack", chunk_size=1000, backoff=0)
+        self.upload_dir = f"/remote.php/dav/uploads/repack/{get_upload_id('/records/record.zip', self.local_file)}"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def puts(self):
+        return [path for method, path in DavHandler.requests if method == "PUT"]
+
+    def test_split_chunks(self):
+        chunks = self.uploader.split_chunks(len(CONTENT))
+
+        self.assertEqual(len(chunks), 11)
+        self.assertEqual(chunks[0], ("00001", 0, 1000))
+        self.assertEqual(chunks[-1], ("00011", 10000, 500))
+
+    def test_upload(self):
+        self.uploader.upload("/records/record.zip", self.local_file)
+
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.zip"], CONTENT)
+        self.assertEqual(len(self.puts()), 11)
+        self.assertEqual(DavHandler.requests[-1], ("MOVE", f"{self.upload_dir}/.file"))
+
+    def test_upload_retry(self):
+        DavHandler.fail_once = {f"{self.upload_dir}/00003"}
+
+        self.uploader.upload("/records/record.zip", self.local_file)
+
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.zip"], CONTENT)
+        self.assertEqual(self.puts().count(f"{self.upload_dir}/00003"), 2)
+
+    def test_upload_stream(self):
+        request = self.uploader.session.request
+        bodies = []
+
+        def stream_request(method, url, **kwargs):
+            if method == "PUT":
+                bodies.append((type(kwargs["data"]), kwargs["headers"]["Content-Length"]))
+            return request(method, url, **kwargs)
+
+        # Части файла передаются потоком с явной длиной, а не читаются в память
+        with mock.patch.object(self.uploader.session, "request", side_effect=stream_request):
+            self.uploader.upload("/records/record.zip", self.local_file)
+
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.zip"], CONTENT)
+        self.assertEqual(bodies[0], (MemberReader, "1000"))
+        self.assertEqual(bodies[-1], (MemberReader, "500"))
+
+    def test_upload_resume(self):
+        DavHandler.uploads[self.upload_dir] = {
+            "00001": CONTENT[:1000],
+            "00002": CONTENT[1000:2000],
+            "00003": CONTENT[2000:2500],
+        }
+
+        self.uploader.upload("/records/record.zip", self.local_file)
+
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.zip"], CONTENT)
+        self.assertNotIn(("MKCOL", self.upload_dir), DavHandler.requests)
+        self.assertEqual(len(self.puts()), 9)
+        self.assertIn(f"{self.upload_dir}/00003", self.puts())
+
+    def test_upload_archive_member(self):
+        archive_file = os.path.join(self.tmp_dir, "record-archive.zip")
+        with ArchiveWriter(archive_file) as archive:
+            archive.add_file(self.local_file, "record.mp4")
+
+        self.uploader.upload("/records/record.mp4", ArchiveMember(archive_file, "record.mp4"))
+
+        self.assertEqual(DavHandler.files["/remote.php/dav/files/repack/records/record.mp4"], CONTENT)
+        self.assertEqual(len(self.puts()), 11)
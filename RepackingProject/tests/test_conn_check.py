@@ -0,0 +1,24 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from common.conn_check import health_check
+
+
+class HealthCheckTests(unittest.TestCase):
+    def test_health_check(self):
+        with mock.patch("common.http_client.HTTPClient.head") as head:
+            head.return_value = mock.MagicMock(status_code=200)
+            self.assertTrue(health_check("nextcloud.ru"))
+
+            head.return_value = mock.MagicMock(status_code=302)
+            self.assertTrue(health_check("nextcloud.ru"))
+
+            for status_code in (401, 403, 404, 503):
+                head.return_value = mock.MagicMock(status_code=status_code)
+                self.assertFalse(health_check("nextcloud.ru"))
+
+            for error in (requests.ConnectTimeout(), requests.ReadTimeout(), requests.ConnectionError()):
+                head.side_effect = error
+                self.assertFalse(health_check("nextcloud.ru"))
@@ -0,0 +1,238 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from common.ffmpeg_repack import parse_progress, build_command, StageTimer, FILTER_COMPLEX, \
+    MediaInfo, single_source_codec_args, get_encoder_profile, thread_budget, DEFAULT_ENCODER_PROFILE, \
+    split_segments, build_concat_command, write_segments_list, RepackSources, prepare_sources
+
+
+class FFmpegProgressTests(unittest.TestCase):
+    def test_parse_progress(self):
+        lines = [
+            "frame=120\n", "fps=24.00\n", "out_time_us=5000000\n", "speed=1.5x\n", "progress=continue\n",
+            "[h264 @ 0x55] some log line\n",
+            "frame=240\n", "out_time_us=10000000\n", "progress=end\n",
+        ]
+        events = list(parse_progress(lines))
+
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0].frame, 120)
+        self.assertEqual(events[0].out_time, 5.0)
+        self.assertEqual(events[0].speed, "1.5x")
+        self.assertFalse(events[0].is_end)
+        self.assertEqual(events[1].out_time, 10.0)
+        self.assertTrue(events[1].is_end)
+
+    def test_parse_progress_negative_out_time(self):
+        events = list(parse_progress(["out_time_us=-9223372036854775807\n", "progress=continue\n"]))
+
+        self.assertEqual(events[0].out_time, 0)
+
+    def test_progress_percent_eta(self):
+        events = list(parse_progress(["out_time_us=30000000\n", "speed=2.0x\n", "progress=continue\n"]))
+
+        self.assertEqual(events[0].percent(120), 25.0)
+        self.assertEqual(events[0].eta(120), 45)
+        self.assertEqual(events[0].percent(0), 0)
+
+    def test_progress_eta_unknown_speed(self):
+        events = list(parse_progress(["out_time_us=30000000\n", "speed=N/A\n", "progress=continue\n"]))
+
+        self.assertIsNone(events[0].eta(120))
+
+
+class FFmpegCommandTests(unittest.TestCase):
+    def test_build_command_webcams(self):
+        command = build_command("out.mp4", "webcams.webm")
+
+        self.assertEqual(command.count("-i"), 1)
+        self.assertNotIn("-filter_complex", command)
+        self.assertEqual(command[-1], "out.mp4")
+        self.assertIn("pipe:1", command)
+
+    def test_build_command_deskshare(self):
+        command = build_command("out.mp4", "webcams.webm", "deskshare.webm")
+
+        self.assertEqual(command.count("-i"), 2)
+        self.assertEqual(command[command.index("-filter_complex") + 1], FILTER_COMPLEX)
+        self.assertLess(command.index("deskshare.webm"), command.index("webcams.webm"))
+
+
+class SingleSourceCodecArgsTests(unittest.TestCase):
+    @staticmethod
+    def media_info(video_codec, audio_codec):
+        streams = []
+        if video_codec:
+            streams.append({"codec_type": "video", "codec_name": video_codec})
+        if audio_codec:
+            streams.append({"codec_type": "audio", "codec_name": audio_codec})
+        return MediaInfo({"streams": streams, "format": {"duration": "12.5"}})
+
+    def test_media_info(self):
+        media_info = self.media_info("vp9", "opus")
+
+        self.assertEqual(media_info.video_codec, "vp9")
+        self.assertEqual(media_info.audio_codec, "opus")
+        self.assertEqual(media_info.duration, 12.5)
+
+    def test_copy_video_transcode_audio(self):
+        args = single_source_codec_args(self.media_info("vp9", "opus"), get_encoder_profile("balanced"))
+
+        self.assertEqual(args[:2], ["-c:v", "copy"])
+        self.assertIn("aac", args)
+
+    def test_copy_video_and_audio(self):
+        args = single_source_codec_args(self.media_info("h264", "aac"), get_encoder_profile("balanced"))
+
+        self.assertEqual(args, ["-c:v", "copy", "-c:a", "copy"])
+
+    def test_fast_preset_for_vp8(self):
+        args = single_source_codec_args(self.media_info("vp8", "opus"), get_encoder_profile("balanced"))
+
+        self.assertIn("veryfast", args)
+
+    def test_audio_only(self):
+        args = single_source_codec_args(self.media_info(None, "opus"), get_encoder_profile("balanced"))
+
+        self.assertEqual(args[0], "-vn")
+
+    def test_quality_profile(self):
+        args = single_source_codec_args(self.media_info("vp9", "opus"), get_encoder_profile("quality"))
+
+        self.assertNotIn("copy", args)
+
+    def test_build_command_codec_args(self):
+        command = build_command("out.mp4", "webcams.webm", codec_args=["-c:v", "copy", "-c:a", "copy"])
+
+        self.assertEqual(command[-5:], ["-c:v", "copy", "-c:a", "copy", "out.mp4"])
+
+
+class EncoderProfileTests(unittest.TestCase):
+    def test_get_encoder_profile(self):
+        profile = get_encoder_profile("fast")
+
+        self.assertEqual(profile.name, "fast")
+        self.assertEqual(profile.preset, "veryfast")
+        self.assertEqual(profile.scale, 1280)
+
+    def test_get_encoder_profile_unknown(self):
+        profile = get_encoder_profile("unknown")
+
+        self.assertEqual(profile.name, DEFAULT_ENCODER_PROFILE)
+
+    def test_get_encoder_profile_override(self):
+        profile = get_encoder_profile("backlog", {"backlog": {"preset": "ultrafast", "crf": 28, "threads": 2}})
+
+        self.assertEqual(profile.preset, "ultrafast")
+        self.assertEqual(profile.video_args(threads=8)[-2:], ["-threads", "2"])
+
+    def test_video_args(self):
+        profile = get_encoder_profile("quality")
+        args = profile.video_args(threads=4)
+
+        self.assertEqual(args, ["-c:v", "h264", "-preset", "medium", "-crf", "21", "-threads", "4"])
+
+    def test_build_command_scale(self):
+        command = build_command("out.mp4", "webcams.webm", "deskshare.webm", get_encoder_profile("fast"))
+
+        self.assertIn("[vs]", command)
+        self.assertIn("scale='min(1280,iw)':-2", command[command.index("-filter_complex") + 1])
+
+    def test_thread_budget(self):
+        self.assertEqual(thread_budget(2, cpu_count=8), 4)
+        self.assertEqual(thread_budget(16, cpu_count=8), 1)
+        self.assertEqual(thread_budget(0, cpu_count=8), 8)
+
+
+class StageTimerTests(unittest.TestCase):
+    def test_stage_timer(self):
+        timer = StageTimer()
+        with timer.stage("probe"):
+            pass
+        with timer.stage("probe"):
+            pass
+
+        self.assertEqual(list(timer.stages.keys()), ["probe"])
+        self.assertGreaterEqual(timer.total(), 0)
+
+    def test_stage_timer_on_stage(self):
+        stages = []
+        timer = StageTimer(on_stage=stages.append)
+        with timer.stage("probe"):
+            pass
+        with timer.stage("encode"):
+            pass
+
+        self.assertEqual(stages, ["probe", "encode"])
+
+
+class SegmentTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_split_segments(self):
+        self.assertEqual(split_segments(2000, 900), [(0.0, 900), (900.0, 1100)])
+        self.assertEqual(split_segments(2700, 900), [(0.0, 900), (900.0, 900), (1800.0, 900)])
+        self.assertEqual(split_segments(0, 900), [])
+
+    def test_build_command_segment(self):
+        command = build_command("segment.mp4", "webcams.webm", "deskshare.webm", get_encoder_profile("quality"),
+                                segment=(900.0, 900.0))
+
+        self.assertEqual(command.count("-ss"), 2)
+        self.assertEqual(command.count("-t"), 2)
+        self.assertLess(command.index("-ss"), command.index("-i"))
+        self.assertIn("-an", command)
+
+    def test_build_concat_command(self):
+        command = build_concat_command("segments.txt", "out.mp4", "webcams.webm", ["-c:a", "aac"])
+
+        self.assertEqual(command[command.index("-f") + 1], "concat")
+        self.assertEqual(command[command.index("-c:v") + 1], "copy")
+        self.assertEqual(command[-3:], ["-c:a", "aac", "out.mp4"])
+
+    def test_write_segments_list(self):
+        path = write_segments_list(os.path.join(self.tmp_dir, "segments.txt"), ["segment-0000.mp4", "it's.mp4"])
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("file '/"))
+        self.assertIn("it'\\''s.mp4", lines[1])
+
+    def test_can_split(self):
+        media_info = MediaInfo({"streams": [{"codec_type": "video", "codec_name": "vp8"}],
+                                "format": {"duration": "3600"}})
+
+        self.assertTrue(RepackSources("webcams.webm", "deskshare.webm", media_info)
+                        .can_split(get_encoder_profile("balanced"), 900))
+        self.assertFalse(RepackSources("webcams.webm", "deskshare.webm", media_info)
+                         .can_split(get_encoder_profile("balanced"), 2000))
+
+
+class PrepareSourcesTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cache_entry_removed(self):
+        # Запись кэша удалена до копирования popcorn.xml, обработка продолжается без него
+        cache = mock.MagicMock()
+        cache.fetch.side_effect = lambda url, pin_dir=None: os.path.join(self.tmp_dir, "removed", os.path.basename(url))
+
+        with mock.patch("common.ffmpeg_repack.probe_sources",
+                        return_value={"webcams": True, "deskshare": False, "popcorn": True}), \
+                mock.patch("common.ffmpeg_repack.probe_media", return_value=None):
+            sources = prepare_sources("https://bbb", "record", os.path.join(self.tmp_dir, "output"), cache=cache)
+
+        self.assertEqual(sources.webcams, os.path.join(self.tmp_dir, "removed", "webcams.webm"))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "output", "popcorn.xml")))
@@ -0,0 +1,117 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.media_cache import MediaCache
+
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        self.requests.append(header)
+
+        start, end = header.replace("bytes=", "").split("-")
+        body = CONTENT[int(start):int(end) + 1]
+
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MediaCacheTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/presentation/1/video/webcams.webm"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        RangeHandler.requests = []
+        self.root = tempfile.mkdtemp()
+        self.cache = MediaCache(self.root, max_size=len(CONTENT) * 2, workers=4, min_range_size=10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_fetch_ranges(self):
+        path = self.cache.fetch(self.url)
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertTrue(path.endswith(".webm"))
+        self.assertEqual(len(RangeHandler.requests), 4)
+
+    def test_fetch_hit(self):
+        first = self.cache.fetch(self.url)
+        RangeHandler.requests = []
+
+        self.assertEqual(self.cache.fetch(self.url), first)
+        self.assertEqual(RangeHandler.requests, [])
+
+    def test_fetch_resume(self):
+        path = self.cache.path(self.url, len(CONTENT), '"v1"')
+        os.makedirs(os.path.dirname(path))
+        with open(f"{path}.part0", "wb") as f:
+            f.write(CONTENT[:1000])
+
+        self.cache.fetch(self.url)
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertIn("bytes=1000-63999", RangeHandler.requests)
+
+    def test_evict(self):
+        old = os.path.join(self.root, "old.webm")
+        with open(old, "wb") as f:
+            f.write(CONTENT)
+        os.utime(old, (time.time() - 3600, time.time() - 3600))
+
+        recent = os.path.join(self.root, "recent.webm")
+        with open(recent, "wb") as f:
+            f.write(CONTENT[:1000])
+
+        self.cache.fetch(self.url)
+
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(recent))
+
+    def test_evict_pinned(self):
+        task_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, task_dir)
+        pin_dir = os.path.join(task_dir, "media")
+        pinned = self.cache.fetch(self.url, pin_dir)
+        path = self.cache.path(self.url, len(CONTENT), '"v1"')
+        self.assertEqual(os.path.dirname(pinned), pin_dir)
+
+        # Вытеснение удаляет запись кэша вместе с блокировкой, закрепленная копия остается
+        self.cache.evict(self.cache.max_size)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(f"{path}.lock"))
+
+        with open(pinned, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)